@@ -1,4 +1,4 @@
-from flask import Blueprint, Flask, request, jsonify, current_app
+from flask import Blueprint, Flask, Response, request, jsonify, current_app, g, has_app_context
 from flask_cors import CORS
 import sqlite3
 import json
@@ -10,27 +10,132 @@ from uuid import uuid4
 import jwt
 import traceback
 from functools import wraps
-from flask import send_from_directory
+from flask import send_from_directory, render_template, send_file
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from flask_mail import Mail, Message
 import pdfkit
-import uuid
+import gzip
+import hashlib
+import threading
+import time
+import codecs
+import tempfile
+import zlib
+import zipfile
+import re
+import math
+import heapq
+import unicodedata
+import queue
+import smtplib
+import multiprocessing
+import click
+from flask.cli import AppGroup
+from flask.json.provider import DefaultJSONProvider
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
+
+try:
+    import orjson
+except ImportError:  # dépendance optionnelle, repli sur le module json standard
+    orjson = None
+
+try:
+    from PIL import Image
+except ImportError:  # dépendance optionnelle : sans Pillow, /uploads sert toujours l'original
+    Image = None
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # dépendance optionnelle : sans pypdf, un wkhtmltopdf par devis d'une campagne
+    PdfReader = PdfWriter = None
 
 
 # Load env variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:3000", "http://localhost:5173"], supports_credentials=True)
+
+# --- Sérialisation JSON ---
+# JSON_BACKEND=orjson (par défaut si installé) ou stdlib. Le choix s'applique aux
+# réponses (app.json, donc jsonify) et au stockage des snapshots (json_dumps/json_loads).
+
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson" if orjson else "stdlib")
+if JSON_BACKEND == "orjson" and orjson is None:
+    JSON_BACKEND = "stdlib"
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Provider JSON Flask basé sur orjson (mêmes options que le provider par défaut)"""
+
+    def _option(self, indent=False):
+        # Dates confiées à self.default pour garder le format HTTP du provider standard
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        # Options propres au module json (cls, ensure_ascii...) : on délègue au provider standard
+        if set(kwargs) - {'indent', 'separators', 'sort_keys'}:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._option(kwargs.get('indent'))).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._option(indent) | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if JSON_BACKEND == "orjson":
+    app.json = OrjsonProvider(app)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+
+CORS(app, origins=["http://localhost:3000", "http://localhost:5173"], supports_credentials=True,
+     expose_headers=["X-Next-Cursor"])
 
 
 
 DATABASE = "midocean_crm.db"
 UPLOAD_FOLDER = 'static/uploads'
 app.config['DATABASE'] = DATABASE
+# Connexions SQLite inactives conservées par le pool (une par worker suffit en général)
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 8))
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Images produits : taille maximale téléchargée, largeurs des miniatures (Pillow),
+# workers qui les génèrent et durée de cache navigateur des fichiers (noms = empreinte)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_MB", 10)) * 1024 * 1024
+IMAGE_WIDTHS = (160, 320, 640, 1280)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+# Miroir local des images du catalogue MidOcean (variants et positions d'impression) :
+# téléchargées après chaque rafraîchissement, puis servies depuis /uploads aux clients
+# qui le demandent (?local_images=1 ou en-tête X-Local-Images: 1)
+ASSET_MIRROR = os.getenv("ASSET_MIRROR", "true").lower() == "true"
+MIRROR_WORKERS = int(os.getenv("MIRROR_WORKERS", 4))
+MIRROR_MAX_ATTEMPTS = 3
+# Hôtes dont une image de devis absente du miroir peut être téléchargée
+MIRROR_ALLOWED_HOSTS = {host.strip().lower() for host in
+                        os.getenv("MIRROR_ALLOWED_HOSTS", "cdn1.midocean.com").split(",") if host.strip()}
 API_KEY = os.getenv("API_KEY")
 JWT_SECRET = os.getenv("JWT_SECRET", "supersecret")
 app.config['SECRET_KEY'] = JWT_SECRET
@@ -40,13 +145,59 @@ products_bp = Blueprint('products', __name__)
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 
+# Rafraîchissement MidOcean : nombre de téléchargements simultanés et timeout par défaut
+# (surchargé par endpoint via la clé "timeout" d'API_ENDPOINTS)
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", 5))
+FETCH_TIMEOUT = int(os.getenv("FETCH_TIMEOUT", 15))
+# Ingestion streamée des gros flux (clé "stream" d'API_ENDPOINTS) : mémoire bornée par un produit
+FETCH_STREAMING = os.getenv("FETCH_STREAMING", "true").lower() == "true"
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", 64 * 1024))
+# Nombre de versions du catalogue dont on garde les différences (/midocean/changes)
+CATALOG_CHANGES_KEEP_VERSIONS = int(os.getenv("CATALOG_CHANGES_KEEP_VERSIONS", 200))
+
+# Stockage des snapshots api_data : compression et rétention (par endpoint et par statut,
+# on garde les N derniers snapshots, plus ceux vus dans les N derniers jours ; 0 = désactivé)
+SNAPSHOT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zlib")
+SNAPSHOT_KEEP_LAST = int(os.getenv("SNAPSHOT_KEEP_LAST", 3))
+SNAPSHOT_KEEP_DAYS = int(os.getenv("SNAPSHOT_KEEP_DAYS", 7))
+
+# Produits similaires : nombre de voisins précalculés par produit (table product_similarities)
+SIMILAR_TOP_K = int(os.getenv("SIMILAR_TOP_K", 8))
+
+# Hachage des mots de passe (scrypt, PBKDF2 pour l'admin initial) dans ce nombre de
+# processus, hors des threads de requête (0 : dans le thread de la requête)
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Devis : PDF (wkhtmltopdf) et e-mail générés en tâche de fond par ce nombre de workers
+DEVIS_WORKERS = int(os.getenv("DEVIS_WORKERS", 2))
+# Cache des PDF de devis (nommés par empreinte du HTML) : durée de vie depuis
+# le dernier accès et taille maximale du dossier, nettoyés au plus une fois par heure
+PDF_CACHE_TTL_DAYS = int(os.getenv("PDF_CACHE_TTL_DAYS", 90))
+PDF_CACHE_MAX_MB = int(os.getenv("PDF_CACHE_MAX_MB", 1024))
+PDF_CACHE_CLEANUP_INTERVAL = 3600
+# Nombre maximal de devis par appel à POST /api/devis/batch
+DEVIS_BATCH_MAX = int(os.getenv("DEVIS_BATCH_MAX", 200))
+# Devis d'une campagne rendus par un même appel à wkhtmltopdf (PDF découpé ensuite)
+DEVIS_RENDER_BATCH = int(os.getenv("DEVIS_RENDER_BATCH", 20))
+# File d'envoi des e-mails (mail_outbox) : messages envoyés par lot sur une seule
+# connexion SMTP, nouvel essai après MAIL_RETRY_SECONDS * 2^(tentative - 1)
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", 50))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 6))
+MAIL_RETRY_SECONDS = int(os.getenv("MAIL_RETRY_SECONDS", 30))
+MAIL_POLL_SECONDS = int(os.getenv("MAIL_POLL_SECONDS", 30))
+# Bail d'un devis ou d'un lot d'e-mails pris par un worker : au-delà, le worker est
+# considéré arrêté et un autre processus peut reprendre la tâche
+DEVIS_LEASE_SECONDS = int(os.getenv("DEVIS_LEASE_SECONDS", 600))
+MAIL_LEASE_SECONDS = int(os.getenv("MAIL_LEASE_SECONDS", 300))
+
 API_ENDPOINTS = {
     "products": {
         "url": "https://api.midocean.com/gateway/products/2.0?language=fr",
         "headers": {
             "Accept": "application/json",
             "x-Gateway-APIKey": API_KEY
-        }
+        },
+        "stream": "products"
     },
     "stock": {
         "url": "https://api.midocean.com/gateway/stock/2.0",
@@ -74,23 +225,113 @@ API_ENDPOINTS = {
         "headers": {
             "Accept": "application/json",
             "x-Gateway-APIKey": API_KEY
-        }
+        },
+        "stream": "products"
     }
 }
 
 # --- DB init & connection helpers ---
 
-def get_db():
-    # Remplace current_app par app si tu es hors contexte requête
-    conn = sqlite3.connect(app.config['DATABASE'])
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",         # lecteurs non bloqués par l'écrivain
+    "PRAGMA synchronous=NORMAL",       # sûr en WAL, un fsync par checkpoint
+    "PRAGMA cache_size=-20000",        # ~20 Mo de cache de pages
+    "PRAGMA mmap_size=268435456",      # 256 Mo mappés en mémoire
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",        # attend le verrou au lieu de "database is locked"
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connexion du pool : close() la remet dans un état propre sans la fermer.
+
+    Elle est rendue au pool au teardown du contexte applicatif.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def discard(self):
+        super().close()
+
+
+class ConnectionPool:
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect_db(self.database, pooled=True)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.discard()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connect_db(database, pooled=False):
+    conn = sqlite3.connect(
+        database,
+        factory=PooledConnection if pooled else sqlite3.Connection,
+        check_same_thread=not pooled,
+        cached_statements=256
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def init_db():
-    conn = get_db()
-    c = conn.cursor()
+def get_pool():
+    database = app.config['DATABASE']
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(database, ConnectionPool(database, app.config['DB_POOL_SIZE']))
+    return pool
+
+
+def get_db():
+    # Dans un contexte applicatif : connexion du pool, partagée jusqu'au teardown.
+    # Hors contexte (scripts, threads) : connexion autonome à fermer par l'appelant.
+    if not has_app_context():
+        return connect_db(app.config['DATABASE'])
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
 
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def add_column_if_missing(c, table, column, definition):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# --- Migrations du schéma ---
+# Chaque migration est appliquée une seule fois, dans l'ordre, et enregistrée
+# dans schema_migrations. La 1 reprend le schéma historique de init_db et reste
+# idempotente car elle s'exécute aussi sur des bases créées avant les migrations.
+
+def migration_001_initial(c):
     c.execute('''
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -113,9 +354,30 @@ def init_db():
             endpoint TEXT NOT NULL,
             fetched_at TEXT NOT NULL,
             data TEXT NOT NULL,
-            status TEXT NOT NULL
+            status TEXT NOT NULL,
+            items_key TEXT, -- non NULL : tableau stocké élément par élément dans api_data_items
+            encoding TEXT, -- 'zlib' ou NULL/'json' (texte brut)
+            content_hash TEXT,
+            last_seen_at TEXT
+        )
+    """)
+    add_column_if_missing(c, 'api_data', 'items_key', 'TEXT')
+    add_column_if_missing(c, 'api_data', 'encoding', 'TEXT')
+    add_column_if_missing(c, 'api_data', 'content_hash', 'TEXT')
+    add_column_if_missing(c, 'api_data', 'last_seen_at', 'TEXT')
+
+    # Éléments des snapshots ingérés en streaming (un produit par ligne)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS api_data_items (
+            api_data_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            master_code TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (api_data_id, seq),
+            FOREIGN KEY(api_data_id) REFERENCES api_data(id)
         )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_api_data_items_master ON api_data_items(api_data_id, master_code)")
 
     # Users table (clients, commerciaux, admins)
     c.execute("""
@@ -162,8 +424,399 @@ def init_db():
         )
     """)
 
-    conn.commit()
+    # Catalogue MidOcean normalisé (reconstruit à chaque rafraîchissement)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_products (
+            master_code TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            master_id TEXT,
+            product_name TEXT,
+            short_description TEXT,
+            long_description TEXT,
+            brand TEXT,
+            material TEXT,
+            category_level1 TEXT,
+            category_level2 TEXT,
+            category_level3 TEXT,
+            price REAL,
+            stock INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_variants (
+            variant_id TEXT PRIMARY KEY,
+            master_code TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            sku TEXT,
+            color TEXT,
+            color_code TEXT,
+            gtin TEXT,
+            category_level1 TEXT,
+            category_level2 TEXT,
+            category_level3 TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_assets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_code TEXT NOT NULL,
+            variant_id TEXT, -- NULL pour les images génériques (printing_positions)
+            source TEXT NOT NULL CHECK(source IN ('variant','printing_positions')),
+            type TEXT,
+            subtype TEXT,
+            url TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_prices (
+            variant_id TEXT PRIMARY KEY,
+            sku TEXT,
+            price REAL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_stock (
+            ref TEXT PRIMARY KEY,
+            qty INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Snapshots api_data à partir desquels le catalogue a été construit
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            products_id INTEGER,
+            pricelist_id INTEGER,
+            stock_id INTEGER,
+            built_at TEXT NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_products_position ON catalog_products(position)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_variants_master ON catalog_variants(master_code, position)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_variants_sku ON catalog_variants(sku)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_assets_master ON catalog_assets(master_code, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_assets_variant ON catalog_assets(variant_id)")
+
+    # Historique des versions du catalogue et différences par master_code
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            products_id INTEGER,
+            pricelist_id INTEGER,
+            stock_id INTEGER,
+            changes INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            version INTEGER NOT NULL,
+            master_code TEXT NOT NULL,
+            change TEXT NOT NULL CHECK(change IN ('added','removed','price','stock','assets')),
+            old_value, -- prix, stock ou empreinte des assets selon le type de changement
+            new_value,
+            FOREIGN KEY(version) REFERENCES catalog_versions(version)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_catalog_changes_version ON catalog_changes(version, id)")
+
+
+def migration_002_products_json_columns(c):
+    # Colonnes utilisées par create_product mais absentes du CREATE TABLE d'origine
+    for column in ('colors_json', 'images_json', 'images_by_color_json', 'print_data_json'):
+        add_column_if_missing(c, 'products', column, 'TEXT')
+
+
+def migration_003_hot_query_indexes(c):
+    # Dernier snapshot par endpoint (latest_snapshot, déduplication)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_api_data_endpoint ON api_data(endpoint, status, fetched_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_quotes_created_at ON quotes(created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_quotes_client ON quotes(client_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_level1)")
+
+    # Un produit n'est qu'une fois dans les favoris d'un utilisateur
+    c.execute("""
+        DELETE FROM favorites WHERE id NOT IN (
+            SELECT MIN(id) FROM favorites GROUP BY user_id, product_id
+        )
+    """)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_favorites_user_product ON favorites(user_id, product_id)")
+
+
+def migration_004_printdata_index(c):
+    # Index des données d'impression, reconstruit à chaque nouveau snapshot printdata
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS printdata_products (
+            master_code TEXT PRIMARY KEY,
+            data TEXT NOT NULL -- master_data + printing_positions (ids de techniques non résolus)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS printdata_techniques (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS printdata_state (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            snapshot_id INTEGER NOT NULL,
+            built_at TEXT NOT NULL
+        )
+    """)
+
+
+def migration_005_valid_product_json(c):
+    # Les routes produits recopient le texte des colonnes JSON sans le décoder :
+    # on remplace une fois pour toutes les valeurs NULL ou invalides par un défaut
+    c.execute(f"SELECT id, {', '.join(PRODUCT_JSON_FIELDS)} FROM products")
+    updates = []
+    for row in c.fetchall():
+        for field in PRODUCT_JSON_FIELDS:
+            try:
+                json.loads(row[field])
+            except (TypeError, ValueError):
+                updates.append((field, PRODUCT_JSON_DEFAULT_TEXT[field], row['id']))
+    for field, text, product_id in updates:
+        c.execute(f"UPDATE products SET {field} = ? WHERE id = ?", (text, product_id))
+
+
+def migration_006_product_search(c):
+    # Index plein texte commun aux produits locaux (rowid = products.id > 0)
+    # et au catalogue MidOcean (rowid < 0, reconstruit avec catalog_products)
+    c.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+            {', '.join(SEARCH_COLUMNS)}, master_code UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+    c.execute("INSERT INTO product_search (product_search, rank) VALUES ('rank', ?)", (SEARCH_RANK,))
+
+    # Produits locaux synchronisés par triggers (create_product et toute autre écriture)
+    local_values = "NEW.id, NEW.name, NEW.description, NULL, NULL, " \
+                   "NEW.category_level1, NEW.category_level2, NEW.category_level3, NULL"
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_search_insert AFTER INSERT ON products BEGIN
+            INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+            VALUES ({local_values});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_search_update AFTER UPDATE ON products BEGIN
+            DELETE FROM product_search WHERE rowid = OLD.id;
+            INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+            VALUES ({local_values});
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_search_delete AFTER DELETE ON products BEGIN
+            DELETE FROM product_search WHERE rowid = OLD.id;
+        END
+    """)
+
+    c.execute("DELETE FROM product_search WHERE rowid > 0")
+    c.execute(f"""
+        INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+        SELECT id, name, description, NULL, NULL, category_level1, category_level2, category_level3, NULL
+        FROM products
+    """)
+    rebuild_catalog_search(c)
+
+
+def migration_007_product_similarities(c):
+    # Voisins précalculés de chaque produit local, lus par /products/<id>/similar
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS product_similarities (
+            product_id INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (product_id, similar_id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_product_similarities_score ON product_similarities(product_id, score DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_product_similarities_similar ON product_similarities(similar_id)")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_similarities_delete AFTER DELETE ON products BEGIN
+            DELETE FROM product_similarities WHERE product_id = OLD.id OR similar_id = OLD.id;
+        END
+    """)
+    rebuild_product_similarities(c)
+
+
+def migration_008_products_master_code(c):
+    # Clé externe stable des produits importés du catalogue (NULL pour les produits saisis à la main)
+    add_column_if_missing(c, 'products', 'master_code', 'TEXT')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_master_code ON products(master_code)")
+
+
+def migration_009_devis_jobs(c):
+    # Génération asynchrone des devis : une ligne par demande, suivie par GET /api/devis/<id>
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS devis_jobs (
+            id TEXT PRIMARY KEY,
+            devis_id TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('queued','running','done','failed')),
+            payload TEXT NOT NULL, -- données reçues par POST /api/devis (JSON)
+            pdf_filename TEXT NOT NULL,
+            email_status TEXT, -- 'queued', 'sent' ou 'failed'
+            error TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devis_jobs_status ON devis_jobs(status, created_at)")
+
+
+def migration_010_devis_pdf_cache(c):
+    # 1 si le PDF existait déjà (même contenu) et n'a pas été régénéré
+    add_column_if_missing(c, 'devis_jobs', 'pdf_cached', 'INTEGER')
+
+
+def migration_011_devis_batches(c):
+    # Campagnes de devis (POST /api/devis/batch) : un devis_jobs par destinataire
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS devis_batches (
+            id TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    add_column_if_missing(c, 'devis_jobs', 'batch_id', 'TEXT')
+    add_column_if_missing(c, 'devis_jobs', 'batch_index', 'INTEGER')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_devis_jobs_batch ON devis_jobs(batch_id, batch_index)")
+
+
+def migration_012_mail_outbox(c):
+    # E-mails en attente d'envoi : le devis n'attend plus le serveur SMTP
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS mail_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            devis_job_id TEXT,
+            recipients TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            html TEXT NOT NULL,
+            status TEXT NOT NULL CHECK (status IN ('pending', 'sending', 'sent', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mail_outbox_pending ON mail_outbox(status, next_attempt_at)")
+
+
+def migration_013_asset_mirror(c):
+    # Copie locale (uploads, nom = empreinte) de chaque image du catalogue, par URL
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS asset_mirror (
+            url TEXT PRIMARY KEY,
+            filename TEXT,
+            status TEXT NOT NULL CHECK (status IN ('pending', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            mirrored_at TEXT
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asset_mirror_status ON asset_mirror(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asset_mirror_mirrored_at ON asset_mirror(mirrored_at)")
+
+
+def migration_014_product_search_master_code(c):
+    # Les triggers de la migration 6 (antérieurs à products.master_code) indexaient NULL
+    local_values = "NEW.id, NEW.name, NEW.description, NULL, NULL, " \
+                   "NEW.category_level1, NEW.category_level2, NEW.category_level3, NEW.master_code"
+    c.execute("DROP TRIGGER IF EXISTS products_search_insert")
+    c.execute("DROP TRIGGER IF EXISTS products_search_update")
+    c.execute(f"""
+        CREATE TRIGGER products_search_insert AFTER INSERT ON products BEGIN
+            INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+            VALUES ({local_values});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER products_search_update AFTER UPDATE ON products BEGIN
+            DELETE FROM product_search WHERE rowid = OLD.id;
+            INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+            VALUES ({local_values});
+        END
+    """)
+
+    c.execute("DELETE FROM product_search WHERE rowid > 0")
+    c.execute(f"""
+        INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+        SELECT id, name, description, NULL, NULL, category_level1, category_level2, category_level3, master_code
+        FROM products
+    """)
+
+
+def migration_015_worker_leases(c):
+    # Bail des tâches en cours : reprises seulement quand il a expiré (plusieurs processus)
+    add_column_if_missing(c, 'devis_jobs', 'lease_until', 'TEXT')
+    add_column_if_missing(c, 'mail_outbox', 'lease_until', 'TEXT')
+
+
+MIGRATIONS = [
+    (1, "Schéma initial", migration_001_initial),
+    (2, "Colonnes JSON de products", migration_002_products_json_columns),
+    (3, "Index des requêtes fréquentes et unicité des favoris", migration_003_hot_query_indexes),
+    (4, "Index des données d'impression", migration_004_printdata_index),
+    (5, "Colonnes JSON de products valides", migration_005_valid_product_json),
+    (6, "Recherche plein texte des produits", migration_006_product_search),
+    (7, "Index des produits similaires", migration_007_product_similarities),
+    (8, "Clé master_code des produits", migration_008_products_master_code),
+    (9, "File des devis", migration_009_devis_jobs),
+    (10, "Cache des PDF de devis", migration_010_devis_pdf_cache),
+    (11, "Campagnes de devis", migration_011_devis_batches),
+    (12, "File d'envoi des e-mails", migration_012_mail_outbox),
+    (13, "Miroir des images du catalogue", migration_013_asset_mirror),
+    (14, "master_code des produits locaux dans la recherche", migration_014_product_search_master_code),
+    (15, "Bail des devis et e-mails en cours", migration_015_worker_leases),
+]
+
+
+def schema_version(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+    c.execute("SELECT MAX(version) FROM schema_migrations")
+    return c.fetchone()[0] or 0
+
 
+def migrate(conn, target=None):
+    """Applique les migrations en attente (jusqu'à target), chacune dans sa transaction.
+
+    Retourne la liste des versions appliquées.
+    """
+    c = conn.cursor()
+    current = schema_version(c)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        c.execute("BEGIN")
+        try:
+            step(c)
+            c.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                      (version, name, datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def init_db():
+    conn = get_db()
+    c = conn.cursor()
+    migrate(conn)
 
     # Insert default admin if not exists
     c.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
@@ -175,13 +828,54 @@ def init_db():
     conn.commit()
     conn.close()
 
+# --- Mots de passe ---
+# Le hachage werkzeug (scrypt par défaut, PBKDF2 pour l'admin initial) occupe le CPU
+# des dizaines de ms par appel : calculé dans un pool de processus borné
+# (PASSWORD_WORKERS) pour qu'une rafale de connexions ne bloque pas les autres requêtes.
+# Processus lancés en 'spawn' : le pool est créé à la première connexion, quand les
+# threads de l'application tournent déjà, et un fork copierait leurs verrous.
+
+_password_executor = None
+_password_lock = threading.Lock()
+
+
+def run_password_task(fn, *args):
+    global _password_executor
+    if PASSWORD_WORKERS <= 0:
+        return fn(*args)
+    with _password_lock:
+        if _password_executor is None:
+            _password_executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+        executor = _password_executor
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # Processus tué (OOM...) : pool recréé au prochain appel, calcul local cette fois
+        with _password_lock:
+            if _password_executor is executor:
+                _password_executor = None
+        return fn(*args)
+
+
+def hash_password(password):
+    return run_password_task(generate_password_hash, password)
+
+
+def verify_password(password_hash, password):
+    return run_password_task(check_password_hash, password_hash, password)
+
+
 # --- JWT token utils ---
 
 
 
-def generate_token(user_id):
+def generate_token(user_id, role=None, name=None, email=None):
+    # role/name/email dans le token : /users/me et les contrôles de rôle sans lecture de users.
+    # Un changement de rôle ou de nom prend effet à la prochaine connexion.
     return jwt.encode(
-        {"user_id": user_id, "exp": datetime.utcnow() + timedelta(hours=6)},
+        {"user_id": user_id, "role": role, "name": name, "email": email,
+         "exp": datetime.utcnow() + timedelta(hours=6)},
         app.config['SECRET_KEY'],
         algorithm="HS256"
     )
@@ -199,6 +893,10 @@ def auth_required(f):
         try:
             decoded = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
             request.user_id = decoded['user_id']
+            # Absents (None) dans les tokens émis avant l'ajout des claims
+            request.user_role = decoded.get('role')
+            request.user_name = decoded.get('name')
+            request.user_email = decoded.get('email')
         except jwt.ExpiredSignatureError:
             return jsonify({"message": "Token expiré"}), 401
         except jwt.InvalidTokenError:
@@ -210,122 +908,1364 @@ def parse_json_safe(json_str, default=None):
     if json_str is None:
         return default
     try:
-        return json.loads(json_str)
+        return json_loads(json_str)
     except (json.JSONDecodeError, TypeError):
         return default
 
+# --- Stockage des snapshots api_data ---
 
+def encode_snapshot_text(text):
+    """Texte JSON -> (valeur stockée, encoding)"""
+    if SNAPSHOT_COMPRESSION == 'zlib':
+        return zlib.compress(text.encode('utf-8'), 6), 'zlib'
+    return text, 'json'
 
-# --- Routes ---
 
+def decode_snapshot_text(value, encoding):
+    if encoding == 'zlib':
+        return zlib.decompress(value).decode('utf-8')
+    return value
 
 
-@app.route('/auth/login', methods=['POST'])
-def login():
-    data = request.get_json()
-    username = data.get("username")
-    password = data.get("password")
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, password_hash FROM users WHERE email = ?", (username,))
-    user = c.fetchone()
-    conn.close()
+def snapshot_json(snapshot, default=None):
+    return parse_json_safe(decode_snapshot_text(snapshot['data'], snapshot['encoding']), default)
 
-    # Support admin username/password from env (simple fallback)
-    if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
-        token = generate_token(0)
-        return jsonify({"token": token})
 
-    if user and check_password_hash(user['password_hash'], password):
-        token = generate_token(user['id'])
-        return jsonify({"token": token})
-    return jsonify({"message": "Nom ou mot de passe invalide"}), 401
+def latest_snapshot_hash(c, endpoint):
+    """(id, content_hash) du dernier snapshot réussi, sans lire ses données"""
+    c.execute("""
+        SELECT id, content_hash FROM api_data
+        WHERE endpoint = ? AND status = 'success'
+        ORDER BY fetched_at DESC
+        LIMIT 1
+    """, (endpoint,))
+    return c.fetchone()
 
-# --- Fetch external APIs and save results ---
-@app.route('/midocean/fetch', methods=['GET'])
-@auth_required
-def fetch_data():
-    conn = get_db()
-    c = conn.cursor()
-    results = {}
 
-    for endpoint, config in API_ENDPOINTS.items():
-        try:
-            response = requests.get(config["url"], headers=config["headers"], timeout=15)
-            response.raise_for_status()
-            json_data = response.json()
+def delete_snapshots(c, ids):
+    ids = [(snapshot_id,) for snapshot_id in ids]
+    c.executemany("DELETE FROM api_data_items WHERE api_data_id = ?", ids)
+    c.executemany("DELETE FROM api_data WHERE id = ?", ids)
+    return len(ids)
 
-            c.execute(
-                "INSERT INTO api_data (endpoint, fetched_at, data, status) VALUES (?, ?, ?, ?)",
-                (endpoint, datetime.now().isoformat(), json.dumps(json_data), "success")
-            )
-            results[endpoint] = {"status": "success", "size": len(response.text)}
-        except Exception as e:
-            error_msg = str(e)
-            c.execute(
-                "INSERT INTO api_data (endpoint, fetched_at, data, status) VALUES (?, ?, ?, ?)",
-                (endpoint, datetime.now().isoformat(), json.dumps({"error": error_msg}), "error")
-            )
-            results[endpoint] = {"status": "error", "error": error_msg}
 
-    conn.commit()
-    conn.close()
-    return jsonify({"results": results, "timestamp": datetime.now().isoformat()})
+def apply_retention(conn, keep_last=None, keep_days=None):
+    """Supprime les snapshots hors politique de rétention. Ne commit pas.
+
+    Par (endpoint, statut), un snapshot est conservé s'il fait partie des
+    keep_last plus récents ou s'il a été vu dans les keep_days derniers jours.
+    Les snapshots du catalogue courant ne sont jamais supprimés.
+    """
+    keep_last = SNAPSHOT_KEEP_LAST if keep_last is None else keep_last
+    keep_days = SNAPSHOT_KEEP_DAYS if keep_days is None else keep_days
+    if keep_last <= 0:
+        return 0
+    cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat() if keep_days > 0 else None
 
-@app.route('/midocean/data', methods=['GET'])
-@auth_required
-def get_data():
-    conn = get_db()
     c = conn.cursor()
     c.execute("""
-        SELECT endpoint, data, fetched_at, status 
-        FROM api_data 
-        WHERE id IN (SELECT MAX(id) FROM api_data GROUP BY endpoint)
-        ORDER BY endpoint
-    """)
-    data = []
-    for endpoint, data_str, fetched_at, status in c.fetchall():
-        try:
-            content = json.loads(data_str)
-        except json.JSONDecodeError:
-            content = {"error": "Format invalide"}
+        SELECT id, COALESCE(last_seen_at, fetched_at) AS seen_at FROM (
+            SELECT id, fetched_at, last_seen_at,
+                   ROW_NUMBER() OVER (PARTITION BY endpoint, status ORDER BY fetched_at DESC, id DESC) AS rank
+            FROM api_data
+        )
+        WHERE rank > ?
+          AND id NOT IN (
+              SELECT products_id FROM catalog_state WHERE products_id IS NOT NULL
+              UNION SELECT pricelist_id FROM catalog_state WHERE pricelist_id IS NOT NULL
+              UNION SELECT stock_id FROM catalog_state WHERE stock_id IS NOT NULL
+          )
+    """, (keep_last,))
+    expired = [row['id'] for row in c.fetchall() if cutoff is None or row['seen_at'] < cutoff]
+    return delete_snapshots(c, expired)
+
+
+def compress_legacy_snapshots(conn):
+    """Compresse et hache les snapshots écrits avant la compression. Commit par snapshot."""
+    if SNAPSHOT_COMPRESSION != 'zlib':
+        return 0
+    c = conn.cursor()
+    c.execute("SELECT id FROM api_data WHERE encoding IS NULL OR encoding != 'zlib'")
+    ids = [row['id'] for row in c.fetchall()]
+    for snapshot_id in ids:
+        c.execute("SELECT data, items_key FROM api_data WHERE id = ?", (snapshot_id,))
+        row = c.fetchone()
+        text = row['data']
+        data, encoding = encode_snapshot_text(text)
+        c.execute("UPDATE api_data SET data = ?, encoding = ?, content_hash = COALESCE(content_hash, ?) WHERE id = ?",
+                  (data, encoding, hashlib.sha256(text.encode('utf-8')).hexdigest(), snapshot_id))
+        if row['items_key'] is not None:
+            items = conn.execute("SELECT seq, data FROM api_data_items WHERE api_data_id = ?", (snapshot_id,))
+            c.executemany("UPDATE api_data_items SET data = ? WHERE api_data_id = ? AND seq = ?",
+                          ((encode_snapshot_text(item['data'])[0], snapshot_id, item['seq']) for item in items.fetchall()))
+        conn.commit()
+    return len(ids)
 
-        data.append({
-            "api": endpoint,
-            "data": content,
-            "last_updated": fetched_at,
-            "status": status
-        })
+
+snapshots_cli = AppGroup('snapshots', help="Maintenance des snapshots MidOcean (table api_data)")
+
+
+@snapshots_cli.command('compact')
+@click.option('--keep-last', type=int, default=None, help="Snapshots conservés par endpoint et statut")
+@click.option('--keep-days', type=int, default=None, help="Conserver aussi les snapshots vus depuis N jours")
+@click.option('--no-vacuum', is_flag=True, help="Ne pas lancer VACUUM")
+def compact_snapshots_command(keep_last, keep_days, no_vacuum):
+    """Compresse les anciens snapshots, applique la rétention et récupère l'espace disque."""
+    conn = get_db()
+    compressed = compress_legacy_snapshots(conn)
+    deleted = apply_retention(conn, keep_last, keep_days)
+    conn.commit()
+    if not no_vacuum:
+        conn.execute("VACUUM")
     conn.close()
-    return jsonify(data)
+    click.echo(f"{compressed} snapshot(s) compressé(s), {deleted} snapshot(s) supprimé(s)")
 
-# --- CRUD Users ---
 
-@app.route('/users', methods=['GET'])
-@auth_required
-def get_users():
+app.cli.add_command(snapshots_cli)
+
+
+db_cli = AppGroup('db', help="Schéma de la base SQLite")
+
+
+@db_cli.command('upgrade')
+@click.option('--to', 'target', type=int, default=None, help="Version cible (par défaut : la dernière)")
+def db_upgrade_command(target):
+    """Applique les migrations en attente."""
     conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, name, email, role FROM users")
-    users = [dict(row) for row in c.fetchall()]
+    applied = migrate(conn, target)
+    version = schema_version(conn.cursor())
     conn.close()
-    return jsonify(users)
+    if applied:
+        click.echo(f"Migrations appliquées : {', '.join(map(str, applied))} (version {version})")
+    else:
+        click.echo(f"Base à jour (version {version})")
 
-@app.route('/users', methods=['POST'])
-def create_user():
-    data = request.get_json()
-    name = data.get('name')
-    email = data.get('email')
-    role = data.get('role')
-    password = data.get('password')
-    if not all([name, email, role, password]):
-        return jsonify({"message": "Tous les champs sont obligatoires"}), 400
 
-    password_hash = generate_password_hash(password)
+@db_cli.command('status')
+def db_status_command():
+    """Affiche la version du schéma et les migrations en attente."""
     conn = get_db()
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO users (name, email, role, password_hash) VALUES (?, ?, ?, ?)",
+    version = schema_version(conn.cursor())
+    conn.close()
+    click.echo(f"Version du schéma : {version}")
+    for number, name, _ in MIGRATIONS:
+        click.echo(f"  [{'x' if number <= version else ' '}] {number:03d} {name}")
+
+
+app.cli.add_command(db_cli)
+
+# --- Catalogue MidOcean normalisé ---
+
+CATALOG_ENDPOINTS = ('products', 'pricelist', 'stock')
+
+
+def latest_snapshot(c, endpoint):
+    """Dernier snapshot api_data réussi pour un endpoint (ou None)"""
+    c.execute("""
+        SELECT id, data, items_key, encoding FROM api_data
+        WHERE endpoint = ? AND status = 'success'
+        ORDER BY fetched_at DESC
+        LIMIT 1
+    """, (endpoint,))
+    return c.fetchone()
+
+
+def iter_snapshot_items(conn, snapshot, key):
+    """Éléments du tableau `key` d'un snapshot, qu'il ait été ingéré en streaming ou non"""
+    if snapshot['items_key'] is not None:
+        rows = conn.execute(
+            "SELECT data FROM api_data_items WHERE api_data_id = ? ORDER BY seq", (snapshot['id'],)
+        )
+        for row in rows:
+            yield json_loads(decode_snapshot_text(row[0], snapshot['encoding']))
+        return
+
+    data = snapshot_json(snapshot, {})
+    items = data.get(key, []) if isinstance(data, dict) else data
+    yield from items or []
+
+
+def load_snapshot_data(conn, snapshot):
+    """Document complet d'un snapshot (réassemble les snapshots streamés)"""
+    data = snapshot_json(snapshot, {"error": "Format invalide"})
+    key = snapshot['items_key']
+    if key is None:
+        return data
+    items = list(iter_snapshot_items(conn, snapshot, key))
+    if key == '':
+        return items
+    data[key] = items
+    return data
+
+
+def parse_price(value):
+    """Convertit un prix MidOcean ("1,23") en float, None si illisible"""
+    try:
+        return float(str(value).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+
+
+def rebuild_catalog(conn):
+    """Éclate les derniers snapshots products/pricelist/stock dans les tables catalog_*.
+
+    Appelé une fois par rafraîchissement : les routes catalogue lisent ensuite
+    uniquement les lignes indexées dont elles ont besoin au lieu de re-parser
+    les snapshots complets à chaque requête. Ne commit pas.
+    Retourne le nombre de produits catalogue.
+    """
+    c = conn.cursor()
+    rows = {endpoint: latest_snapshot(c, endpoint) for endpoint in CATALOG_ENDPOINTS}
+    if not rows['products']:
+        return 0
+
+    products = iter_snapshot_items(conn, rows['products'], 'products')
+    pricelist_data = snapshot_json(rows['pricelist'], {}) if rows['pricelist'] else {}
+    stock_data = snapshot_json(rows['stock'], {}) if rows['stock'] else {}
+
+    prices = pricelist_data.get("price", []) if isinstance(pricelist_data, dict) else []
+    stock_items = stock_data.get("stock", []) if isinstance(stock_data, dict) else []
+
+    c.execute("SELECT 1 FROM catalog_state WHERE id = 1")
+    previous = catalog_signatures(c) if c.fetchone() else {}
+
+    for table in ('catalog_products', 'catalog_variants', 'catalog_assets', 'catalog_prices', 'catalog_stock'):
+        c.execute(f"DELETE FROM {table}")
+
+    c.executemany(
+        "INSERT OR REPLACE INTO catalog_prices (variant_id, sku, price) VALUES (?, ?, ?)",
+        ((item["variant_id"], item.get("sku"), parse_price(item.get("price")))
+         for item in prices if item.get("variant_id"))
+    )
+
+    stock_by_ref = {}
+    for item in stock_items:
+        ref = (item.get("sku") or "").split("-")[0]
+        stock_by_ref[ref] = stock_by_ref.get(ref, 0) + (item.get("qty") or 0)
+    c.executemany("INSERT INTO catalog_stock (ref, qty) VALUES (?, ?)", stock_by_ref.items())
+
+    product_rows, variant_rows, asset_rows = [], [], []
+    for position, product in enumerate(products):
+        master_code = product.get("master_code")
+        if not master_code:
+            continue
+        variants = product.get("variants", [])
+        first = variants[0] if variants else {}
+        product_rows.append((
+            master_code, position, product.get("master_id"), product.get("product_name"),
+            product.get("short_description"), product.get("long_description"),
+            product.get("brand"), product.get("material"),
+            first.get("category_level1"), first.get("category_level2"), first.get("category_level3"),
+        ))
+
+        for variant_position, variant in enumerate(variants):
+            variant_id = variant.get("variant_id")
+            if not variant_id:
+                continue
+            variant_rows.append((
+                variant_id, master_code, variant_position, variant.get("sku"),
+                variant.get("color_description"), variant.get("color_code"), variant.get("gtin"),
+                variant.get("category_level1"), variant.get("category_level2"), variant.get("category_level3"),
+            ))
+            for asset in variant.get("digital_assets", []):
+                asset_rows.append((
+                    master_code, variant_id, 'variant', asset.get("type"), asset.get("subtype"),
+                    asset.get("url_highress") or asset.get("url"),
+                ))
+
+        # Images génériques au produit, pas aux variants
+        for print_position in product.get("printing_positions", []):
+            for img in print_position.get("images", []):
+                for key, kind in (("print_position_image_blank", "blank"),
+                                  ("print_position_image_with_area", "with_area")):
+                    if key in img:
+                        asset_rows.append((master_code, None, 'printing_positions', kind, None, img.get(key)))
+
+    c.executemany("""
+        INSERT OR REPLACE INTO catalog_products (
+            master_code, position, master_id, product_name,
+            short_description, long_description, brand, material,
+            category_level1, category_level2, category_level3
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, product_rows)
+    c.executemany("""
+        INSERT OR REPLACE INTO catalog_variants (
+            variant_id, master_code, position, sku, color, color_code, gtin,
+            category_level1, category_level2, category_level3
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, variant_rows)
+    c.executemany("""
+        INSERT INTO catalog_assets (master_code, variant_id, source, type, subtype, url)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, asset_rows)
+
+    # Prix (min des variants) et stock agrégé dénormalisés sur le produit
+    c.execute("""
+        UPDATE catalog_products SET
+            price = (
+                SELECT MIN(p.price) FROM catalog_variants v
+                JOIN catalog_prices p ON p.variant_id = v.variant_id
+                WHERE v.master_code = catalog_products.master_code
+            ),
+            stock = COALESCE(
+                (SELECT qty FROM catalog_stock WHERE ref = catalog_products.master_code), 0
+            )
+    """)
+
+    c.execute("""
+        INSERT OR REPLACE INTO catalog_state (id, products_id, pricelist_id, stock_id, built_at)
+        VALUES (1, ?, ?, ?, ?)
+    """, tuple(rows[e]['id'] if rows[e] else None for e in CATALOG_ENDPOINTS) + (datetime.now().isoformat(),))
+
+    record_catalog_changes(c, previous, catalog_signatures(c),
+                           tuple(rows[e]['id'] if rows[e] else None for e in CATALOG_ENDPOINTS))
+    rebuild_catalog_search(c)
+
+    return len(product_rows)
+
+
+def catalog_signatures(c):
+    """master_code -> (prix, stock, empreinte des assets) du catalogue courant"""
+    assets = {}
+    c.execute("SELECT master_code, url FROM catalog_assets ORDER BY master_code, id")
+    for row in c.fetchall():
+        assets.setdefault(row['master_code'], hashlib.sha1()).update(f"{row['url']}\n".encode('utf-8'))
+
+    c.execute("SELECT master_code, price, stock FROM catalog_products")
+    return {
+        row['master_code']: (
+            row['price'],
+            row['stock'],
+            assets[row['master_code']].hexdigest()[:16] if row['master_code'] in assets else None
+        )
+        for row in c.fetchall()
+    }
+
+
+def record_catalog_changes(c, previous, current, snapshot_ids):
+    """Enregistre une nouvelle version du catalogue et ses différences avec la précédente"""
+    changes = []
+    for master_code in current.keys() - previous.keys():
+        changes.append((master_code, 'added', None, None))
+    for master_code in previous.keys() - current.keys():
+        changes.append((master_code, 'removed', None, None))
+    for master_code in current.keys() & previous.keys():
+        for kind, old, new in zip(('price', 'stock', 'assets'), previous[master_code], current[master_code]):
+            if old != new:
+                changes.append((master_code, kind, old, new))
+    changes.sort()
+
+    c.execute("""
+        INSERT INTO catalog_versions (created_at, products_id, pricelist_id, stock_id, changes)
+        VALUES (?, ?, ?, ?, ?)
+    """, (datetime.now().isoformat(),) + tuple(snapshot_ids) + (len(changes),))
+    version = c.lastrowid
+    c.executemany("""
+        INSERT INTO catalog_changes (version, master_code, change, old_value, new_value)
+        VALUES (?, ?, ?, ?, ?)
+    """, ((version,) + change for change in changes))
+
+    # Les curseurs plus anciens que la fenêtre conservée devront resynchroniser
+    oldest = version - CATALOG_CHANGES_KEEP_VERSIONS
+    c.execute("DELETE FROM catalog_changes WHERE version <= ?", (oldest,))
+    c.execute("DELETE FROM catalog_versions WHERE version <= ?", (oldest,))
+    return version
+
+
+def load_catalog_products(c, master_code=None, mirrored=False):
+    """Reconstruit le format /products/images/full depuis les tables catalog_*
+
+    mirrored : URLs des images remplacées par leur copie locale quand elle existe.
+    """
+    where = "WHERE master_code = ?" if master_code else ""
+    params = (master_code,) if master_code else ()
+
+    c.execute(f"SELECT * FROM catalog_products {where} ORDER BY position", params)
+    products = c.fetchall()
+
+    variants_by_master = {}
+    c.execute(f"""
+        SELECT master_code, variant_id, sku, color, color_code, gtin
+        FROM catalog_variants {where}
+        ORDER BY master_code, position
+    """, params)
+    for row in c.fetchall():
+        variants_by_master.setdefault(row['master_code'], []).append({
+            "variant_id": row['variant_id'],
+            "sku": row['sku'],
+            "color": row['color'],
+            "color_code": row['color_code'],
+            "gtin": row['gtin'],
+            "images": []
+        })
+
+    variant_images, product_images = {}, {}
+    if mirrored:
+        c.execute(f"""
+            SELECT a.master_code, a.variant_id, a.source, a.type, a.subtype,
+                   COALESCE(? || m.filename, a.url) AS url
+            FROM catalog_assets a
+            LEFT JOIN asset_mirror m ON m.url = a.url AND m.status = 'done'
+            {where.replace('master_code', 'a.master_code')}
+            ORDER BY a.id
+        """, (mirror_url_prefix(),) + params)
+    else:
+        c.execute(f"""
+            SELECT master_code, variant_id, source, type, subtype, url
+            FROM catalog_assets {where}
+            ORDER BY id
+        """, params)
+    for row in c.fetchall():
+        if row['source'] == 'printing_positions':
+            product_images.setdefault(row['master_code'], []).append({
+                "source": "printing_positions",
+                "type": row['type'],
+                "url": row['url']
+            })
+        elif row['type'] == 'image':
+            variant_images.setdefault(row['variant_id'], []).append({
+                "subtype": row['subtype'],
+                "url": row['url']
+            })
+
+    results = []
+    for product in products:
+        variants = variants_by_master.get(product['master_code'], [])
+        for variant in variants:
+            variant['images'] = variant_images.get(variant['variant_id'], [])
+        results.append({
+            "product_name": product['product_name'],
+            "master_code": product['master_code'],
+            "short_description": product['short_description'],
+            "long_description": product['long_description'],
+            "brand": product['brand'],
+            "material": product['material'],
+            "price": product['price'],
+            "stock": product['stock'],
+            "category_level1": product['category_level1'],
+            "category_level2": product['category_level2'],
+            "category_level3": product['category_level3'],
+            "images": product_images.get(product['master_code'], []),
+            "variants": variants
+        })
+    return results
+
+
+def ensure_catalog(conn):
+    """Construit le catalogue si la base contient des snapshots mais pas encore de tables catalog_*"""
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM catalog_state WHERE id = 1")
+    if c.fetchone() is None:
+        # Commit même pour un snapshot vide : les DELETE de la reconstruction ouvrent une transaction
+        rebuild_catalog(conn)
+        conn.commit()
+
+
+def catalog_version(c):
+    """Ids (products, pricelist, stock) des snapshots du catalogue courant, ou None"""
+    c.execute("SELECT products_id, pricelist_id, stock_id FROM catalog_state WHERE id = 1")
+    row = c.fetchone()
+    return tuple(row) if row else None
+
+
+def wants_local_images():
+    """Le client demande les copies locales des images (?local_images=1 ou X-Local-Images: 1)"""
+    if not ASSET_MIRROR:
+        return False
+    value = request.args.get('local_images') or request.headers.get('X-Local-Images') or ''
+    return value.lower() in ('1', 'true')
+
+
+# Cache de la réponse /products/images/full, déjà sérialisée et gzippée.
+# La clé est la version du catalogue : un nouveau snapshot change la clé,
+# donc un worker qui n'a pas vu l'invalidation ne sert jamais de données périmées.
+# La variante avec images locales a sa propre entrée, dont la clé inclut aussi
+# la dernière copie du miroir ; la réponse par défaut (URLs du CDN) n'en dépend pas.
+_products_full_cache = {}
+_products_full_lock = threading.Lock()
+
+
+def invalidate_products_full_cache():
+    with _products_full_lock:
+        _products_full_cache.clear()
+
+
+def get_products_full_cache(conn, local_images=False):
+    """Retourne l'entrée de cache {key, etag, body, gzip} à jour, ou None si catalogue vide"""
+    c = conn.cursor()
+    key = catalog_version(c)
+    if key is None:
+        return None
+    slot = 'entry'
+    if local_images:
+        slot = 'local'
+        c.execute("SELECT MAX(mirrored_at) FROM asset_mirror")
+        key += (c.fetchone()[0],)
+
+    entry = _products_full_cache.get(slot)
+    if entry and entry['key'] == key:
+        return entry
+
+    with _products_full_lock:
+        entry = _products_full_cache.get(slot)
+        if entry and entry['key'] == key:
+            return entry
+
+        results = load_catalog_products(c, mirrored=local_images)
+        if not results:
+            return None
+        body = app.json.dumps({"products_with_images": results}).encode('utf-8')
+        entry = {
+            'key': key,
+            'etag': hashlib.sha256(body).hexdigest()[:32],
+            'body': body,
+            'gzip': gzip.compress(body, compresslevel=6, mtime=0),
+        }
+        _products_full_cache[slot] = entry
+        return entry
+
+
+def cached_json_response(entry):
+    """Réponse JSON depuis une entrée de cache : 304 si If-None-Match correspond, gzip si accepté"""
+    use_gzip = 'gzip' in request.accept_encodings
+    # ETag fort : une représentation gzip a ses propres octets, donc son propre ETag
+    etag = f"{entry['etag']}-gz" if use_gzip else entry['etag']
+
+    if request.if_none_match.contains(entry['etag']) or request.if_none_match.contains(f"{entry['etag']}-gz"):
+        response = Response(status=304)
+    else:
+        response = Response(entry['gzip'] if use_gzip else entry['body'], mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Accept-Encoding, X-Local-Images'
+    return response
+
+
+# --- Recherche plein texte ---
+# Table FTS5 product_search (migration 6). bm25 pondère davantage le nom,
+# la marque et les catégories que les descriptions.
+
+SEARCH_COLUMNS = ('name', 'description', 'brand', 'material',
+                  'category_level1', 'category_level2', 'category_level3')
+SEARCH_RANK = "bm25(10.0, 1.0, 4.0, 2.0, 3.0, 3.0, 3.0, 0.0)"
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_TERMS_MAX = 10
+
+
+def rebuild_catalog_search(c):
+    """Remplace les entrées catalogue de l'index (rowid = -(position + 1)). Ne commit pas."""
+    c.execute("DELETE FROM product_search WHERE rowid < 0")
+    c.execute(f"""
+        INSERT INTO product_search (rowid, {', '.join(SEARCH_COLUMNS)}, master_code)
+        SELECT -(position + 1), product_name,
+               COALESCE(short_description, '') || ' ' || COALESCE(long_description, ''),
+               brand, material, category_level1, category_level2, category_level3, master_code
+        FROM catalog_products
+    """)
+
+
+def search_match_expression(query):
+    """Texte saisi -> expression MATCH : chaque mot est un préfixe, tous doivent être présents.
+
+    Les mots sont mis entre guillemets, la syntaxe FTS5 de l'utilisateur n'est pas interprétée.
+    Retourne None si la requête ne contient aucun mot.
+    """
+    terms = re.findall(r"\w+", query or "")[:SEARCH_TERMS_MAX]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_products(c, query, source=None, limit=SEARCH_PAGE_DEFAULT, offset=0):
+    """Produits (locaux et catalogue) correspondant à query, triés par pertinence"""
+    expression = search_match_expression(query)
+    if expression is None:
+        return []
+
+    where = ["product_search MATCH ?"]
+    params = [expression]
+    if source == 'local':
+        where.append("rowid > 0")
+    elif source == 'catalog':
+        where.append("rowid < 0")
+
+    # Page classée d'abord dans l'index, jointure ensuite sur ses seules lignes
+    c.execute(f"""
+        WITH hits AS (
+            SELECT rowid AS search_id, master_code, name,
+                   category_level1, category_level2, category_level3, rank
+            FROM product_search
+            WHERE {' AND '.join(where)}
+            ORDER BY rank, ABS(rowid)
+            LIMIT ? OFFSET ?
+        )
+        SELECT h.search_id, h.master_code, h.name,
+               h.category_level1, h.category_level2, h.category_level3,
+               COALESCE(p.price, cp.price) AS price, COALESCE(p.stock, cp.stock) AS stock,
+               p.image, -h.rank AS score
+        FROM hits h
+        LEFT JOIN products p ON h.search_id > 0 AND p.id = h.search_id
+        LEFT JOIN catalog_products cp ON h.search_id < 0 AND cp.master_code = h.master_code
+        ORDER BY h.rank, ABS(h.search_id)
+    """, params + [limit, offset])
+
+    results = []
+    for row in c.fetchall():
+        item = dict(row)
+        search_id = item.pop('search_id')
+        if search_id > 0:
+            item.update(source='local', id=search_id)
+            if item.get("image") and not item["image"].startswith(("http", "/")):
+                item["image"] = f"/uploads/{item['image']}"
+        else:
+            item.update(source='catalog', id=None)
+        results.append(item)
+    return results
+
+
+# --- Produits similaires ---
+# Score = 0.6 x cosinus TF-IDF (nom + description) + 0.4 x proximité du chemin de
+# catégories. Les voisins sont recalculés en entier par `flask products similar`
+# (et la migration 7), puis mis à jour en tâche de fond pour chaque produit créé.
+
+SIMILAR_TEXT_WEIGHT = 0.6
+SIMILAR_CATEGORY_WEIGHTS = (0.2, 0.1, 0.1)  # niveaux 1, 2, 3 identiques (chemin commun)
+SIMILAR_TERMS_MAX = 30  # termes de plus fort poids gardés par produit
+# Termes présents dans plus de 5 % des produits (et au moins 100) : faible idf,
+# ignorés pour le calcul des voisins qui resterait sinon quadratique
+SIMILAR_COMMON_TERM_RATIO = 0.05
+SIMILAR_COMMON_TERM_MIN = 100
+
+
+def similarity_tokens(text):
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"[a-z]{3,}", text)
+
+
+def similarity_model(c):
+    """Vecteurs TF-IDF normalisés et chemins de catégories de tous les produits locaux"""
+    c.execute("SELECT id, name, description, category_level1, category_level2, category_level3 FROM products")
+    rows = c.fetchall()
+    counts = {row['id']: Counter(similarity_tokens(f"{row['name']} {row['name']} {row['description'] or ''}"))
+              for row in rows}
+    df = Counter(term for terms in counts.values() for term in terms)
+    total = len(rows)
+
+    common = max(SIMILAR_COMMON_TERM_MIN, SIMILAR_COMMON_TERM_RATIO * total)
+    vectors = {}
+    for product_id, terms in counts.items():
+        weights = sorted(((term, (1 + math.log(count)) * (math.log((1 + total) / (1 + df[term])) + 1))
+                          for term, count in terms.items() if df[term] <= common),
+                         key=lambda item: -item[1])[:SIMILAR_TERMS_MAX]
+        norm = math.sqrt(sum(weight * weight for _, weight in weights)) or 1.0
+        vectors[product_id] = {term: weight / norm for term, weight in weights}
+
+    paths = {row['id']: tuple(row[level] or None for level in
+                              ('category_level1', 'category_level2', 'category_level3'))
+             for row in rows}
+    postings = {}
+    for product_id, vector in vectors.items():
+        for term, weight in vector.items():
+            postings.setdefault(term, []).append((product_id, weight))
+    return vectors, paths, postings
+
+
+def category_score(path, other):
+    score = 0.0
+    for level, weight in enumerate(SIMILAR_CATEGORY_WEIGHTS):
+        if path[level] is None or path[level] != other[level]:
+            break
+        score += weight
+    return score
+
+
+def product_neighbours(product_id, vectors, paths, postings, by_path):
+    """[(score, voisin)] des SIMILAR_TOP_K meilleurs voisins de product_id"""
+    dots = {}
+    for term, weight in vectors[product_id].items():
+        for other, other_weight in postings[term]:
+            dots[other] = dots.get(other, 0.0) + weight * other_weight
+    # Produits de la même catégorie sans mot commun : candidats pour compléter la liste
+    for other in by_path.get(paths[product_id][0], ())[:SIMILAR_TOP_K + 1]:
+        dots.setdefault(other, 0.0)
+    dots.pop(product_id, None)
+
+    scored = ((SIMILAR_TEXT_WEIGHT * dot + category_score(paths[product_id], paths[other]), other)
+              for other, dot in dots.items())
+    return heapq.nsmallest(SIMILAR_TOP_K, (item for item in scored if item[0] > 0),
+                           key=lambda item: (-item[0], item[1]))
+
+
+def products_by_category(paths):
+    by_path = {}
+    for product_id, path in sorted(paths.items()):
+        if path[0] is not None:
+            by_path.setdefault(path[0], []).append(product_id)
+    return by_path
+
+
+def rebuild_product_similarities(c):
+    """Recalcule les voisins de tous les produits locaux. Ne commit pas. Retourne le nombre de produits."""
+    vectors, paths, postings = similarity_model(c)
+    by_path = products_by_category(paths)
+    c.execute("DELETE FROM product_similarities")
+    for product_id in vectors:
+        c.executemany("INSERT INTO product_similarities (product_id, similar_id, score) VALUES (?, ?, ?)",
+                      ((product_id, other, score)
+                       for score, other in product_neighbours(product_id, vectors, paths, postings, by_path)))
+    return len(vectors)
+
+
+def refresh_product_similarities(c, product_ids):
+    """Calcule les voisins des produits créés ou modifiés et les ajoute aux listes où ils entrent dans le top k.
+
+    Les listes qui contenaient un produit modifié (score calculé sur ses anciennes
+    données) sont recalculées. Le modèle TF-IDF est calculé une fois pour tout le lot. Ne commit pas.
+    """
+    if not product_ids:
+        return
+    vectors, paths, postings = similarity_model(c)
+    by_path = products_by_category(paths)
+    for product_id in product_ids:
+        c.execute("SELECT product_id FROM product_similarities WHERE similar_id = ?", (product_id,))
+        stale = [row[0] for row in c.fetchall()]
+        c.execute("DELETE FROM product_similarities WHERE similar_id = ?", (product_id,))
+
+        if product_id in vectors:
+            add_product_neighbours(c, product_id, product_neighbours(product_id, vectors, paths, postings, by_path))
+        else:
+            c.execute("DELETE FROM product_similarities WHERE product_id = ?", (product_id,))
+        for other in stale:
+            if other in vectors:
+                set_product_neighbours(c, other, product_neighbours(other, vectors, paths, postings, by_path))
+
+
+def set_product_neighbours(c, product_id, neighbours):
+    c.execute("DELETE FROM product_similarities WHERE product_id = ?", (product_id,))
+    c.executemany("INSERT INTO product_similarities (product_id, similar_id, score) VALUES (?, ?, ?)",
+                  ((product_id, other, score) for score, other in neighbours))
+
+
+def add_product_neighbours(c, product_id, neighbours):
+    set_product_neighbours(c, product_id, neighbours)
+
+    # Le score est symétrique : le nouveau produit est aussi un voisin candidat de chacun de ses voisins
+    for score, other in neighbours:
+        c.execute("SELECT COUNT(*), MIN(score) FROM product_similarities WHERE product_id = ?", (other,))
+        count, lowest = c.fetchone()
+        if count < SIMILAR_TOP_K or score > lowest:
+            c.execute("INSERT OR REPLACE INTO product_similarities (product_id, similar_id, score) VALUES (?, ?, ?)",
+                      (other, product_id, score))
+            c.execute("""
+                DELETE FROM product_similarities WHERE product_id = ? AND similar_id NOT IN (
+                    SELECT similar_id FROM product_similarities WHERE product_id = ?
+                    ORDER BY score DESC, similar_id LIMIT ?
+                )
+            """, (other, other, SIMILAR_TOP_K))
+
+
+# Un seul worker : les mises à jour ne se chevauchent pas et la création
+# d'un produit n'attend pas le calcul (~0,5 s pour 10 000 produits)
+_similar_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similar')
+
+
+def schedule_similarity_refresh(product_ids):
+    """Met à jour les voisins des produits créés, hors de la requête. Retourne le Future."""
+    database = app.config['DATABASE']
+
+    def refresh():
+        conn = connect_db(database)
+        try:
+            refresh_product_similarities(conn.cursor(), product_ids)
+            conn.commit()
+        except Exception as e:
+            # L'index sera corrigé par `flask products similar`
+            conn.rollback()
+            app.logger.error(f"[Similar] Erreur mise à jour des voisins {product_ids}: {e}")
+        finally:
+            conn.close()
+
+    return _similar_executor.submit(refresh)
+
+
+products_cli = AppGroup('products', help="Maintenance des produits locaux")
+
+
+@products_cli.command('similar')
+def rebuild_similar_command():
+    """Recalcule l'index des produits similaires."""
+    conn = get_db()
+    count = rebuild_product_similarities(conn.cursor())
+    conn.commit()
+    conn.close()
+    click.echo(f"Voisins recalculés pour {count} produit(s)")
+
+
+@products_cli.command('thumbnails')
+def thumbnails_command():
+    """Génère les miniatures manquantes des images de static/uploads (Pillow requis)."""
+    if Image is None:
+        raise click.ClickException("Pillow n'est pas installé")
+    folder = app.config['UPLOAD_FOLDER']
+    names = [entry.name for entry in os.scandir(folder)
+             if entry.is_file() and os.path.splitext(entry.name)[1].lower()[1:] in ALLOWED_EXTENSIONS | {'webp'}]
+    failed = 0
+    for name in names:
+        try:
+            make_image_renditions(folder, name)
+        except Exception as e:
+            click.echo(f"{name}: {e}", err=True)
+            failed += 1
+    click.echo(f"Miniatures à jour pour {len(names) - failed} image(s), {failed} en échec")
+
+
+app.cli.add_command(products_cli)
+
+
+# --- Index des données d'impression ---
+
+PRINTDATA_BATCH_MAX = 500
+
+
+def print_technique_id(technique):
+    """Id d'une technique de position : le flux MidOcean donne des objets {"id": ...}, parfois un id seul"""
+    return technique.get('id') if isinstance(technique, dict) else technique
+
+
+def format_print_product(product):
+    """Produit printdata -> format de réponse, techniques laissées sous forme d'ids"""
+    return {
+        'master_data': {
+            'master_code': product.get('master_code'),
+            'master_id': product.get('master_id'),
+            'print_manipulation': product.get('print_manipulation'),
+            'print_template': product.get('print_template'),
+            'item_color_numbers': product.get('item_color_numbers', [])
+        },
+        'printing_positions': [{
+            'position_id': position.get('position_id'),
+            'print_position_type': position.get('print_position_type'),
+            'max_print_size_width': position.get('max_print_size_width'),
+            'max_print_size_height': position.get('max_print_size_height'),
+            'print_size_unit': position.get('print_size_unit'),
+            'rotation': position.get('rotation'),
+            'images': position.get('images', []),
+            'points': position.get('points', []),
+            'printing_techniques': position.get('printing_techniques', [])
+        } for position in product.get('printing_positions', [])]
+    }
+
+
+def rebuild_printdata_index(conn):
+    """Indexe le dernier snapshot printdata par master_code et par technique. Ne commit pas."""
+    c = conn.cursor()
+    snapshot = latest_snapshot(c, 'printdata')
+    if not snapshot:
+        return 0
+
+    envelope = snapshot_json(snapshot, {})
+    techniques = envelope.get('printing_techniques', []) if isinstance(envelope, dict) else []
+
+    c.execute("DELETE FROM printdata_products")
+    c.execute("DELETE FROM printdata_techniques")
+    c.executemany(
+        "INSERT OR REPLACE INTO printdata_techniques (id, data) VALUES (?, ?)",
+        ((print_technique_id(tech), json_dumps({
+            'id': print_technique_id(tech),
+            'name': tech.get('name', []),
+            'default': tech.get('default', False),
+            'max_colours': tech.get('max_colours')
+        })) for tech in techniques if isinstance(tech, dict) and print_technique_id(tech) is not None)
+    )
+
+    count = 0
+    for product in iter_snapshot_items(conn, snapshot, 'products'):
+        if not product.get('master_code'):
+            continue
+        # Le premier produit d'un master_code l'emporte, comme l'ancien parcours linéaire
+        c.execute(
+            "INSERT OR IGNORE INTO printdata_products (master_code, data) VALUES (?, ?)",
+            (product['master_code'], json_dumps(format_print_product(product)))
+        )
+        count += c.rowcount
+
+    c.execute("INSERT OR REPLACE INTO printdata_state (id, snapshot_id, built_at) VALUES (1, ?, ?)",
+              (snapshot['id'], datetime.now().isoformat()))
+    return count
+
+
+def ensure_printdata_index(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM printdata_state WHERE id = 1")
+    if c.fetchone() is None:
+        rebuild_printdata_index(conn)
+        conn.commit()
+
+
+def load_print_data(c, master_codes):
+    """master_code -> données d'impression avec techniques résolues (codes inconnus absents)"""
+    master_codes = list(dict.fromkeys(master_codes))
+    if not master_codes:
+        return {}
+    c.execute(
+        f"SELECT master_code, data FROM printdata_products WHERE master_code IN ({','.join('?' * len(master_codes))})",
+        master_codes
+    )
+    results = {row['master_code']: json_loads(row['data']) for row in c.fetchall()}
+
+    tech_ids = {print_technique_id(tech) for result in results.values()
+                for position in result['printing_positions']
+                for tech in position['printing_techniques']} - {None}
+    techniques = {}
+    if tech_ids:
+        c.execute(
+            f"SELECT id, data FROM printdata_techniques WHERE id IN ({','.join('?' * len(tech_ids))})",
+            list(tech_ids)
+        )
+        techniques = {row['id']: json_loads(row['data']) for row in c.fetchall()}
+
+    for result in results.values():
+        for position in result['printing_positions']:
+            resolved = []
+            for tech in position['printing_techniques']:
+                tech_id = print_technique_id(tech)
+                if tech_id not in techniques:
+                    continue
+                # Valeurs propres à la position (technique par défaut, couleurs max) prioritaires
+                resolved.append(dict(techniques[tech_id], **{
+                    key: tech[key] for key in ('default', 'max_colours') if isinstance(tech, dict) and key in tech
+                }))
+            position['printing_techniques'] = resolved
+    return results
+
+
+def run_ingestion_step(conn, name, step):
+    """Exécute une étape post-fetch dans sa propre transaction : son échec n'annule
+    ni les snapshots ni les autres étapes"""
+    try:
+        count = step(conn)
+        conn.commit()
+        return {"status": "success", "items": count}
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"[Fetch] Erreur étape {name}: {e}\n{traceback.format_exc()}")
+        return {"status": "error", "error": str(e)}
+
+
+# --- Routes ---
+
+
+
+@app.route('/auth/login', methods=['POST'])
+def login():
+    data = request.get_json()
+    username = data.get("username")
+    password = data.get("password")
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, name, email, role, password_hash FROM users WHERE email = ?", (username,))
+    user = c.fetchone()
+    conn.close()
+
+    # Support admin username/password from env (simple fallback)
+    if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+        token = generate_token(0, role='admin', name='Administrator', email=ADMIN_USERNAME)
+        return jsonify({"token": token})
+
+    if user and verify_password(user['password_hash'], password):
+        token = generate_token(user['id'], role=user['role'], name=user['name'], email=user['email'])
+        return jsonify({"token": token})
+    return jsonify({"message": "Nom ou mot de passe invalide"}), 401
+
+# --- Fetch external APIs and save results ---
+
+_JSON_WHITESPACE = ' \t\n\r'
+_JSON_DELIMITERS = _JSON_WHITESPACE + ',:]}'
+
+
+class JsonArrayStream:
+    """Parse incrémental d'un document JSON contenant un très gros tableau.
+
+    items() produit un par un les éléments du tableau `key` (ou du tableau racine)
+    en ne gardant en mémoire que l'élément courant et un chunk réseau. Une fois
+    items() épuisé, `envelope` contient le reste du document avec un tableau vide.
+    """
+
+    def __init__(self, chunks, key):
+        self.envelope = None
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._key = key
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._envelope_parts = []
+
+    def _fill(self):
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk)
+            if text:
+                self._buf = self._buf[self._pos:] + text
+                self._pos = 0
+                return
+        self._buf = self._buf[self._pos:] + self._utf8.decode(b'', final=True)
+        self._pos = 0
+        self._eof = True
+
+    def _peek(self):
+        """Prochain caractère significatif ('' en fin de flux)"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _JSON_WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                return ''
+            self._fill()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f"JSON invalide : attendu {chars!r}, trouvé {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Décode la valeur suivante, en lisant d'autres chunks tant qu'elle est incomplète"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # Un nombre coupé entre deux chunks ("12" puis "3.5") se décode quand même :
+                # on n'accepte la valeur qu'une fois son délimiteur reçu
+                if self._eof or (end < len(self._buf) and self._buf[end] in _JSON_DELIMITERS):
+                    text = self._buf[self._pos:end]
+                    self._pos = end
+                    return value, text
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _array_items(self):
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            item, _ = self._value()
+            yield item
+            if self._expect(',]') == ']':
+                return
+
+    def items(self):
+        first = self._expect('{[')
+        parts = self._envelope_parts
+        parts.append(first)
+
+        if first == '[':
+            yield from self._array_items()
+            parts.append(']')
+        elif self._peek() == '}':
+            self._pos += 1
+            parts.append('}')
+        else:
+            while True:
+                key, key_text = self._value()
+                self._expect(':')
+                if key == self._key and self._peek() == '[':
+                    self._pos += 1
+                    parts.append(f'{key_text}:[')
+                    yield from self._array_items()
+                    parts.append(']')
+                else:
+                    _, value_text = self._value()
+                    parts.append(f'{key_text}:{value_text}')
+                separator = self._expect(',}')
+                parts.append(separator)
+                if separator == '}':
+                    break
+
+        self.envelope = json_loads(''.join(parts))
+
+
+def download_endpoint_streamed(endpoint, config):
+    """Télécharge un gros endpoint par chunks et spoole ses éléments sur disque un par un.
+
+    Le spool (une ligne "master_code<TAB>json" par élément) est inséré dans
+    api_data_items au moment de la transaction finale de fetch_data.
+    """
+    started = time.monotonic()
+    fetched_at = datetime.now().isoformat()
+    spool = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with requests.get(config["url"], headers=config["headers"], stream=True,
+                          timeout=config.get("timeout", FETCH_TIMEOUT)) as response:
+            response.raise_for_status()
+
+            def chunks():
+                nonlocal size
+                for chunk in response.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+                    size += len(chunk)
+                    digest.update(chunk)
+                    yield chunk
+
+            stream = JsonArrayStream(chunks(), config["stream"])
+            count = 0
+            for item in stream.items():
+                master_code = item.get("master_code") if isinstance(item, dict) else None
+                spool.write(f"{master_code or ''}\t{json_dumps(item)}\n")
+                count += 1
+
+        # Tableau racine : l'enveloppe est une liste vide et items_key vaut ''
+        items_key = config["stream"] if isinstance(stream.envelope, dict) else ''
+        spool.seek(0)
+        data, encoding = encode_snapshot_text(json_dumps(stream.envelope))
+        return {
+            "endpoint": endpoint,
+            "fetched_at": fetched_at,
+            "data": data,
+            "encoding": encoding,
+            "content_hash": digest.hexdigest(),
+            "items_key": items_key,
+            "spool": spool,
+            "status": "success",
+            "size": size,
+            "items": count,
+            "elapsed": round(time.monotonic() - started, 3)
+        }
+    except Exception as e:
+        spool.close()
+        return {
+            "endpoint": endpoint,
+            "fetched_at": fetched_at,
+            "data": json_dumps({"error": str(e)}),
+            "status": "error",
+            "error": str(e),
+            "elapsed": round(time.monotonic() - started, 3)
+        }
+
+
+def iter_spool_rows(api_data_id, spool):
+    for seq, line in enumerate(spool):
+        master_code, _, text = line.rstrip('\n').partition('\t')
+        yield api_data_id, seq, master_code or None, encode_snapshot_text(text)[0]
+
+
+def download_endpoint(endpoint, config):
+    """Télécharge un endpoint MidOcean (exécuté dans un thread, sans accès à la base)"""
+    if FETCH_STREAMING and config.get("stream"):
+        return download_endpoint_streamed(endpoint, config)
+
+    started = time.monotonic()
+    fetched_at = datetime.now().isoformat()
+    try:
+        response = requests.get(config["url"], headers=config["headers"],
+                                timeout=config.get("timeout", FETCH_TIMEOUT))
+        response.raise_for_status()
+        text = json_dumps(json_loads(response.content))
+        data, encoding = encode_snapshot_text(text)
+        return {
+            "endpoint": endpoint,
+            "fetched_at": fetched_at,
+            "data": data,
+            "encoding": encoding,
+            "content_hash": hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            "status": "success",
+            "size": len(response.content),
+            "elapsed": round(time.monotonic() - started, 3)
+        }
+    except Exception as e:
+        return {
+            "endpoint": endpoint,
+            "fetched_at": fetched_at,
+            "data": json_dumps({"error": str(e)}),
+            "status": "error",
+            "error": str(e),
+            "elapsed": round(time.monotonic() - started, 3)
+        }
+
+
+@app.route('/midocean/fetch', methods=['GET'])
+@auth_required
+def fetch_data():
+    # Téléchargements en parallèle : la durée totale est celle de l'endpoint le plus lent
+    with ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(API_ENDPOINTS))) as pool:
+        futures = [pool.submit(download_endpoint, endpoint, config)
+                   for endpoint, config in API_ENDPOINTS.items()]
+        downloads = [future.result() for future in futures]
+
+    # Snapshots écrits en une transaction courte, puis chaque étape dans la sienne :
+    # le verrou d'écriture n'est pas gardé pendant toute la reconstruction du catalogue
+    conn = get_db()
+    c = conn.cursor()
+    results = {}
+
+    for download in downloads:
+        # Contenu identique au dernier snapshot : on note seulement qu'il a été revu
+        previous = latest_snapshot_hash(c, download["endpoint"]) if download["status"] == "success" else None
+        if previous and previous['content_hash'] == download["content_hash"]:
+            if download.get("spool"):
+                download["spool"].close()
+            c.execute("UPDATE api_data SET last_seen_at = ? WHERE id = ?", (download["fetched_at"], previous['id']))
+            results[download["endpoint"]] = {"status": "unchanged", "size": download["size"],
+                                             "elapsed": download["elapsed"]}
+            continue
+
+        c.execute(
+            """INSERT INTO api_data (endpoint, fetched_at, data, status, items_key, encoding, content_hash)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (download["endpoint"], download["fetched_at"], download["data"], download["status"],
+             download.get("items_key"), download.get("encoding"), download.get("content_hash"))
+        )
+        if download.get("spool"):
+            with download["spool"] as spool:
+                c.executemany(
+                    "INSERT INTO api_data_items (api_data_id, seq, master_code, data) VALUES (?, ?, ?, ?)",
+                    iter_spool_rows(c.lastrowid, spool)
+                )
+        if download["status"] == "success":
+            results[download["endpoint"]] = {"status": "success", "size": download["size"],
+                                             "elapsed": download["elapsed"]}
+            if "items" in download:
+                results[download["endpoint"]]["items"] = download["items"]
+        else:
+            results[download["endpoint"]] = {"status": "error", "error": download["error"],
+                                             "elapsed": download["elapsed"]}
+
+    conn.commit()
+
+    # Éclatement du catalogue une seule fois, au moment du fetch
+    if any(results.get(endpoint, {}).get("status") == "success" for endpoint in CATALOG_ENDPOINTS):
+        results["catalog"] = run_ingestion_step(conn, "catalog", rebuild_catalog)
+    if results.get("printdata", {}).get("status") == "success":
+        results["printdata_index"] = run_ingestion_step(conn, "printdata_index", rebuild_printdata_index)
+
+    results["retention"] = run_ingestion_step(conn, "retention", apply_retention)
+
+    conn.close()
+    invalidate_products_full_cache()
+    if results.get("catalog", {}).get("status") == "success":
+        schedule_asset_mirror()
+    return jsonify({"results": results, "timestamp": datetime.now().isoformat()})
+
+@app.route('/midocean/changes', methods=['GET'])
+@auth_required
+def get_catalog_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(max(int(request.args.get('limit', 5000)), 1), 50000)
+    except ValueError:
+        return jsonify({"message": "since et limit doivent être des entiers"}), 400
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT MIN(version) AS oldest, MAX(version) AS latest FROM catalog_versions")
+    bounds = c.fetchone()
+    latest = bounds['latest'] or 0
+
+    # Différences déjà purgées : le client doit repartir de /products/images/full
+    if since and bounds['oldest'] and since < bounds['oldest'] - 1:
+        conn.close()
+        return jsonify({"message": "Curseur expiré, resynchronisation complète nécessaire",
+                        "version": latest}), 410
+
+    c.execute("""
+        SELECT version, master_code, change, old_value, new_value
+        FROM catalog_changes
+        WHERE version > ?
+        ORDER BY version, id
+        LIMIT ?
+    """, (since, limit + 1))
+    rows = c.fetchall()
+
+    # Une page ne coupe jamais une version en deux : on s'arrête à la dernière
+    # version complète, ou on renvoie la première en entier si elle dépasse limit
+    has_more = len(rows) > limit
+    if has_more:
+        last_version = rows[limit]['version']
+        rows = [row for row in rows[:limit] if row['version'] < last_version]
+        if not rows:
+            c.execute("""
+                SELECT version, master_code, change, old_value, new_value
+                FROM catalog_changes WHERE version = ? ORDER BY id
+            """, (last_version,))
+            rows = c.fetchall()
+            c.execute("SELECT 1 FROM catalog_changes WHERE version > ? LIMIT 1", (last_version,))
+            has_more = c.fetchone() is not None
+    conn.close()
+
+    version = rows[-1]['version'] if has_more else max(latest, since)
+    return jsonify({
+        "since": since,
+        "version": version,
+        "latest": latest,
+        "has_more": has_more,
+        "changes": [{
+            "version": row['version'],
+            "master_code": row['master_code'],
+            "change": row['change'],
+            "old": row['old_value'],
+            "new": row['new_value']
+        } for row in rows]
+    })
+
+@app.route('/midocean/data', methods=['GET'])
+@auth_required
+def get_data():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, endpoint, data, items_key, encoding, fetched_at, last_seen_at, status
+        FROM api_data 
+        WHERE id IN (SELECT MAX(id) FROM api_data GROUP BY endpoint)
+        ORDER BY endpoint
+    """)
+    data = []
+    for row in c.fetchall():
+        data.append({
+            "api": row['endpoint'],
+            "data": load_snapshot_data(conn, row),
+            "last_updated": row['fetched_at'],
+            "last_seen": row['last_seen_at'] or row['fetched_at'],
+            "status": row['status']
+        })
+    conn.close()
+    return jsonify(data)
+
+# --- CRUD Users ---
+
+@app.route('/users', methods=['GET'])
+@auth_required
+def get_users():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, name, email, role FROM users")
+    users = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return jsonify(users)
+
+@app.route('/users', methods=['POST'])
+def create_user():
+    data = request.get_json()
+    name = data.get('name')
+    email = data.get('email')
+    role = data.get('role')
+    password = data.get('password')
+    if not all([name, email, role, password]):
+        return jsonify({"message": "Tous les champs sont obligatoires"}), 400
+
+    password_hash = hash_password(password)
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute("INSERT INTO users (name, email, role, password_hash) VALUES (?, ?, ?, ?)",
                   (name, email, role, password_hash))
         conn.commit()
         user_id = c.lastrowid
@@ -353,7 +2293,7 @@ def update_user(user_id):
     # Hash du mot de passe si fourni
     password_hash = None
     if password:
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
 
     conn = get_db()
     c = conn.cursor()
@@ -571,7 +2511,7 @@ def get_quotes():
         quotes.append({
             "id": row["id"],
             "client": row["company_name"],
-            "products": json.loads(row["products"]),
+            "products": json_loads(row["products"]),
             "created_at": row["created_at"]
         })
     conn.close()
@@ -588,7 +2528,7 @@ def create_quote():
         return jsonify({"message": "client_id et products sont requis"}), 400
 
     try:
-        products_json = json.dumps(products)
+        products_json = json_dumps(products)
     except Exception:
         return jsonify({"message": "Format products invalide"}), 400
 
@@ -608,152 +2548,40 @@ def create_quote():
 @auth_required
 def products_images_full():
     conn = get_db()
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT data FROM api_data 
-        WHERE endpoint = 'products' 
-        ORDER BY fetched_at DESC 
-        LIMIT 1
-    """)
-    products_row = c.fetchone()
-
-    c.execute("""
-        SELECT data FROM api_data 
-        WHERE endpoint = 'pricelist' 
-        ORDER BY fetched_at DESC 
-        LIMIT 1
-    """)
-    pricelist_row = c.fetchone()
-
-    c.execute("""
-        SELECT data FROM api_data 
-        WHERE endpoint = 'stock' 
-        ORDER BY fetched_at DESC 
-        LIMIT 1
-    """)
-    stock_row = c.fetchone()
-
+    ensure_catalog(conn)
+    entry = get_products_full_cache(conn, wants_local_images())
     conn.close()
 
-    if not products_row:
+    if not entry:
         return jsonify({"message": "Aucune donnée produit trouvée"}), 404
 
-    try:
-        products_data = json.loads(products_row['data'])
-        pricelist_data = json.loads(pricelist_row['data']) if pricelist_row else {}
-    except Exception:
-        return jsonify({"message": "Erreur de format JSON"}), 500
-
-    products = products_data.get("products", []) if isinstance(products_data, dict) else products_data
-    prices = pricelist_data.get("price", []) if isinstance(pricelist_data, dict) else []
-
-    stock_data = json.loads(stock_row['data']) if stock_row else {}
-    stock_items = stock_data.get("stock", []) if isinstance(stock_data, dict) else []
-
-    stock_by_ref = {}
-    for item in stock_items:
-        sku = item.get("sku", "")
-        qty = item.get("qty", 0)
-        ref = sku.split("-")[0]
-        stock_by_ref[ref] = stock_by_ref.get(ref, 0) + qty
-
-    price_by_variant_id = {
-        item["variant_id"]: item for item in prices if "variant_id" in item
-    }
-
-    results = []
-
-    for product in products:
-        variants = product.get("variants", [])
-        product_prices = []
-
-        variant_output = []
-        for variant in variants:
-            variant_id = variant.get("variant_id")
-            sku = variant.get("sku")
-            color = variant.get("color_description")
-            gtin = variant.get("gtin")
-            color_code = variant.get("color_code")
-
-            variant_images = []
-            for asset in variant.get("digital_assets", []):
-                if asset.get("type") == "image":
-                    variant_images.append({
-                        "subtype": asset.get("subtype"),
-                        "url": asset.get("url_highress") or asset.get("url")
-                    })
-
-            if variant_id and variant_id in price_by_variant_id:
-                try:
-                    price_str = price_by_variant_id[variant_id]["price"]
-                    price_float = float(price_str.replace(",", "."))
-                    product_prices.append(price_float)
-                except Exception:
-                    pass
-
-            variant_output.append({
-                "variant_id": variant_id,
-                "sku": sku,
-                "color": color,
-                "color_code": color_code,
-                "gtin": gtin,
-                "images": variant_images
-            })
-
-        final_price = min(product_prices) if product_prices else None
-
-        base_info = {
-            "product_name": product.get("product_name"),
-            "master_code": product.get("master_code"),
-            "short_description": product.get("short_description"),
-            "long_description": product.get("long_description"),
-            "brand": product.get("brand"),
-            "material": product.get("material"),
-            "price": final_price,
-            "stock": stock_by_ref.get(product.get("master_code"), 0),
-            "category_level1": variants[0].get("category_level1") if variants else None,
-            "category_level2": variants[0].get("category_level2") if variants else None,
-            "category_level3": variants[0].get("category_level3") if variants else None,
-        }
+    return cached_json_response(entry)
 
-        # Images depuis printing_positions (génériques au produit, pas aux variants)
-        product_images = []
-        for position in product.get("printing_positions", []):
-            for img in position.get("images", []):
-                if "print_position_image_blank" in img:
-                    product_images.append({
-                        "source": "printing_positions",
-                        "type": "blank",
-                        "url": img.get("print_position_image_blank")
-                    })
-                if "print_position_image_with_area" in img:
-                    product_images.append({
-                        "source": "printing_positions",
-                        "type": "with_area",
-                        "url": img.get("print_position_image_with_area")
-                    })
-
-        # Tri des images générales
-        product_images.sort(key=lambda img: (
-            0 if img.get("subtype") == "item_picture_front" else 1
-        ))
-
-        results.append({
-            **base_info,
-            "images": product_images,
-            "variants": variant_output
-        })
-
-    return jsonify({"products_with_images": results})
 
+@app.route('/products/images/full/<string:master_code>', methods=['GET'])
+@auth_required
+def product_images_by_master_code(master_code):
+    conn = get_db()
+    ensure_catalog(conn)
+    c = conn.cursor()
+    results = load_catalog_products(c, master_code, mirrored=wants_local_images())
+    conn.close()
 
+    if not results:
+        return jsonify({"message": f"Produit {master_code} introuvable"}), 404
 
+    return jsonify(results[0])
 
 
 @app.route('/users/me', methods=['GET'])
 @auth_required
 def get_current_user():
+    # Token récent : tout est dans les claims, pas de lecture de la table users.
+    # L'administrateur de .env (id 0) n'a pas de compte : 404 comme avant les claims.
+    if request.user_id and request.user_role and request.user_name:
+        return jsonify({"id": request.user_id, "name": request.user_name,
+                        "email": request.user_email, "role": request.user_role})
+
     conn = get_db()
     c = conn.cursor()
     c.execute("SELECT id, name, email, role FROM users WHERE id = ?", (request.user_id,))
@@ -791,7 +2619,7 @@ def register():
         return jsonify({"message": "Le mot de passe doit faire au moins 8 caractères"}), 400
     
     # Hachage mot de passe
-    password_hash = generate_password_hash(password)
+    password_hash = hash_password(password)
     
     try:
         # FORCER le rôle client pour les inscriptions publiques
@@ -803,7 +2631,7 @@ def register():
         user_id = c.lastrowid
         
         # Génération du token JWT
-        token = generate_token(user_id)
+        token = generate_token(user_id, role='client', name=name, email=email)
         
         return jsonify({
             "message": "Compte créé avec succès",
@@ -826,112 +2654,45 @@ def register():
     finally:
         conn.close()
 
-import json
-
 @products_bp.route('/products/<int:product_id>/similar', methods=['GET'])
 def get_similar_products(product_id):
     try:
-        # D'abord, récupérer le produit pour connaître sa catégorie
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
+        limit = min(max(int(request.args.get('limit', 4)), 1), SIMILAR_TOP_K)
+    except ValueError as e:
+        return jsonify({'error': f'Paramètre invalide: {str(e)}'}), 400
+
+    try:
+        conn = get_db()
         c = conn.cursor()
-        
-        c.execute('SELECT category_level1 FROM products WHERE id = ?', (product_id,))
-        product = c.fetchone()
-        
-        if product is None:
+
+        c.execute('SELECT 1 FROM products WHERE id = ?', (product_id,))
+        if c.fetchone() is None:
             conn.close()
             return jsonify({'error': 'Produit non trouvé'}), 404
-        
-        category = product['category_level1']
-        
-        # Récupérer 4 produits aléatoires de la même catégorie (en excluant le produit actuel)
+
+        # Voisins précalculés (product_similarities), du plus au moins proche
         c.execute('''
-            SELECT * FROM products 
-            WHERE category_level1 = ? AND id != ?
-            ORDER BY RANDOM()
-            LIMIT 4
-        ''', (category, product_id))
-        
-        similar_products = []
-        for row in c.fetchall():
-            product = dict(row)
-            
-            # Corriger l'URL de l'image
-            if product.get("image") and not product["image"].startswith(("http", "/")):
-                product["image"] = f"/uploads/{product['image']}"
-                
-            similar_products.append(product)
-        
+            SELECT p.* FROM product_similarities s
+            JOIN products p ON p.id = s.similar_id
+            WHERE s.product_id = ?
+            ORDER BY s.score DESC, s.similar_id
+            LIMIT ?
+        ''', (product_id, limit))
+        rows = c.fetchall()
         conn.close()
-        return jsonify(similar_products)
-        
+        return json_text_response("[" + ",".join(product_json_text(row) for row in rows) + "]")
+
     except Exception as e:
         if 'conn' in locals():
             conn.close()
         return jsonify({'error': str(e)}), 500
-    
+
 @app.route('/api/printdata/by-master-code/<string:master_code>', methods=['GET'])
 def get_print_data_by_master_code(master_code):
+    conn = get_db()
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Get latest print data
-        c.execute("""
-            SELECT data FROM api_data 
-            WHERE endpoint = 'printdata'
-            ORDER BY fetched_at DESC 
-            LIMIT 1
-        """)
-        row = c.fetchone()
-        
-        if not row:
-            return jsonify({"error": "No print data found"}), 404
-
-        print_data = json.loads(row['data'])
-        result = None
-
-        if 'products' in print_data:
-            for product in print_data['products']:
-                if product.get('master_code') == master_code:
-                    result = {
-                        'master_data': {
-                            'master_code': product.get('master_code'),
-                            'master_id': product.get('master_id'),
-                            'print_manipulation': product.get('print_manipulation'),
-                            'print_template': product.get('print_template'),
-                            'item_color_numbers': product.get('item_color_numbers', [])
-                        },
-                        'printing_positions': []
-                    }
-
-                    for position in product.get('printing_positions', []):
-                        position_data = {
-                            'position_id': position.get('position_id'),
-                            'print_position_type': position.get('print_position_type'),
-                            'max_print_size_width': position.get('max_print_size_width'),
-                            'max_print_size_height': position.get('max_print_size_height'),
-                            'print_size_unit': position.get('print_size_unit'),
-                            'rotation': position.get('rotation'),
-                            'images': position.get('images', []),
-                            'points': position.get('points', []),
-                            'printing_techniques': []
-                        }
-
-                        for tech_id in position.get('printing_techniques', []):
-                            for global_tech in print_data.get('printing_techniques', []):
-                                if global_tech.get('id') == tech_id:
-                                    position_data['printing_techniques'].append({
-                                        'id': tech_id,
-                                        'name': global_tech.get('name', []),
-                                        'default': global_tech.get('default', False),
-                                        'max_colours': global_tech.get('max_colours')
-                                    })
-                                    break
-
-                        result['printing_positions'].append(position_data)
-                    break
+        ensure_printdata_index(conn)
+        result = load_print_data(conn.cursor(), [master_code]).get(master_code)
 
         if not result:
             return jsonify({"error": f"Product with master_code {master_code} not found"}), 404
@@ -951,11 +2712,70 @@ def get_print_data_by_master_code(master_code):
         conn.close()
 
 
+@app.route('/api/printdata/by-master-codes', methods=['POST'])
+def get_print_data_by_master_codes():
+    data = request.get_json(silent=True) or {}
+    master_codes = data.get('master_codes')
+    if not isinstance(master_codes, list) or not all(isinstance(code, str) for code in master_codes):
+        return jsonify({"error": "master_codes doit être une liste de codes"}), 400
+    if len(master_codes) > PRINTDATA_BATCH_MAX:
+        return jsonify({"error": f"Maximum {PRINTDATA_BATCH_MAX} codes par requête"}), 400
+
+    conn = get_db()
+    try:
+        ensure_printdata_index(conn)
+        results = load_print_data(conn.cursor(), master_codes)
+        return jsonify({
+            'status': 'success',
+            'data': results,
+            'not_found': [code for code in dict.fromkeys(master_codes) if code not in results]
+        })
+
+    except Exception as e:
+        app.logger.error(f"Error in get_print_data_by_master_codes: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Internal server error'
+        }), 500
+    finally:
+        conn.close()
+
+
+
+# Colonnes JSON de products. Leur texte est validé à l'écriture (create_product,
+# migration 5) : les routes de lecture le recopient tel quel dans la réponse
+# au lieu de le décoder puis de le ré-encoder.
+PRODUCT_JSON_FIELDS = {
+    'colors_json': list,
+    'images_json': list,
+    'images_by_color_json': dict,
+    'print_data_json': dict,
+}
+PRODUCT_JSON_DEFAULT_TEXT = {field: json_dumps(default()) for field, default in PRODUCT_JSON_FIELDS.items()}
+
+
+def product_json_text(row):
+    """Ligne products -> objet JSON sérialisé, colonnes JSON insérées sans décodage"""
+    parts = []
+    for key in row.keys():
+        value = row[key]
+        if key in PRODUCT_JSON_FIELDS:
+            text = value or PRODUCT_JSON_DEFAULT_TEXT[key]
+        else:
+            if key == 'image' and value and not value.startswith(("http", "/")):
+                value = f"/uploads/{value}"
+            text = json_dumps(value)
+        parts.append(f"{json_dumps(key)}:{text}")
+    return "{" + ",".join(parts) + "}"
+
+
+def json_text_response(text, status=200):
+    return Response(text, status=status, mimetype='application/json')
+
 
 @products_bp.route('/products/<int:product_id>', methods=['GET'])
 def get_product_by_id(product_id):
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT * FROM products WHERE id = ?', (product_id,))
     row = c.fetchone()
@@ -964,39 +2784,79 @@ def get_product_by_id(product_id):
     if not row:
         return jsonify({'error': 'Produit non trouvé'}), 404
 
-    product = dict(row)
-    for field in ['colors_json', 'images_json', 'images_by_color_json', 'print_data_json']:
-        product[field] = parse_json_safe(product.get(field), [] if 'by_color' not in field else {})
+    return json_text_response(product_json_text(row))
 
-    if product.get("image") and not product["image"].startswith(("http", "/")):
-        product["image"] = f"/uploads/{product['image']}"
 
-    return jsonify(product)
+PRODUCTS_PAGE_MAX = 500
+
+
+def product_list_query(c, args):
+    """Construit (sql, params, limit) de GET /products depuis la query string.
+
+    Lève ValueError si un paramètre est invalide.
+    """
+    c.execute("PRAGMA table_info(products)")
+    columns = [row[1] for row in c.fetchall()]
+
+    # Projection : id est toujours renvoyé, il sert de curseur
+    selected = columns
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            raise ValueError(f"Champs inconnus : {', '.join(unknown)}")
+        selected = ['id'] + [field for field in fields if field != 'id']
+
+    where, params = [], []
+    for level in ('category_level1', 'category_level2', 'category_level3'):
+        if args.get(level):
+            where.append(f"{level} = ?")
+            params.append(args[level])
+    if args.get('min_price'):
+        where.append("price >= ?")
+        params.append(float(args['min_price']))
+    if args.get('max_price'):
+        where.append("price <= ?")
+        params.append(float(args['max_price']))
+    if args.get('in_stock', '').lower() in ('1', 'true', 'yes'):
+        where.append("stock > 0")
+
+    # Pagination par clé : id > curseur, coût proportionnel à la page
+    limit = None
+    if args.get('limit'):
+        limit = min(max(int(args['limit']), 1), PRODUCTS_PAGE_MAX)
+        if args.get('cursor'):
+            where.append("id > ?")
+            params.append(int(args['cursor']))
+
+    sql = f"SELECT {', '.join(selected)} FROM products"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params, limit
 
 
 @products_bp.route('/products', methods=['GET'])
 def get_products():
     try:
-        conn = sqlite3.connect(app.config['DATABASE'])
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT * FROM products')
+        try:
+            sql, params, limit = product_list_query(c, request.args)
+        except ValueError as e:
+            return jsonify({"error": f"Paramètre invalide: {str(e)}"}), 400
+        c.execute(sql, params)
         rows = c.fetchall()
         conn.close()
 
-        products = []
-        for row in rows:
-            product = dict(row)
-            for field in ['colors_json', 'images_json', 'images_by_color_json', 'print_data_json']:
-                default = [] if 'by_color' not in field and 'print_data' not in field else {}
-                product[field] = parse_json_safe(product.get(field), default)
-
-            if product.get("image") and not product["image"].startswith(("http", "/")):
-                product["image"] = f"/uploads/{product['image']}"
-
-            products.append(product)
-
-        return jsonify(products)
+        response = json_text_response("[" + ",".join(product_json_text(row) for row in rows) + "]")
+        # Page pleine : le client continue avec ?cursor=<X-Next-Cursor>
+        if limit and len(rows) == limit:
+            response.headers['X-Next-Cursor'] = str(rows[-1]['id'])
+        return response
 
     except Exception as e:
         print("❌ Erreur /products :", str(e))
@@ -1005,6 +2865,37 @@ def get_products():
 
 
 
+@products_bp.route('/products/search', methods=['GET'])
+def search_products_route():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Paramètre q obligatoire"}), 400
+    source = request.args.get('source')
+    if source not in (None, 'local', 'catalog'):
+        return jsonify({"error": "source doit valoir local ou catalog"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_DEFAULT)), 1), PRODUCTS_PAGE_MAX)
+        offset = max(int(request.args.get('cursor', 0)), 0)
+    except ValueError as e:
+        return jsonify({"error": f"Paramètre invalide: {str(e)}"}), 400
+
+    conn = get_db()
+    try:
+        ensure_catalog(conn)
+        results = search_products(conn.cursor(), query, source, limit, offset)
+    except sqlite3.OperationalError as e:
+        app.logger.error(f"[Search] Requête '{query}' : {e}")
+        return jsonify({"error": "Requête de recherche invalide"}), 400
+    finally:
+        conn.close()
+
+    response = jsonify({"query": query, "results": results})
+    # Page pleine : le client continue avec ?cursor=<X-Next-Cursor>
+    if len(results) == limit:
+        response.headers['X-Next-Cursor'] = str(offset + limit)
+    return response
+
+
 @products_bp.route('/products/<int:id>', methods=['GET'])
 def get_product(id):
     try:
@@ -1017,16 +2908,7 @@ def get_product(id):
         if row is None:
             return jsonify({'error': 'Produit non trouvé'}), 404
 
-        product = dict(row)
-        product['colors_json'] = parse_json_safe(product.get('colors_json'), [])
-        product['images_json'] = parse_json_safe(product.get('images_json'), [])
-        product['images_by_color_json'] = parse_json_safe(product.get('images_by_color_json'), {})
-        product['print_data_json'] = parse_json_safe(product.get('print_data_json'), {})
-
-        if product.get("image") and not product["image"].startswith(("http", "/")):
-            product["image"] = f"/uploads/{product['image']}"
-
-        return jsonify(product)
+        return json_text_response(product_json_text(row))
 
     except Exception as e:
         print("❌ Erreur /products/<id> :", str(e))
@@ -1034,9 +2916,297 @@ def get_product(id):
         return jsonify({"error": "Erreur serveur"}), 500
 
 
+# --- Images produits ---
+# Les images (upload ou URL) sont lues par blocs, limitées à IMAGE_MAX_BYTES et
+# nommées par l'empreinte de leur contenu : une même image n'est stockée qu'une fois.
+# Les miniatures WebP/JPEG (uploads/renditions) sont générées en tâche de fond.
+
+IMAGE_CONTENT_TYPES = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+IMAGE_RENDITION_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='images')
+# Miniatures en cours ou impossibles (image illisible) : jamais replanifiées par /uploads
+_renditions_pending = set()
+_renditions_failed = set()
+_renditions_lock = threading.Lock()
+
+
+def image_extension(name, content_type=None):
+    ext = os.path.splitext(name or '')[1].lower()
+    if ext[1:] in ALLOWED_EXTENSIONS or ext == '.webp':
+        return '.jpg' if ext == '.jpeg' else ext
+    return IMAGE_CONTENT_TYPES.get((content_type or '').split(';')[0].strip().lower(), '.jpg')
+
+
+def store_image(chunks, ext, folder=None):
+    """Écrit les blocs d'une image dans uploads sous le nom de son empreinte. Retourne le nom.
+
+    Lève ValueError au-delà de IMAGE_MAX_BYTES.
+    """
+    folder = folder or app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(folder, f".{uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ValueError(f"Image trop volumineuse (max {IMAGE_MAX_BYTES // 1024 // 1024} Mo)")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("Image vide")
+        filename = f"{digest.hexdigest()[:32]}{ext}"
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    schedule_image_renditions(filename, folder)
+    return filename
+
+
+def download_image(url, folder=None):
+    """Télécharge une image en streaming (taille limitée) et la stocke. Retourne le nom du fichier."""
+    with requests.get(url, timeout=10, stream=True) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > IMAGE_MAX_BYTES:
+            raise ValueError(f"Image trop volumineuse ({int(length)} octets)")
+        ext = image_extension(requests.utils.urlparse(url).path, response.headers.get('Content-Type'))
+        return store_image(response.iter_content(chunk_size=64 * 1024), ext, folder)
+
+
+def rendition_path(folder, filename, width, fmt):
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(folder, 'renditions', f"{stem}-{width}.{fmt}")
+
+
+def make_image_renditions(folder, filename):
+    """Génère les miniatures WebP et JPEG d'une image d'uploads (largeurs IMAGE_WIDTHS)"""
+    os.makedirs(os.path.join(folder, 'renditions'), exist_ok=True)
+    with Image.open(os.path.join(folder, filename)) as original:
+        image = original.convert('RGBA' if original.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    for width in IMAGE_WIDTHS:
+        # Pas d'agrandissement : une image plus étroite est seulement convertie
+        resized = image if image.width <= width else image.resize(
+            (width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        for fmt, pil_format in IMAGE_RENDITION_FORMATS.items():
+            path = rendition_path(folder, filename, width, fmt)
+            if os.path.exists(path):
+                continue
+            out = resized
+            if pil_format == 'JPEG' and out.mode == 'RGBA':
+                out = Image.new('RGB', out.size, (255, 255, 255))
+                out.paste(resized, mask=resized.getchannel('A'))
+            tmp_path = f"{path}.{uuid4().hex[:8]}.tmp"
+            out.save(tmp_path, pil_format, quality=82)
+            os.replace(tmp_path, path)
+
+
+def run_image_renditions(folder, filename):
+    key = (folder, filename)
+    try:
+        make_image_renditions(folder, filename)
+    except Exception as e:
+        app.logger.warning(f"[Image] Miniatures impossibles pour {filename}: {e}")
+        with _renditions_lock:
+            _renditions_failed.add(key)
+    finally:
+        with _renditions_lock:
+            _renditions_pending.discard(key)
+
+
+def schedule_image_renditions(filename, folder=None):
+    """Planifie les miniatures, sauf si elles sont déjà en cours ou ont échoué. Retourne False si impossible."""
+    if Image is None:
+        return False
+    key = (folder or app.config['UPLOAD_FOLDER'], filename)
+    with _renditions_lock:
+        if key in _renditions_failed:
+            return False
+        if key in _renditions_pending:
+            return True
+        _renditions_pending.add(key)
+    _image_executor.submit(run_image_renditions, *key)
+    return True
+
+
+def rendition_width(requested):
+    """Plus petite largeur disponible >= à la largeur demandée (None : l'original)"""
+    for width in IMAGE_WIDTHS:
+        if requested <= width:
+            return width
+    return None
+
+
+# --- Miroir des images du catalogue ---
+# asset_mirror associe chaque URL d'image du CDN MidOcean à sa copie dans uploads.
+# Après chaque rafraîchissement, les URLs nouvelles (ou en échec) sont téléchargées
+# par un pool de MIRROR_WORKERS ; une URL déjà copiée n'est plus jamais retéléchargée.
+# Les PDF de devis utilisent ensuite la copie locale ; les réponses catalogue
+# gardent les URLs du CDN sauf demande explicite du client (wants_local_images).
+
+_mirror_lock = threading.Lock()
+_mirror_rerun = threading.Event()
+
+
+def mirror_url_prefix():
+    return f"{app.config['BASE_URL']}/uploads/"
+
+
+def local_asset_path(conn, url):
+    """Chemin local d'une image (upload ou copie du catalogue), ou None"""
+    if not url:
+        return None
+    for prefix in (mirror_url_prefix(), '/uploads/'):
+        if url.startswith(prefix):
+            path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(url[len(prefix):]))
+            return path if os.path.exists(path) else None
+    row = conn.execute("SELECT filename FROM asset_mirror WHERE url = ? AND status = 'done'", (url,)).fetchone()
+    if row:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
+        return path if os.path.exists(path) else None
+    return None
+
+
+def mirror_download(url, folder):
+    """Worker du pool : (url, fichier, erreur)"""
+    try:
+        return url, download_image(url, folder), None
+    except Exception as e:
+        return url, None, str(e)
+
+
+def record_mirror_results(conn, results):
+    now = datetime.now().isoformat()
+    conn.executemany("""
+        UPDATE asset_mirror SET
+            status = CASE WHEN ? IS NOT NULL THEN 'done' ELSE 'failed' END,
+            filename = COALESCE(?, filename), error = ?, attempts = attempts + 1,
+            mirrored_at = CASE WHEN ? IS NOT NULL THEN ? ELSE mirrored_at END
+        WHERE url = ?
+    """, [(filename, filename, error, filename, now, url) for url, filename, error in results])
+    conn.commit()
+
+
+def mirror_catalog_assets(conn, batch_size=200):
+    """Copie les images du catalogue pas encore en local. Retourne (copiées, en échec)."""
+    c = conn.cursor()
+    c.execute("""
+        INSERT OR IGNORE INTO asset_mirror (url, status)
+        SELECT DISTINCT url, 'pending' FROM catalog_assets
+        WHERE url LIKE 'http%' AND (source = 'printing_positions' OR type = 'image')
+    """)
+    conn.commit()
+    c.execute("SELECT url FROM asset_mirror WHERE status = 'pending' OR (status = 'failed' AND attempts < ?)",
+              (MIRROR_MAX_ATTEMPTS,))
+    urls = [row['url'] for row in c.fetchall()]
+
+    done = failed = 0
+    folder = app.config['UPLOAD_FOLDER']
+    with ThreadPoolExecutor(max_workers=MIRROR_WORKERS, thread_name_prefix='mirror') as pool:
+        results = []
+        # Écritures en base par lots, depuis ce seul thread
+        for result in pool.map(mirror_download, urls, [folder] * len(urls)):
+            results.append(result)
+            if result[1]:
+                done += 1
+            else:
+                failed += 1
+                app.logger.warning(f"[Mirror] {result[0]}: {result[2]}")
+            if len(results) >= batch_size:
+                record_mirror_results(conn, results)
+                results = []
+        if results:
+            record_mirror_results(conn, results)
+    return done, failed
+
+
+def run_asset_mirror():
+    with app.app_context():
+        while True:
+            _mirror_rerun.clear()
+            try:
+                done, failed = mirror_catalog_assets(get_db())
+                if done or failed:
+                    app.logger.info(f"[Mirror] {done} image(s) copiée(s), {failed} en échec")
+            except Exception as e:
+                app.logger.error(f"[Mirror] Erreur: {e}\n{traceback.format_exc()}")
+            if _mirror_rerun.is_set():
+                continue
+            _mirror_lock.release()
+            # Demande arrivée juste avant la libération : son acquire a échoué, elle est reprise ici
+            if not _mirror_rerun.is_set() or not _mirror_lock.acquire(blocking=False):
+                return
+
+
+def schedule_asset_mirror():
+    """Lance la copie des images en tâche de fond (relancée à la fin si déjà en cours)"""
+    if not ASSET_MIRROR:
+        return
+    _mirror_rerun.set()
+    if _mirror_lock.acquire(blocking=False):
+        threading.Thread(target=run_asset_mirror, name='asset-mirror', daemon=True).start()
+
+
+@app.route('/midocean/mirror', methods=['GET'])
+@auth_required
+def get_asset_mirror_status():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) AS count FROM asset_mirror GROUP BY status")
+    counts = {status: 0 for status in ('pending', 'done', 'failed')}
+    counts.update({row['status']: row['count'] for row in c.fetchall()})
+    c.execute("SELECT MAX(mirrored_at) FROM asset_mirror")
+    return jsonify({
+        "enabled": ASSET_MIRROR,
+        "running": _mirror_lock.locked(),
+        "counts": counts,
+        "last_mirrored_at": c.fetchone()[0],
+    })
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # ?w=320 : miniature la plus proche (WebP si le navigateur l'accepte, sinon JPEG)
+    width = request.args.get('w', type=int)
+    if width and width > 0 and Image is not None and rendition_width(width):
+        # WebP seulement si annoncé explicitement (image/* ne garantit pas le support)
+        fmt = 'webp' if any(mime == 'image/webp' and q for mime, q in request.accept_mimetypes) else 'jpg'
+        path = rendition_path(app.config['UPLOAD_FOLDER'], secure_filename(filename), rendition_width(width), fmt)
+        if os.path.exists(path):
+            response = send_from_directory(os.path.dirname(path), os.path.basename(path),
+                                           max_age=IMAGE_CACHE_MAX_AGE)
+            response.cache_control.immutable = True
+            response.vary.add('Accept')
+            return response
+        # Original absent : 404 ci-dessous, sans planifier de miniatures
+        if (os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename)))
+                and schedule_image_renditions(secure_filename(filename))):
+            # Miniature pas encore prête : original, sans cache long, et génération en fond
+            response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=60)
+            response.vary.add('Accept')
+            return response
+
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=IMAGE_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
+def normalize_print_data(print_data):
+    """Complète les positions d'impression (id, nom, points, images), en place"""
+    if isinstance(print_data, dict) and 'printing_positions' in print_data:
+        for pos in print_data['printing_positions']:
+            if isinstance(pos, dict):
+                pos['position_id'] = pos.get('position_id', str(uuid4()))
+                pos['position_name'] = pos.get('position_name', 'Position inconnue')
+                pos['points'] = pos.get('points', [])
+                pos['images'] = pos.get('images', [])
 
 
 @products_bp.route('/products', methods=['POST'])
@@ -1048,6 +3218,14 @@ def create_product():
         if not name or not price:
             return jsonify({'error': 'Le nom et le prix sont obligatoires'}), 400
 
+        # Produit du catalogue déjà importé : mis à jour au lieu d'être dupliqué
+        master_code = request.form.get('master_code') or None
+        existing_id = None
+        if master_code:
+            conn = get_db()
+            row = conn.execute("SELECT id FROM products WHERE master_code = ?", (master_code,)).fetchone()
+            existing_id = row['id'] if row else None
+
         product_data = {
             'name': name,
             'price': float(price),
@@ -1062,60 +3240,31 @@ def create_product():
         # Image uploadée
         if 'image' in request.files and request.files['image'].filename:
             image_file = request.files['image']
-            filename = secure_filename(f"{uuid4().hex}_{image_file.filename}")
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            image_file.save(image_path)
-            product_data['image'] = filename
-
-        # Image depuis URL
-        elif request.form.get('image_url'):
             try:
-                image_url = request.form['image_url']
-                response = requests.get(image_url, timeout=10)
-                response.raise_for_status()
-                ext = os.path.splitext(image_url)[1] or '.jpg'
-                filename = secure_filename(f"{uuid4().hex}{ext}")
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                product_data['image'] = filename
+                product_data['image'] = store_image(
+                    iter(lambda: image_file.stream.read(64 * 1024), b''),
+                    image_extension(image_file.filename, image_file.mimetype))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 413
+
+        # Image depuis URL (pas retéléchargée pour un produit existant : son image est conservée)
+        elif request.form.get('image_url') and existing_id is None:
+            try:
+                product_data['image'] = download_image(request.form['image_url'])
             except Exception as e:
                 app.logger.error(f"[Image] Erreur téléchargement image depuis URL: {e}")
 
-        # Champs JSON
-        json_fields = ['colors_json', 'images_json', 'images_by_color_json', 'print_data_json']
-        for field in json_fields:
-            raw = request.form.get(field)
-            if raw:
-                try:
-                    product_data[field] = json.loads(raw)
-                except json.JSONDecodeError:
-                    app.logger.warning(f"[JSON] Erreur décodage {field}")
-                    product_data[field] = [] if 'json' in field else {}
-            else:
-                product_data[field] = [] if 'json' in field else {}
-
-        # Normalisation des positions d'impression
-        print_data = product_data['print_data_json']
-        if isinstance(print_data, dict) and 'printing_positions' in print_data:
-            for pos in print_data['printing_positions']:
-                if isinstance(pos, dict):
-                    pos['position_id'] = pos.get('position_id', str(uuid4()))
-                    pos['position_name'] = pos.get('position_name', 'Position inconnue')
-                    pos['points'] = pos.get('points', [])
-                    pos['images'] = pos.get('images', [])
-
-        # Insertion en base
+        # Champs JSON : validés ici une fois pour toutes, les lectures recopient le texte stocké
+        try:
+            for field in PRODUCT_JSON_FIELDS:
+                product_data[field] = parse_product_json_field(field, request.form.get(field) or None)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Insertion ou mise à jour en base
         conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO products (
-                name, price, image, description,
-                category_level1, category_level2, category_level3,
-                stock, colors_json, images_json,
-                images_by_color_json, print_data_json
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        [(status, product_id)] = upsert_products(conn, [(
+            master_code,
             product_data['name'],
             product_data['price'],
             product_data['image'],
@@ -1124,20 +3273,22 @@ def create_product():
             product_data['category_level2'],
             product_data['category_level3'],
             product_data['stock'],
-            json.dumps(product_data['colors_json']),
-            json.dumps(product_data['images_json']),
-            json.dumps(product_data['images_by_color_json']),
-            json.dumps(product_data['print_data_json']),
-        ))
+            json_dumps(product_data['colors_json']),
+            json_dumps(product_data['images_json']),
+            json_dumps(product_data['images_by_color_json']),
+            json_dumps(product_data['print_data_json']),
+        )])
         conn.commit()
-        product_id = cursor.lastrowid
         conn.close()
+        if status != 'unchanged':
+            schedule_similarity_refresh([product_id])
 
         return jsonify({
-            'message': 'Produit créé avec succès',
+            'message': PRODUCT_UPSERT_MESSAGES[status],
             'product_id': product_id,
+            'status': status,
             'print_data': product_data['print_data_json']
-        }), 201
+        }), 201 if status == 'created' else 200
 
     except ValueError as e:
         return jsonify({'error': f'Donnée invalide: {str(e)}'}), 400
@@ -1146,8 +3297,329 @@ def create_product():
         traceback.print_exc()
         return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
     
+
+PRODUCTS_BULK_MAX = int(os.getenv("PRODUCTS_BULK_MAX", 5000))
+PRODUCT_TEXT_FIELDS = ('description', 'category_level1', 'category_level2', 'category_level3')
+
+
+def parse_product_json_field(field, value):
+    """Valeur d'un champ *_json (texte JSON ou valeur décodée) -> liste/objet du bon type.
+
+    None donne la valeur par défaut du champ. Lève ValueError si le JSON ou le type est invalide.
+    """
+    default = PRODUCT_JSON_FIELDS[field]
+    if isinstance(value, str):
+        try:
+            value = json_loads(value)
+        except ValueError:
+            raise ValueError(f"{field} n'est pas du JSON valide")
+    if value is None:
+        value = default()
+    if not isinstance(value, default):
+        raise ValueError(f"{field} doit être de type {'liste' if default is list else 'objet'}")
+    if field == 'print_data_json':
+        normalize_print_data(value)
+    return value
+
+
+def prepare_bulk_product(item):
+    """Objet JSON reçu par /products/bulk -> valeurs de l'INSERT products.
+
+    Mêmes champs que le formulaire de create_product ; image est une URL ou un nom
+    de fichier déjà présent dans uploads (pas de téléchargement). Les champs *_json
+    acceptent du texte JSON ou la valeur décodée. Lève ValueError si l'objet est invalide.
+    Les valeurs suivent l'ordre de PRODUCT_WRITE_COLUMNS.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("un produit doit être un objet JSON")
+    name = item.get('name')
+    if not name or not isinstance(name, str) or item.get('price') in (None, ''):
+        raise ValueError("le nom et le prix sont obligatoires")
+    try:
+        price = float(item['price'])
+        stock = int(item.get('stock') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("prix ou stock invalide")
+
+    master_code = item.get('master_code') or None
+    if master_code is not None and not isinstance(master_code, str):
+        raise ValueError("master_code doit être une chaîne")
+
+    values = [master_code, name, price, item.get('image') or None]
+    values += [str(item.get(field) or '') for field in PRODUCT_TEXT_FIELDS]
+    values.append(stock)
+    for field in PRODUCT_JSON_FIELDS:
+        values.append(json_dumps(parse_product_json_field(field, item.get(field))))
+    return tuple(values)
+
+
+def iter_bulk_items():
+    """(index, produit ou exception) depuis un tableau JSON ou un flux NDJSON"""
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        index = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield index, json_loads(line)
+            except ValueError:
+                yield index, ValueError("ligne NDJSON invalide")
+            index += 1
+        return
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise ValueError("le corps doit être un tableau JSON ou un flux NDJSON")
+    yield from enumerate(items)
+
+
+PRODUCT_WRITE_COLUMNS = (
+    'master_code', 'name', 'price', 'image', 'description',
+    'category_level1', 'category_level2', 'category_level3',
+    'stock', 'colors_json', 'images_json', 'images_by_color_json', 'print_data_json',
+)
+PRODUCT_UPSERT_MESSAGES = {
+    'created': 'Produit créé avec succès',
+    'updated': 'Produit mis à jour',
+    'unchanged': 'Produit déjà à jour',
+}
+
+
+def product_row_changed(stored, row):
+    """Compare une ligne entrante (ordre PRODUCT_WRITE_COLUMNS) au produit stocké.
+
+    Les colonnes JSON sont comparées décodées (le texte dépend du sérialiseur) ;
+    une image absente conserve celle du produit.
+    """
+    for column, value in zip(PRODUCT_WRITE_COLUMNS, row):
+        if column == 'image' and value is None:
+            continue
+        if column in PRODUCT_JSON_FIELDS:
+            try:
+                if json_loads(stored[column]) == json_loads(value):
+                    continue
+            except (TypeError, ValueError):
+                pass
+            return True
+        if stored[column] != value:
+            return True
+    return False
+
+
+def upsert_products(conn, rows):
+    """Écrit des lignes (ordre PRODUCT_WRITE_COLUMNS), une transaction pour tout le lot. Ne commit pas.
+
+    Une ligne dont le master_code existe déjà met à jour ce produit, et seulement
+    si une valeur a changé : une resynchronisation complète ne réécrit que les
+    produits modifiés. Les master_codes doivent être uniques dans le lot.
+    Retourne [(statut, id)] dans l'ordre des lignes, statut 'created', 'updated' ou 'unchanged'.
+    """
+    c = conn.cursor()
+    # Verrou d'écriture pris d'emblée : les ids AUTOINCREMENT du lot se suivent
+    c.execute("BEGIN IMMEDIATE")
+
+    codes = [row[0] for row in rows if row[0] is not None]
+    stored = {}
+    for i in range(0, len(codes), 500):
+        chunk = codes[i:i + 500]
+        c.execute(f"SELECT id, {', '.join(PRODUCT_WRITE_COLUMNS)} FROM products "
+                  f"WHERE master_code IN ({', '.join('?' * len(chunk))})", chunk)
+        stored.update((product['master_code'], product) for product in c.fetchall())
+
+    results, inserts, updates = [], [], []
+    for row in rows:
+        product = stored.get(row[0]) if row[0] is not None else None
+        if product is None:
+            results.append(['created', None])
+            inserts.append(row)
+        elif product_row_changed(product, row):
+            results.append(['updated', product['id']])
+            updates.append(row[1:] + (product['id'],))
+        else:
+            results.append(['unchanged', product['id']])
+
+    if updates:
+        c.executemany(f"""
+            UPDATE products SET {', '.join(
+                'image = COALESCE(?, image)' if column == 'image' else f'{column} = ?'
+                for column in PRODUCT_WRITE_COLUMNS[1:])}
+            WHERE id = ?
+        """, updates)
+    if inserts:
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM products")
+        last_id = c.fetchone()[0]
+        c.executemany(f"""
+            INSERT INTO products ({', '.join(PRODUCT_WRITE_COLUMNS)})
+            VALUES ({', '.join('?' * len(PRODUCT_WRITE_COLUMNS))})
+        """, inserts)
+        c.execute("SELECT id FROM products WHERE id > ? ORDER BY id", (last_id,))
+        new_ids = iter(row['id'] for row in c.fetchall())
+        for result in results:
+            if result[1] is None:
+                result[1] = next(new_ids)
+    return [tuple(result) for result in results]
+
+
+@products_bp.route('/products/bulk', methods=['POST'])
+@auth_required
+def create_products_bulk():
+    rows, indexes, errors = [], [], []
+    codes = set()
+    try:
+        for index, item in iter_bulk_items():
+            if index >= PRODUCTS_BULK_MAX:
+                return jsonify({'error': f'Maximum {PRODUCTS_BULK_MAX} produits par requête'}), 413
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                row = prepare_bulk_product(item)
+                if row[0] is not None and row[0] in codes:
+                    raise ValueError(f"master_code {row[0]} en double dans le lot")
+                codes.add(row[0])
+                rows.append(row)
+                indexes.append(index)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not rows:
+        return jsonify({'created': 0, 'updated': 0, 'unchanged': 0, 'items': [], 'errors': errors}), 400
+
+    conn = get_db()
+    try:
+        results = upsert_products(conn, rows)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"[Bulk] Erreur insertion de {len(rows)} produits: {e}")
+        return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
+    finally:
+        conn.close()
+
+    counts = Counter(status for status, _ in results)
+    changed = [product_id for status, product_id in results if status != 'unchanged']
+    if changed:
+        schedule_similarity_refresh(changed)
+    return jsonify({
+        'created': counts['created'],
+        'updated': counts['updated'],
+        'unchanged': counts['unchanged'],
+        'items': [{'index': index, 'id': product_id, 'status': status}
+                  for index, (status, product_id) in zip(indexes, results)],
+        'errors': errors
+    }), 201 if counts['created'] else 200
+
+
 app.register_blueprint(products_bp)
 
+
+# --- Import du catalogue MidOcean dans les produits locaux ---
+
+def catalog_shop_product(product, print_data, markup):
+    """Produit catalogue (format /products/images/full) -> champs de products.
+
+    Même correspondance que « Ajouter au catalogue » du CRM : couleurs et images
+    par couleur tirées des variants, données d'impression de l'index printdata.
+    """
+    variants = product.get('variants') or []
+    colors = list(dict.fromkeys(v['color'] for v in variants if v.get('color')))
+    images_by_color = {}
+    for variant in variants:
+        urls = [image['url'] for image in variant.get('images', []) if image.get('url')]
+        if variant.get('color') and variant['color'].strip() and urls:
+            images_by_color[variant['color'].strip()] = urls
+    images = list(dict.fromkeys(url for urls in images_by_color.values() for url in urls))
+
+    if print_data:
+        print_data = dict(print_data, printing_positions=[
+            dict(position, mockup_image=images[0] if images else None, images=position.get('images') or [])
+            for position in print_data.get('printing_positions', [])
+        ])
+
+    return {
+        'master_code': product.get('master_code'),
+        'name': product.get('product_name') or "Produit sans nom",
+        'price': (product.get('price') or 0) * markup,
+        'description': product.get('long_description') or product.get('short_description') or '',
+        'category_level1': product.get('category_level1') or "Non spécifié",
+        'category_level2': product.get('category_level2') or '',
+        'category_level3': product.get('category_level3') or '',
+        'stock': product.get('stock') or 0,
+        'colors_json': colors,
+        'images_json': images,
+        'images_by_color_json': images_by_color,
+        'print_data_json': print_data or {},
+    }
+
+
+catalog_cli = AppGroup('catalog', help="Catalogue MidOcean")
+
+
+@catalog_cli.command('import')
+@click.option('--refs', 'refs_file', type=click.File(encoding='utf-8'), default=None,
+              help="Fichier de master_codes, un par ligne (par défaut : tout le catalogue)")
+@click.option('--markup', type=float, default=2.0, show_default=True, help="Coefficient appliqué au prix d'achat")
+@click.option('--dry-run', is_flag=True, help="Affiche ce qui serait importé sans rien écrire")
+def catalog_import_command(refs_file, markup, dry_run):
+    """Importe des produits du catalogue MidOcean dans products, sans passer par l'API HTTP.
+
+    Les produits déjà importés (même master_code) ne sont réécrits que s'ils ont changé.
+    """
+    refs = None
+    if refs_file is not None:
+        refs = {line.strip() for line in refs_file if line.strip() and not line.startswith('#')}
+
+    conn = get_db()
+    ensure_catalog(conn)
+    ensure_printdata_index(conn)
+    c = conn.cursor()
+    # La boutique référence les images du CDN, pas les copies locales de ce serveur
+    products = [product for product in load_catalog_products(c)
+                if refs is None or product['master_code'] in refs]
+    print_data = load_print_data(c, [product['master_code'] for product in products])
+
+    rows = []
+    for product in products:
+        try:
+            rows.append(prepare_bulk_product(
+                catalog_shop_product(product, print_data.get(product['master_code']), markup)))
+        except ValueError as e:
+            click.echo(f"❌ {product['master_code']} : {e}")
+
+    if refs is not None:
+        missing = refs - {product['master_code'] for product in products}
+        if missing:
+            click.echo(f"{len(missing)} référence(s) absente(s) du catalogue : {', '.join(sorted(missing))}")
+    if dry_run:
+        click.echo(f"[dry-run] {len(rows)} produit(s) seraient importés")
+        conn.close()
+        return
+
+    results = upsert_products(conn, rows)
+    refresh_product_similarities(c, [product_id for status, product_id in results if status != 'unchanged'])
+    conn.commit()
+    conn.close()
+    counts = Counter(status for status, _ in results)
+    click.echo(f"{counts['created']} produit(s) créé(s), {counts['updated']} mis à jour, "
+               f"{counts['unchanged']} inchangé(s)")
+
+
+@catalog_cli.command('mirror')
+@click.option('--retry-failed', is_flag=True, help="Réessayer aussi les images en échec définitif")
+def catalog_mirror_command(retry_failed):
+    """Copie en local les images du catalogue pas encore téléchargées."""
+    conn = get_db()
+    ensure_catalog(conn)
+    if retry_failed:
+        conn.execute("UPDATE asset_mirror SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+        conn.commit()
+    done, failed = mirror_catalog_assets(conn)
+    click.echo(f"{done} image(s) copiée(s), {failed} en échec")
+
+
+app.cli.add_command(catalog_cli)
+
 # --- Routes pour les devis ---
 
 # Configuration SMTP
@@ -1162,173 +3634,801 @@ app.config['BASE_URL'] = 'http://localhost:5001'  # À adapter en production
 
 mail = Mail(app)
 
-def generate_pdf(devis_data):
-    """Génère un PDF professionnel pour le devis"""
-    if not os.path.exists(app.config['PDF_FOLDER']):
-        os.makedirs(app.config['PDF_FOLDER'])
-    
-    pdf_filename = f"devis-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.pdf"
-    pdf_path = os.path.join(app.config['PDF_FOLDER'], pdf_filename)
-    
-    # HTML template pour le PDF
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>Devis {devis_data['devis_id']}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; color: #333; }}
-            .header {{ border-bottom: 2px solid #0066cc; padding-bottom: 10px; margin-bottom: 20px; }}
-            .info-section {{ margin-bottom: 30px; }}
-            .product-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-            .product-table th, .product-table td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-            .product-table th {{ background-color: #f2f2f2; }}
-            .total-section {{ margin-top: 30px; text-align: right; }}
-            .signature {{ margin-top: 50px; border-top: 1px dashed #999; padding-top: 20px; }}
-            .product-image {{ max-width: 200px; max-height: 200px; margin: 10px 0; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>{devis_data['companyInfo']['companyName']} - Devis personnalisé</h1>
-            <p>Offre n°{devis_data['devis_id']} réalisée à Paris le {datetime.now().strftime('%d/%m/%Y')}</p>
-            <p>Date de fin de validité : {(datetime.now() + timedelta(days=60)).strftime('%d/%m/%Y')}</p>
-            <p>Votre référence client : {devis_data.get('client_reference', 'N/A')}</p>
-        </div>
-
-        <div class="info-section">
-            <h2>{devis_data['companyInfo']['companyName']}</h2>
-            <p>{devis_data['companyInfo']['billingAddress']}</p>
-        </div>
-
-        <div class="info-section">
-            <h3>{devis_data['companyInfo']['firstName']} {devis_data['companyInfo']['lastName']}</h3>
-            <p>{devis_data['companyInfo']['email']}</p>
-            <p>{devis_data['companyInfo']['phone']}</p>
-        </div>
-
-        <h2>{devis_data['product']['quantity']} | {devis_data['product']['name'].upper()}</h2>
-
-        <table class="product-table">
-            <tr>
-                <th>Description</th>
-                <th>Quantité (Prix Unitaire HT)</th>
-                <th>Total HT</th>
-            </tr>
-            <tr>
-                <td>
-                    {devis_data['product']['name']}<br>
-                    {devis_data['product']['description']}
-                </td>
-                <td>{devis_data['product']['quantity']} pièces ({devis_data['product']['price']} € P.U.)</td>
-                <td>{devis_data['total']} €</td>
-            </tr>
-        </table>
-
-        {f'<img src="{devis_data["product"]["image"]}" class="product-image" alt="Image produit">' if devis_data['product'].get('image') else ''}
-
-        <div class="info-section">
-            <h3>CARACTÉRISTIQUES PRODUIT</h3>
-            <p>Couleur : {devis_data['product'].get('color', 'Non spécifié')}</p>
-            <p><strong>PERSONNALISATION</strong></p>
-            <p>Marquage sérigraphie 1 couleur</p>
-            <p>Position de marquage : centré</p>
-            <p>Frais techniques inclus</p>
-        </div>
-
-        <div class="total-section">
-            <h3>Sous-total hors taxe</h3>
-            <p>TVA 20.0% : {float(devis_data['total']) * 0.2} €</p>
-            <h2>Total TTC : {float(devis_data['total']) * 1.2} €</h2>
-        </div>
-
-        <div class="signature">
-            <p>Avant de signer ce devis, vous devez recevoir un e-mail pour confirmer votre identité.</p>
-            <p>{devis_data['companyInfo']['firstName']} {devis_data['companyInfo']['lastName']} ({devis_data['companyInfo']['email']})</p>
-            <p>Vérifier pour signer</p>
-        </div>
-
-        <div class="info-section">
-            <h3>Conditions d'achat</h3>
-            <p>Règlement : 100% à la commande (Paiement comptant)</p>
-            <p>Paiement par chèque ou virement</p>
-        </div>
-
-        <div class="info-section">
-            <h3>Besoin d'informations complémentaires ?</h3>
-            <p>Notre équipe vous répond directement :</p>
-            <p>+33 2 40 48 83 22</p>
-            <p>contact@midocean.com</p>
-        </div>
-    </body>
-    </html>
+# Les PDF sont nommés par l'empreinte du HTML rendu : une demande identique
+# réutilise le fichier existant au lieu de relancer wkhtmltopdf.
+
+DEVIS_VALIDITY_DAYS = 60
+_pdf_cleanup_lock = threading.Lock()
+_pdf_cleanup_last = 0.0
+
+
+def devis_reference(data, issued_at):
+    """Numéro de devis stable : date du jour + empreinte des données saisies"""
+    inputs = {key: data.get(key) for key in ('product', 'companyInfo', 'client_reference', 'total')}
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f"DEV-{issued_at.strftime('%Y%m%d')}-{digest[:8].upper()}"
+
+
+def render_devis_html(devis_data, image_src=None):
+    """HTML du devis (templates/devis.html, compilé une fois par Jinja)
+
+    image_src remplace l'URL de l'image produit (copie locale pour wkhtmltopdf).
     """
-    
-    # Génération du PDF
-    pdfkit.from_string(html_content, pdf_path)
-    
+    issued_at = datetime.fromisoformat(devis_data['issued_at'])
+    return render_template(
+        'devis.html',
+        devis=devis_data,
+        image_src=image_src or devis_data['product'].get('image'),
+        issued_at=issued_at,
+        valid_until=issued_at + timedelta(days=DEVIS_VALIDITY_DAYS),
+        tva=float(devis_data['total']) * 0.2,
+        total_ttc=float(devis_data['total']) * 1.2,
+    )
+
+
+def devis_pdf_filename(html):
+    return f"devis-{hashlib.sha256(html.encode('utf-8')).hexdigest()[:32]}.pdf"
+
+
+def devis_pdf_url(pdf_filename):
     return f"{app.config['BASE_URL']}/{app.config['PDF_FOLDER']}/{pdf_filename}"
 
-@app.route('/api/devis', methods=['POST'])
-def create_devis():
+
+def prepare_pdf(devis_data):
+    """(nom du PDF, chemin, HTML à rendre, options wkhtmltopdf) ; HTML None si le PDF existe déjà"""
+    folder = app.config['PDF_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+
+    html_content = render_devis_html(devis_data)
+    pdf_filename = devis_pdf_filename(html_content)
+    pdf_path = os.path.join(folder, pdf_filename)
+
+    if os.path.exists(pdf_path):
+        # Date d'accès utilisée par le nettoyage : un PDF réutilisé reste en cache
+        os.utime(pdf_path)
+        return pdf_filename, pdf_path, None, None
+
+    # Image produit lue sur disque : copiée une fois si le miroir ne l'a pas encore
+    # (le nom du PDF reste l'empreinte du HTML avec l'URL d'origine)
+    options = None
+    image_path = devis_image_path(devis_data['product'].get('image'))
+    if image_path:
+        html_content = render_devis_html(devis_data, image_src=f"file://{os.path.abspath(image_path)}")
+        options = {'enable-local-file-access': None}
+    return pdf_filename, pdf_path, html_content, options
+
+
+def write_pdf(pdf_path, render):
+    """Fichier temporaire puis renommage : un autre worker ne lit jamais un PDF incomplet"""
+    tmp_path = f"{pdf_path}.{uuid4().hex[:8]}.tmp"
+    try:
+        render(tmp_path)
+        os.replace(tmp_path, pdf_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generate_pdf(devis_data):
+    """Génère (ou réutilise) le PDF du devis. Retourne (url, True si le PDF existait déjà)."""
+    pdf_filename, pdf_path, html_content, options = prepare_pdf(devis_data)
+    if html_content is not None:
+        write_pdf(pdf_path, lambda tmp_path: pdfkit.from_string(html_content, tmp_path, options=options))
+    return devis_pdf_url(pdf_filename), html_content is None
+
+
+def render_pdf_batch(documents):
+    """Rend {chemin du PDF: HTML} en un seul processus wkhtmltopdf, puis découpe le résultat.
+
+    Chaque devis commence par son unique <h1> : avec --outline-depth 1, le signet
+    de premier niveau n°i pointe sur la première page du devis i.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sources = []
+        for index, html_content in enumerate(documents.values()):
+            source = os.path.join(tmp_dir, f"{index:04d}.html")
+            with open(source, 'w', encoding='utf-8') as f:
+                f.write(html_content)
+            sources.append(source)
+        combined = os.path.join(tmp_dir, 'campagne.pdf')
+        pdfkit.from_file(sources, combined, options={
+            'enable-local-file-access': None, 'outline': None, 'outline-depth': 1})
+
+        reader = PdfReader(combined)
+        starts = [reader.get_destination_page_number(item) for item in reader.outline if not isinstance(item, list)]
+        if len(starts) != len(documents) or starts[0] != 0 or starts != sorted(set(starts)):
+            raise ValueError(f"Découpage impossible : {len(starts)} signets pour {len(documents)} devis")
+        bounds = starts + [len(reader.pages)]
+        for pdf_path, first, last in zip(documents, bounds, bounds[1:]):
+            writer = PdfWriter()
+            for page in reader.pages[first:last]:
+                writer.add_page(page)
+            write_pdf(pdf_path, writer.write)
+
+
+def generate_pdfs(datas):
+    """Génère les PDF de plusieurs devis, avec un seul wkhtmltopdf pour ceux à rendre.
+
+    Retourne, dans l'ordre, (url, True si le PDF existait déjà) ou l'exception du devis.
+    """
+    results, documents, options = [], {}, {}
+    for devis_data in datas:
+        try:
+            pdf_filename, pdf_path, html_content, pdf_options = prepare_pdf(devis_data)
+        except Exception as e:
+            results.append(e)
+            continue
+        results.append((pdf_filename, pdf_path, html_content is None))
+        if html_content is not None:
+            documents.setdefault(pdf_path, html_content)
+            options[pdf_path] = pdf_options
+
+    if len(documents) > 1 and PdfReader is not None:
+        try:
+            render_pdf_batch(documents)
+        except Exception as e:
+            app.logger.warning(f"[Devis] Rendu groupé impossible, un wkhtmltopdf par devis : {e}")
+
+    # Repli (ou devis seul) : un rendu par PDF encore absent
+    failures = {}
+    for pdf_path, html_content in documents.items():
+        if os.path.exists(pdf_path):
+            continue
+        try:
+            write_pdf(pdf_path, lambda tmp_path: pdfkit.from_string(html_content, tmp_path,
+                                                                     options=options[pdf_path]))
+        except Exception as e:
+            failures[pdf_path] = e
+
+    return [result if isinstance(result, Exception) else
+            failures.get(result[1]) or (devis_pdf_url(result[0]), result[2])
+            for result in results]
+
+
+def devis_image_path(url):
+    """Copie locale de l'image d'un devis ; téléchargée et ajoutée au miroir si besoin.
+
+    Seules les URLs des hôtes MIRROR_ALLOWED_HOSTS sont téléchargées : pour les autres,
+    None et le PDF garde l'URL d'origine.
+    """
+    if not url:
+        return None
+    conn = get_db()
+    path = local_asset_path(conn, url)
+    if path or not ASSET_MIRROR:
+        return path
+    parsed = requests.utils.urlparse(url)
+    if parsed.scheme != 'https' or (parsed.hostname or '').lower() not in MIRROR_ALLOWED_HOSTS:
+        return None
+    url, filename, error = mirror_download(url, app.config['UPLOAD_FOLDER'])
+    if error:
+        app.logger.warning(f"[Devis] Image non copiée {url}: {error}")
+        return None
+    conn.execute("INSERT OR IGNORE INTO asset_mirror (url, status) VALUES (?, 'pending')", (url,))
+    record_mirror_results(conn, [(url, filename, None)])
+    return os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def cleanup_pdf_cache(folder=None, ttl_days=None, max_mb=None):
+    """Supprime les PDF non utilisés depuis ttl_days, puis les plus anciens au-delà de max_mb.
+
+    Retourne (fichiers supprimés, octets restants).
+    """
+    folder = folder or app.config['PDF_FOLDER']
+    ttl_days = PDF_CACHE_TTL_DAYS if ttl_days is None else ttl_days
+    max_bytes = (PDF_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+    if not os.path.isdir(folder):
+        return 0, 0
+
+    files = []
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.endswith('.pdf'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    cutoff = time.time() - ttl_days * 86400
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for mtime, size, path in files:
+        if mtime >= cutoff and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    return deleted, total
+
+
+def maybe_cleanup_pdf_cache():
+    global _pdf_cleanup_last
+    with _pdf_cleanup_lock:
+        if time.time() - _pdf_cleanup_last < PDF_CACHE_CLEANUP_INTERVAL:
+            return
+        _pdf_cleanup_last = time.time()
+    deleted, _ = cleanup_pdf_cache()
+    if deleted:
+        app.logger.info(f"[Devis] {deleted} PDF supprimé(s) du cache")
+
+
+def devis_email(data, pdf_url):
+    return Message(
+        subject=f"Devis {data['devis_id']} - {data['product']['name']}",
+        recipients=[data['companyInfo']['email']],
+        html=f"""
+        <h2>Votre devis MIDOCEAN</h2>
+        <p><strong>Référence:</strong> {data['devis_id']}</p>
+        <p><strong>Client:</strong> {data['companyInfo']['companyName']}</p>
+        <p><strong>Contact:</strong> {data['companyInfo']['firstName']} {data['companyInfo']['lastName']}</p>
+        <hr>
+        <h3>Détails du produit</h3>
+        <p><strong>Produit:</strong> {data['product']['name']}</p>
+        <p><strong>Référence:</strong> {data['product'].get('reference', 'N/A')}</p>
+        <p><strong>Quantité:</strong> {data['product']['quantity']}</p>
+        <p><strong>Prix unitaire:</strong> {data['product']['price']} €</p>
+        <p><strong>Total HT:</strong> {data['total']} €</p>
+        <p><strong>Total TTC:</strong> {float(data['total']) * 1.2} €</p>
+        <hr>
+        <p>Téléchargez votre devis complet au format PDF : <a href="{pdf_url}">Télécharger le devis</a></p>
+        <p>Vous pouvez aussi <a href="{pdf_url}">imprimer cette offre</a></p>
+        <hr>
+        <p>Besoin d'informations complémentaires ? Contactez-nous au +33 2 40 48 83 22</p>
+        """
+    )
+
+
+# --- File d'envoi des e-mails ---
+# Les e-mails sont enregistrés dans mail_outbox (même transaction que le devis) ;
+# un thread unique les envoie par lots de MAIL_BATCH_SIZE sur une seule connexion
+# SMTP (mail.connect()). En cas d'échec, nouvel essai avec délai croissant, puis
+# 'failed' après MAIL_MAX_ATTEMPTS tentatives.
+
+_mail_wakeup = threading.Event()
+_mail_sender = None
+_mail_sender_lock = threading.Lock()
+
+
+def enqueue_mail(conn, msg, devis_job_id=None):
+    """Ajoute un Message à la file d'envoi (validé par le commit de l'appelant)"""
+    now = datetime.now().isoformat()
+    conn.execute("""
+        INSERT INTO mail_outbox (devis_job_id, recipients, subject, html, status, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, 'pending', ?, ?)
+    """, (devis_job_id, json_dumps(msg.recipients), msg.subject, msg.html, now, now))
+
+
+def mail_retry_at(attempts):
+    return (datetime.now() + timedelta(seconds=MAIL_RETRY_SECONDS * 2 ** (attempts - 1))).isoformat()
+
+
+def mail_sent(c, row, error=None):
+    """Enregistre le résultat d'un envoi ; error=None : envoyé"""
+    now = datetime.now().isoformat()
+    attempts = row['attempts'] + 1
+    if error is None:
+        status, email_status = 'sent', 'sent'
+    elif attempts >= MAIL_MAX_ATTEMPTS:
+        status, email_status = 'failed', 'failed'
+    else:
+        status, email_status = 'pending', None
+    c.execute("""
+        UPDATE mail_outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?, sent_at = ?
+        WHERE id = ?
+    """, (status, attempts, error, mail_retry_at(attempts) if status == 'pending' else now,
+          now if status == 'sent' else None, row['id']))
+    if row['devis_job_id'] and email_status:
+        c.execute("UPDATE devis_jobs SET email_status = ?, error = COALESCE(?, error) WHERE id = ?",
+                  (email_status, error, row['devis_job_id']))
+
+
+def send_mail_batch(conn, limit=None):
+    """Envoie un lot d'e-mails dus sur une connexion SMTP. Retourne (envoyés, en échec)."""
+    c = conn.cursor()
+    now = datetime.now()
+    # Messages dus, ou pris par un expéditeur dont le bail a expiré (processus arrêté)
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("""
+        SELECT * FROM mail_outbox
+        WHERE (status = 'pending' AND next_attempt_at <= ?)
+           OR (status = 'sending' AND (lease_until IS NULL OR lease_until < ?))
+        ORDER BY next_attempt_at, id LIMIT ?
+    """, (now.isoformat(), now.isoformat(), limit or MAIL_BATCH_SIZE))
+    rows = c.fetchall()
+    lease_until = (now + timedelta(seconds=MAIL_LEASE_SECONDS)).isoformat()
+    c.executemany("UPDATE mail_outbox SET status = 'sending', lease_until = ? WHERE id = ?",
+                  [(lease_until, row['id']) for row in rows])
+    conn.commit()
+    if not rows:
+        return 0, 0
+
+    sent = failed = 0
+    try:
+        with mail.connect() as smtp:
+            for row in rows:
+                msg = Message(subject=row['subject'], recipients=json_loads(row['recipients']), html=row['html'])
+                try:
+                    smtp.send(msg)
+                except smtplib.SMTPServerDisconnected:
+                    raise
+                except Exception as e:
+                    app.logger.error(f"[Mail] Erreur envoi #{row['id']}: {e}")
+                    mail_sent(c, row, str(e))
+                    failed += 1
+                else:
+                    mail_sent(c, row)
+                    sent += 1
+                conn.commit()
+    except smtplib.SMTPServerDisconnected as e:
+        # Session coupée en cours de lot : le reste est replanifié sans compter de tentative
+        app.logger.error(f"[Mail] Connexion SMTP perdue: {e}")
+        ids = [row['id'] for row in rows]
+        c.execute("""
+            UPDATE mail_outbox SET status = 'pending', lease_until = NULL, next_attempt_at = ?
+            WHERE status = 'sending' AND id IN (%s)
+        """ % ",".join("?" * len(ids)), [mail_retry_at(1)] + ids)
+        failed += c.rowcount
+        conn.commit()
+    except Exception as e:
+        # Connexion SMTP impossible : le lot est replanifié
+        app.logger.error(f"[Mail] Erreur SMTP: {e}")
+        c.execute("SELECT * FROM mail_outbox WHERE status = 'sending' AND id IN (%s)"
+                  % ",".join("?" * len(rows)), [row['id'] for row in rows])
+        for row in c.fetchall():
+            mail_sent(c, row, str(e))
+            failed += 1
+        conn.commit()
+    return sent, failed
+
+
+def drain_mail_outbox():
+    """Envoie les e-mails dus, lot par lot, jusqu'à ce que la file soit vide ou en erreur"""
+    with app.app_context():
+        conn = get_db()
+        while True:
+            sent, failed = send_mail_batch(conn)
+            if failed or sent < MAIL_BATCH_SIZE:
+                return
+
+
+def mail_sender_loop():
+    while True:
+        _mail_wakeup.wait(MAIL_POLL_SECONDS)
+        _mail_wakeup.clear()
+        try:
+            drain_mail_outbox()
+            # Même passage périodique : devis d'un processus arrêté (bail expiré)
+            with app.app_context():
+                reclaim_devis_jobs(get_db())
+        except Exception as e:
+            app.logger.error(f"[Mail] Erreur file d'envoi: {e}\n{traceback.format_exc()}")
+
+
+def wake_mail_sender():
+    """Démarre au besoin le thread d'envoi et le réveille"""
+    global _mail_sender
+    with _mail_sender_lock:
+        if _mail_sender is None:
+            _mail_sender = threading.Thread(target=mail_sender_loop, name='mail-outbox', daemon=True)
+            _mail_sender.start()
+    _mail_wakeup.set()
+
+
+def mail_outbox_json(conn):
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) AS count FROM mail_outbox GROUP BY status")
+    counts = {status: 0 for status in ('pending', 'sending', 'sent', 'failed')}
+    counts.update({row['status']: row['count'] for row in c.fetchall()})
+    c.execute("SELECT MIN(created_at) AS oldest, MIN(next_attempt_at) AS next FROM mail_outbox WHERE status = 'pending'")
+    row = c.fetchone()
+    return {
+        "depth": counts['pending'] + counts['sending'],
+        "counts": counts,
+        "oldest_pending": row['oldest'],
+        "next_attempt_at": row['next'],
+    }
+
+
+# --- File des devis ---
+# POST /api/devis enregistre la demande (devis_jobs) et répond 202 ; le PDF et
+# l'e-mail sont produits par un pool borné de workers. Un worker prend un devis
+# avec un bail (lease_until) : à la première requête de chaque processus, puis à
+# chaque passage de l'expéditeur d'e-mails, les devis en attente ou dont le bail
+# a expiré (processus arrêté) sont soumis ; la prise reste atomique.
+
+_devis_executor = ThreadPoolExecutor(max_workers=DEVIS_WORKERS, thread_name_prefix='devis')
+_devis_resumed = set()
+_devis_resume_lock = threading.Lock()
+
+
+def claim_devis_job(conn, job_id):
+    """Prend un devis (en attente ou bail expiré) et retourne ses données, None s'il est déjà pris"""
+    c = conn.cursor()
+    # Prise atomique : un devis n'est traité que par un worker à la fois
+    now = datetime.now()
+    c.execute("""
+        UPDATE devis_jobs SET status = 'running', started_at = ?, lease_until = ?
+        WHERE id = ? AND (status = 'queued' OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)))
+    """, (now.isoformat(), devis_lease_until(), job_id, now.isoformat()))
+    conn.commit()
+    if c.rowcount == 0:
+        return None
+    c.execute("SELECT payload FROM devis_jobs WHERE id = ?", (job_id,))
+    return json_loads(c.fetchone()['payload'])
+
+
+def fail_devis_job(conn, job_id, error):
+    conn.execute("UPDATE devis_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                 (str(error), datetime.now().isoformat(), job_id))
+    conn.commit()
+
+
+def finish_devis_job(conn, job_id, data, pdf_url, cached):
+    # L'e-mail part par la file d'envoi : le devis est terminé dès que le PDF existe
+    email_status, error = 'queued', None
     try:
-        data = request.get_json()
-        print("Données reçues:", data)
+        enqueue_mail(conn, devis_email(data, pdf_url), job_id)
+    except Exception as e:
+        app.logger.error(f"[Devis] Erreur e-mail {data['devis_id']}: {e}")
+        email_status, error = 'failed', str(e)
+    conn.execute("""
+        UPDATE devis_jobs SET status = 'done', pdf_cached = ?, email_status = ?, error = ?, finished_at = ?
+        WHERE id = ?
+    """, (int(cached), email_status, error, datetime.now().isoformat(), job_id))
+    conn.commit()
+
+
+def run_devis_job(job_id):
+    """Génère le PDF puis envoie l'e-mail d'un devis. Exécuté par un worker du pool."""
+    with app.app_context():
+        conn = get_db()
+        data = claim_devis_job(conn, job_id)
+        if data is None:
+            return
+        try:
+            pdf_url, cached = generate_pdf(data)
+        except Exception as e:
+            app.logger.error(f"[Devis] Erreur PDF {data['devis_id']}: {e}\n{traceback.format_exc()}")
+            fail_devis_job(conn, job_id, e)
+            return
+        finish_devis_job(conn, job_id, data, pdf_url, cached)
+        wake_mail_sender()
+        if not cached:
+            maybe_cleanup_pdf_cache()
+
+
+def run_devis_batch(job_ids):
+    """Devis d'une campagne : PDF rendus ensemble (generate_pdfs), puis terminés un par un"""
+    with app.app_context():
+        conn = get_db()
+        claimed = [(job_id, data) for job_id in job_ids
+                   if (data := claim_devis_job(conn, job_id)) is not None]
+        if not claimed:
+            return
+        results = generate_pdfs([data for _, data in claimed])
+        for (job_id, data), result in zip(claimed, results):
+            if isinstance(result, Exception):
+                app.logger.error(f"[Devis] Erreur PDF {data['devis_id']}: {result}")
+                fail_devis_job(conn, job_id, result)
+            else:
+                finish_devis_job(conn, job_id, data, *result)
+        wake_mail_sender()
+        if any(not isinstance(result, Exception) and not result[1] for result in results):
+            maybe_cleanup_pdf_cache()
+
+
+def devis_lease_until():
+    return (datetime.now() + timedelta(seconds=DEVIS_LEASE_SECONDS)).isoformat()
+
+
+def reclaim_devis_jobs(conn, queued=False):
+    """Soumet les devis dont le bail a expiré (et ceux en attente si queued). Retourne leur nombre."""
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT id FROM devis_jobs
+        WHERE (status = 'running' AND (lease_until IS NULL OR lease_until < ?)) {"OR status = 'queued'" if queued else ""}
+        ORDER BY created_at
+    """, (datetime.now().isoformat(),))
+    ids = [row['id'] for row in c.fetchall()]
+    for job_id in ids:
+        _devis_executor.submit(run_devis_job, job_id)
+    return len(ids)
+
+
+def resume_devis_jobs(conn):
+    """Au démarrage du processus (une fois par base) : reprise des devis et démarrage de l'expéditeur"""
+    database = app.config['DATABASE']
+    with _devis_resume_lock:
+        if database in _devis_resumed:
+            return
+        _devis_resumed.add(database)
+        reclaim_devis_jobs(conn, queued=True)
+    wake_mail_sender()
+
+
+@app.before_request
+def start_background_workers():
+    if app.config['DATABASE'] not in _devis_resumed:
+        resume_devis_jobs(get_db())
+
+
+def devis_job_json(job):
+    result = {
+        "job_id": job['id'],
+        "devis_id": job['devis_id'],
+        "status": job['status'],
+        "email_status": job['email_status'],
+        "error": job['error'],
+        "created_at": job['created_at'],
+        "finished_at": job['finished_at'],
+    }
+    if job['status'] == 'done':
+        result["pdf_url"] = devis_pdf_url(job['pdf_filename'])
+    return result
 
-        # Validation des données
-        required_fields = ['product', 'companyInfo']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({"error": f"Champ manquant: {field}"}), 400
 
-        # Calcul du total si non fourni
+def prepare_devis(data):
+    """Valide une demande de devis et fixe son total, sa date et son numéro.
+
+    Retourne le nom du PDF (empreinte du HTML). Lève ValueError si la demande est invalide.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Corps JSON attendu")
+
+    # Validation des données
+    required_fields = ['product', 'companyInfo']
+    for field in required_fields:
+        if not isinstance(data.get(field), dict):
+            raise ValueError(f"Champ manquant: {field}")
+    if not data['companyInfo'].get('email'):
+        raise ValueError("Champ manquant: companyInfo.email")
+
+    # Calcul du total si non fourni
+    try:
         if 'total' not in data:
             data['total'] = float(data['product']['price']) * int(data['product']['quantity'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Prix ou quantité invalide: {str(e)}")
 
-        # Génération du PDF
-        data['devis_id'] = f"DEV-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-        pdf_url = generate_pdf(data)
-
-        # Envoi de l'email
-        msg = Message(
-            subject=f"Devis {data['devis_id']} - {data['product']['name']}",
-            recipients=[data['companyInfo']['email']],
-            html=f"""
-            <h2>Votre devis MIDOCEAN</h2>
-            <p><strong>Référence:</strong> {data['devis_id']}</p>
-            <p><strong>Client:</strong> {data['companyInfo']['companyName']}</p>
-            <p><strong>Contact:</strong> {data['companyInfo']['firstName']} {data['companyInfo']['lastName']}</p>
-            <hr>
-            <h3>Détails du produit</h3>
-            <p><strong>Produit:</strong> {data['product']['name']}</p>
-            <p><strong>Référence:</strong> {data['product'].get('reference', 'N/A')}</p>
-            <p><strong>Quantité:</strong> {data['product']['quantity']}</p>
-            <p><strong>Prix unitaire:</strong> {data['product']['price']} €</p>
-            <p><strong>Total HT:</strong> {data['total']} €</p>
-            <p><strong>Total TTC:</strong> {float(data['total']) * 1.2} €</p>
-            <hr>
-            <p>Téléchargez votre devis complet au format PDF : <a href="{pdf_url}">Télécharger le devis</a></p>
-            <p>Vous pouvez aussi <a href="{pdf_url}">imprimer cette offre</a></p>
-            <hr>
-            <p>Besoin d'informations complémentaires ? Contactez-nous au +33 2 40 48 83 22</p>
-            """
-        )
-        mail.send(msg)
+    # Date et numéro fixés à la demande : le PDF ne dépend que des données saisies et du jour
+    issued_at = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    data['issued_at'] = issued_at.isoformat()
+    data['devis_id'] = devis_reference(data, issued_at)
+    try:
+        return devis_pdf_filename(render_devis_html(data))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Données de devis invalides: {str(e)}")
 
-        return jsonify({
-            "success": True,
-            "devis_id": data['devis_id'],
-            "pdf_url": pdf_url,
-            "message": "Devis créé et email envoyé avec succès"
-        })
 
-    except Exception as e:
-        print("Erreur complète:", str(e))
-        return jsonify({
-            "error": "Erreur lors de la création du devis",
-            "details": str(e)
-        }), 500
+@app.route('/api/devis', methods=['POST'])
+def create_devis():
+    data = request.get_json(silent=True)
+    try:
+        pdf_filename = prepare_devis(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job_id = uuid4().hex
+
+    conn = get_db()
+    conn.execute("""
+        INSERT INTO devis_jobs (id, devis_id, status, payload, pdf_filename, created_at)
+        VALUES (?, ?, 'queued', ?, ?, ?)
+    """, (job_id, data['devis_id'], json_dumps(data), pdf_filename, datetime.now().isoformat()))
+    conn.commit()
+    _devis_executor.submit(run_devis_job, job_id)
+
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "devis_id": data['devis_id'],
+        "status": "queued",
+        "status_url": f"/api/devis/{job_id}",
+        "message": "Devis en cours de génération"
+    }), 202
+
+
+def batch_quotes(data):
+    """Corps de /api/devis/batch -> liste de demandes de devis.
+
+    {"quotes": [...]} : demandes complètes ; {"product": {...}, "recipients": [companyInfo, ...]} :
+    la même offre pour chaque destinataire (client_reference facultatif par destinataire).
+    """
+    if isinstance(data, dict) and isinstance(data.get('quotes'), list):
+        return data['quotes']
+    if isinstance(data, dict) and isinstance(data.get('recipients'), list):
+        shared = {key: value for key, value in data.items() if key != 'recipients'}
+        quotes = []
+        for recipient in data['recipients']:
+            if not isinstance(recipient, dict):
+                quotes.append(recipient)
+                continue
+            company = {key: value for key, value in recipient.items() if key != 'client_reference'}
+            quote = json_loads(json_dumps(shared))  # copie : chaque devis reçoit son total et son numéro
+            quote['companyInfo'] = company
+            if 'client_reference' in recipient:
+                quote['client_reference'] = recipient['client_reference']
+            quotes.append(quote)
+        return quotes
+    raise ValueError("Attendu : {\"quotes\": [...]} ou {\"product\": {...}, \"recipients\": [...]}")
+
+
+@app.route('/api/devis/batch', methods=['POST'])
+@auth_required
+def create_devis_batch():
+    try:
+        quotes = batch_quotes(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if len(quotes) > DEVIS_BATCH_MAX:
+        return jsonify({"error": f"Maximum {DEVIS_BATCH_MAX} devis par campagne"}), 413
+
+    batch_id = uuid4().hex
+    now = datetime.now().isoformat()
+    jobs, errors = [], []
+    for index, quote in enumerate(quotes):
+        try:
+            pdf_filename = prepare_devis(quote)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+        jobs.append((uuid4().hex, quote['devis_id'], json_dumps(quote), pdf_filename, now, batch_id, index))
+
+    if not jobs:
+        return jsonify({"error": "Aucun devis valide", "errors": errors}), 400
+
+    # Toute la campagne en une transaction
+    conn = get_db()
+    conn.execute("INSERT INTO devis_batches (id, size, created_at) VALUES (?, ?, ?)", (batch_id, len(jobs), now))
+    conn.executemany("""
+        INSERT INTO devis_jobs (id, devis_id, status, payload, pdf_filename, created_at, batch_id, batch_index)
+        VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)
+    """, jobs)
+    conn.commit()
+    # Lots de DEVIS_RENDER_BATCH devis : un wkhtmltopdf par lot, lots répartis sur les workers
+    for start in range(0, len(jobs), DEVIS_RENDER_BATCH):
+        _devis_executor.submit(run_devis_batch, [job[0] for job in jobs[start:start + DEVIS_RENDER_BATCH]])
+
+    return jsonify({
+        "batch_id": batch_id,
+        "queued": len(jobs),
+        "errors": errors,
+        "status_url": f"/api/devis/batch/{batch_id}",
+        "zip_url": f"/api/devis/batch/{batch_id}/zip"
+    }), 202
+
+
+def load_devis_batch(batch_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM devis_batches WHERE id = ?", (batch_id,))
+    if c.fetchone() is None:
+        return None
+    c.execute("SELECT * FROM devis_jobs WHERE batch_id = ? ORDER BY batch_index", (batch_id,))
+    return c.fetchall()
+
+
+@app.route('/api/devis/batch/<string:batch_id>', methods=['GET'])
+@auth_required
+def get_devis_batch(batch_id):
+    jobs = load_devis_batch(batch_id)
+    if jobs is None:
+        return jsonify({"error": "Campagne introuvable"}), 404
+
+    counts = Counter(job['status'] for job in jobs)
+    return jsonify({
+        "batch_id": batch_id,
+        "finished": counts['queued'] + counts['running'] == 0,
+        "counts": counts,
+        "items": [dict(devis_job_json(job), index=job['batch_index']) for job in jobs]
+    })
+
+
+@app.route('/api/devis/batch/<string:batch_id>/zip', methods=['GET'])
+@auth_required
+def get_devis_batch_zip(batch_id):
+    jobs = load_devis_batch(batch_id)
+    if jobs is None:
+        return jsonify({"error": "Campagne introuvable"}), 404
+    if any(job['status'] in ('queued', 'running') for job in jobs):
+        return jsonify({"error": "Campagne en cours de génération"}), 409
+
+    # PDF déjà compressés : archive sans recompression, construite sur disque au-delà de 16 Mo
+    archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+        manifest = []
+        for job in jobs:
+            entry = dict(devis_job_json(job), index=job['batch_index'])
+            path = os.path.join(app.config['PDF_FOLDER'], job['pdf_filename'])
+            if job['status'] == 'done' and os.path.exists(path):
+                entry['file'] = f"{job['batch_index']:04d}-{job['devis_id']}.pdf"
+                zf.write(path, entry['file'])
+            manifest.append(entry)
+        zf.writestr('manifest.json', json_dumps(manifest))
+    archive.seek(0)
+    return send_file(archive, mimetype='application/zip', as_attachment=True,
+                     download_name=f"devis-{batch_id}.zip")
+
+
+@app.route('/api/devis/stats', methods=['GET'])
+@auth_required
+def get_devis_stats():
+    try:
+        days = int(request.args.get('days', 7))
+    except ValueError as e:
+        return jsonify({"error": f"Paramètre invalide: {str(e)}"}), 400
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) AS count FROM devis_jobs WHERE created_at >= ? GROUP BY status", (since,))
+    jobs = {row['status']: row['count'] for row in c.fetchall()}
+    c.execute("""
+        SELECT COUNT(*) AS generated, COALESCE(SUM(pdf_cached), 0) AS hits
+        FROM devis_jobs WHERE status = 'done' AND pdf_cached IS NOT NULL AND created_at >= ?
+    """, (since,))
+    cache = c.fetchone()
+
+    files, size = 0, 0
+    if os.path.isdir(app.config['PDF_FOLDER']):
+        for entry in os.scandir(app.config['PDF_FOLDER']):
+            if entry.is_file() and entry.name.endswith('.pdf'):
+                files += 1
+                size += entry.stat().st_size
+
+    return jsonify({
+        "days": days,
+        "jobs": jobs,
+        "pdf_cache": {
+            "requests": cache['generated'],
+            "hits": cache['hits'],
+            "hit_rate": round(cache['hits'] / cache['generated'], 3) if cache['generated'] else None,
+            "files": files,
+            "size_bytes": size,
+        },
+    })
+
+
+@app.route('/api/mail/outbox', methods=['GET'])
+@auth_required
+def get_mail_outbox():
+    return jsonify(mail_outbox_json(get_db()))
+
+
+@app.route('/api/devis/<string:job_id>', methods=['GET'])
+def get_devis_job(job_id):
+    conn = get_db()
+    job = conn.execute("SELECT * FROM devis_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return jsonify({"error": "Devis introuvable"}), 404
+    return jsonify(devis_job_json(job))
+
+
+devis_cli = AppGroup('devis', help="Devis et cache des PDF")
+
+
+@devis_cli.command('cleanup')
+@click.option('--ttl-days', type=int, default=None, help="Supprimer les PDF non utilisés depuis N jours")
+@click.option('--max-mb', type=int, default=None, help="Taille maximale du dossier des PDF")
+def devis_cleanup_command(ttl_days, max_mb):
+    """Nettoie le dossier des PDF de devis."""
+    deleted, remaining = cleanup_pdf_cache(ttl_days=ttl_days, max_mb=max_mb)
+    click.echo(f"{deleted} PDF supprimé(s), {remaining / 1024 / 1024:.1f} Mo restants")
+
+
+@devis_cli.command('send-mails')
+def devis_send_mails_command():
+    """Envoie les e-mails en attente (file mail_outbox), sans attendre le thread d'envoi."""
+    conn = get_db()
+    conn.execute("UPDATE mail_outbox SET next_attempt_at = ? WHERE status = 'pending'", (datetime.now().isoformat(),))
+    conn.commit()
+    drain_mail_outbox()
+    status = mail_outbox_json(conn)
+    click.echo(f"{status['counts']['sent']} envoyé(s), {status['depth']} en attente, "
+               f"{status['counts']['failed']} en échec")
+
+
+app.cli.add_command(devis_cli)
 
 
 
@@ -1,10 +1,16 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-import json
-API_PRODUCTS_URL = "http://localhost:5001/products/images/full"
-API_ADD_PRODUCT_URL = "http://localhost:5001/products"
-AUTH_URL = "http://localhost:5001/auth/login"
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:5001")
+CHECKPOINT_FILE = "auto_import.checkpoint"
+IMPORT_STATUS_LABELS = {"created": "ajouté", "updated": "mis à jour", "unchanged": "déjà à jour"}
 
-REFS = [
+REFS = {
     "MO2437", "MO2347", "MO2269", "MO2345", "MO2543", "MO2544", "MO2359", "MO7455", "MO8594", "MO2338", "MO6651", "MO6955",
     "KC1350", "MO6876", "MO2076", "MO2562", "MO2549", "MO2500", "MO2409", "MO2575", "MO2517", "MO2561", "MO2571", "MO2459",
     "MO2570", "MO2440", "MO9243", "MO2403", "MO6313", "MO9910", "MO8294", "MO9227", "MO7251", "MO2315", "MO2119", "MO6149",
@@ -48,25 +54,48 @@ REFS = [
     "MO2513", "MO2445", "MO2520", "MO9891", "MO6815", "MO6662", "MO8735", "MO6874", "MO2211",
     "MO9673", "MO2079", "MO6825", "MO6642", "MO2378", "MO9692", "MO2275", "MO2279", "MO6393",
     "MO9785", "MO6317", "MO2182", "MO6879"
-]
+}
+
+
+def create_session(workers):
+    """Session partagée : connexions réutilisées et erreurs transitoires réessayées avec backoff.
+
+    Les POST ne sont réessayés que si la requête n'a pas atteint le serveur
+    (connexion refusée) ou s'il l'a refusée (429, 502-504) : jamais après une
+    réponse perdue, pour ne pas importer deux fois le même lot.
+    """
+    retry = Retry(
+        total=5, connect=5, read=0, status=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=workers, pool_maxsize=workers)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
-def get_token():
-    """Récupère un token JWT via le login admin/admin"""
-    data = {"username": "admin", "password": "admin"}
-    response = requests.post(AUTH_URL, json=data)
+def get_token(session, username, password):
+    """Récupère un token JWT via le login admin"""
+    response = session.post(f"{API_BASE_URL}/auth/login", json={"username": username, "password": password}, timeout=30)
     response.raise_for_status()
     return response.json()["token"]
 
-def fetch_products(token):
+
+def fetch_products(session, token):
     """Récupère la liste des produits avec images depuis l'API protégée"""
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(API_PRODUCTS_URL, headers=headers)
+    response = session.get(f"{API_BASE_URL}/products/images/full", headers=headers, timeout=120)
     response.raise_for_status()
     return response.json().get("products_with_images", [])
 
-def import_product(product, token):
-    """Envoie un produit à l'API d'ajout avec authentification"""
-    form_data = {
+
+def product_payload(product):
+    """Produit du catalogue -> objet attendu par /products/bulk (prix de vente = 2 x prix d'achat)"""
+    return {
+        "master_code": product.get("master_code"),
         "name": product.get("product_name", f"Produit {product.get('master_code')}"),
         "price": product.get("price") * 2 if product.get("price") else 0,
         "stock": product.get("stock", 0),
@@ -74,28 +103,103 @@ def import_product(product, token):
         "category_level2": product.get("category_level2") or "Sous-catégorie par défaut",
         "category_level3": product.get("category_level3") or "Sous-sous-catégorie par défaut",
         "description": product.get("long_description") or "Pas de description disponible",
-        "colors_json": json.dumps(product.get("colors", [])),
-        "images_json": json.dumps(product.get("images", [])),
-        "images_by_color_json": json.dumps(product.get("images_by_color", {}))
+        "colors_json": product.get("colors", []),
+        "images_json": product.get("images", []),
+        "images_by_color_json": product.get("images_by_color", {}),
     }
+
+
+def import_batch(session, token, batch):
+    """Envoie un lot à /products/bulk. Retourne ([(master_code, statut)], erreurs).
+
+    Le serveur met à jour un produit déjà présent (même master_code) au lieu de le dupliquer.
+    """
     headers = {"Authorization": f"Bearer {token}"}
-    res = requests.post(API_ADD_PRODUCT_URL, data=form_data, headers=headers)
-    if res.status_code == 201:
-        print(f"✅ Produit {form_data['name']} ajouté")
-    else:
-        print(f"❌ Erreur pour {form_data['name']} : {res.text}")
+    response = session.post(f"{API_BASE_URL}/products/bulk", json=[product_payload(p) for p in batch],
+                            headers=headers, timeout=120)
+    if response.status_code not in (200, 201, 400):
+        response.raise_for_status()
+    result = response.json()
+    imported = [(batch[item["index"]].get("master_code"), item["status"]) for item in result.get("items", [])]
+    errors = [(batch[error["index"]].get("master_code"), error["error"]) for error in result.get("errors", [])]
+    return imported, errors
+
+
+def load_checkpoint(path):
+    """master_codes déjà importés (une ligne par code, écrite après chaque lot réussi)"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def load_refs(path):
+    if not path:
+        return REFS
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith("#")}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Importe les références MidOcean sélectionnées dans les produits locaux")
+    parser.add_argument("--refs", help="Fichier de master_codes (un par ligne), à la place de la liste REFS")
+    parser.add_argument("--workers", type=int, default=4, help="Lots envoyés en parallèle")
+    parser.add_argument("--batch-size", type=int, default=50, help="Produits par requête /products/bulk")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="Fichier des références déjà importées")
+    parser.add_argument("--dry-run", action="store_true", help="Affiche ce qui serait importé sans rien écrire")
+    parser.add_argument("--username", default=os.getenv("ADMIN_USERNAME", "admin"))
+    parser.add_argument("--password", default=os.getenv("ADMIN_PASSWORD", "admin"))
+    return parser.parse_args()
+
 
 def main():
-    token = get_token()
-    all_products = fetch_products(token)
-    imported_count = 0
+    args = parse_args()
+    refs = load_refs(args.refs)
+    done = load_checkpoint(args.checkpoint)
+
+    session = create_session(args.workers)
+    token = get_token(session, args.username, args.password)
+    all_products = fetch_products(session, token)
 
+    selected = {}
     for product in all_products:
-        if product.get("master_code") in REFS:
-            import_product(product, token)
-            imported_count += 1
+        master_code = product.get("master_code")
+        if master_code in refs and master_code not in done:
+            selected.setdefault(master_code, product)
+    todo = list(selected.values())
+    missing = refs - done - selected.keys()
+    print(f"{len(todo)} produit(s) à importer, {len(refs & done)} déjà importé(s), "
+          f"{len(missing)} référence(s) absente(s) du catalogue")
+
+    if args.dry_run:
+        for product in todo:
+            print(f"  [dry-run] {product.get('master_code')} {product.get('product_name', '')}")
+        return
+
+    batches = [todo[i:i + args.batch_size] for i in range(0, len(todo), args.batch_size)]
+    imported_count, failed_count = 0, 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            open(args.checkpoint, "a", encoding="utf-8") as checkpoint:
+        futures = {pool.submit(import_batch, session, token, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                imported, errors = future.result()
+            except requests.RequestException as e:
+                failed_count += len(futures[future])
+                print(f"❌ Lot de {len(futures[future])} produits non importé : {e}")
+                continue
+            # Checkpoint écrit dès le lot terminé : une relance ne réimporte pas ces produits
+            checkpoint.writelines(f"{master_code}\n" for master_code, _ in imported)
+            checkpoint.flush()
+            imported_count += len(imported)
+            failed_count += len(errors)
+            for master_code, status in imported:
+                print(f"✅ Produit {master_code} {IMPORT_STATUS_LABELS.get(status, status)}")
+            for master_code, error in errors:
+                print(f"❌ Erreur pour {master_code} : {error}")
+
+    print(f"\n✅ {imported_count} produits importés avec succès, {failed_count} en erreur.")
 
-    print(f"\n✅ {imported_count} produits importés avec succès.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
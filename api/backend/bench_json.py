@@ -0,0 +1,130 @@
+"""Benchmark de sérialisation JSON : module json standard vs orjson.
+
+Mesure le débit de dumps/loads sur un catalogue au format MidOcean (synthétique,
+ou le dernier snapshot "products" de la base avec --db) et le coût d'une réponse
+/products/images/full via le provider Flask de chaque backend.
+
+    python bench_json.py --products 5000 --repeat 5
+    python bench_json.py --db midocean_crm.db
+"""
+import argparse
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def synthetic_catalog(count):
+    """Catalogue au format de l'API products 2.0 (variants, digital_assets, printing_positions)"""
+    products = []
+    for i in range(count):
+        master_code = f"MO{1000 + i}"
+        products.append({
+            "master_code": master_code,
+            "master_id": str(40000000 + i),
+            "product_name": f"Mug céramique {i}",
+            "short_description": "Mug en céramique de 300 ml",
+            "long_description": "Mug en céramique brillante de 300 ml. Compatible lave-vaisselle. " * 3,
+            "brand": "midocean",
+            "material": "Céramique",
+            "dimensions": "Ø8,2X9,6 CM",
+            "printing_positions": [{
+                "position_id": position,
+                "images": [{
+                    "print_position_image_blank": f"https://cdn1.midocean.com/image/print/{master_code}-{position}-blank.jpg",
+                    "print_position_image_with_area": f"https://cdn1.midocean.com/image/print/{master_code}-{position}-area.jpg",
+                }],
+            } for position in ("FRONT", "BACK")],
+            "variants": [{
+                "variant_id": f"{10000000 + i * 10 + j}",
+                "sku": f"{master_code}-{j:02d}",
+                "color_description": color,
+                "color_code": f"{j:02d}",
+                "gtin": f"87193325{i:05d}{j}",
+                "category_level1": "Maison & vie",
+                "category_level2": "Cuisine",
+                "category_level3": "Mugs",
+                "digital_assets": [{
+                    "url": f"https://cdn1.midocean.com/image/700X700/{master_code}-{j:02d}-{subtype}.jpg",
+                    "url_highress": f"https://cdn1.midocean.com/image/original/{master_code}-{j:02d}-{subtype}.jpg",
+                    "type": "image",
+                    "subtype": subtype,
+                } for subtype in ("item_picture_front", "item_picture_back", "item_picture_side")],
+            } for j, color in enumerate(("blanc", "noir", "rouge", "bleu"))],
+        })
+    return {"products": products}
+
+
+def snapshot_catalog(database):
+    """Dernier snapshot products de la base (réassemblé s'il a été ingéré en streaming)"""
+    import api
+    api.app.config['DATABASE'] = database
+    conn = api.get_db()
+    snapshot = api.latest_snapshot(conn.cursor(), 'products')
+    if snapshot is None:
+        raise SystemExit(f"Aucun snapshot products dans {database}")
+    data = api.load_snapshot_data(conn, snapshot)
+    conn.close()
+    return data
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def flask_response_timing(payload, backend, repeat):
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+
+    app = Flask(__name__)
+    if backend == "orjson":
+        import api
+        app.json = api.OrjsonProvider(app)
+    else:
+        app.json = DefaultJSONProvider(app)
+    with app.app_context():
+        return best_of(repeat, lambda: app.json.response(payload).get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=5000, help="Taille du catalogue synthétique")
+    parser.add_argument("--db", help="Utiliser le dernier snapshot products de cette base SQLite")
+    parser.add_argument("--repeat", type=int, default=5, help="Répétitions (on garde la meilleure)")
+    args = parser.parse_args()
+
+    payload = snapshot_catalog(args.db) if args.db else synthetic_catalog(args.products)
+    text = json.dumps(payload)
+    size_mb = len(text.encode("utf-8")) / 1e6
+    print(f"Catalogue : {len(payload.get('products', payload))} produits, {size_mb:.1f} Mo de JSON\n")
+
+    backends = {"stdlib": (json.dumps, json.loads)}
+    if orjson is not None:
+        backends["orjson"] = (orjson.dumps, orjson.loads)
+    else:
+        print("orjson non installé : seul le module json standard est mesuré (pip install orjson)\n")
+
+    results = {}
+    print(f"{'backend':<8} {'dumps':>10} {'loads':>10} {'réponse':>10}   (Mo/s)")
+    for name, (dumps, loads) in backends.items():
+        dumps_time = best_of(args.repeat, lambda: dumps(payload))
+        loads_time = best_of(args.repeat, lambda: loads(text))
+        response_time = flask_response_timing(payload, name, args.repeat)
+        results[name] = (dumps_time, loads_time, response_time)
+        print(f"{name:<8} {size_mb / dumps_time:>10.0f} {size_mb / loads_time:>10.0f} {size_mb / response_time:>10.0f}")
+
+    if "orjson" in results:
+        ratios = [s / o for s, o in zip(results["stdlib"], results["orjson"])]
+        print(f"\norjson : dumps x{ratios[0]:.1f}, loads x{ratios[1]:.1f}, réponse Flask x{ratios[2]:.1f}")
+
+
+if __name__ == "__main__":
+    main()
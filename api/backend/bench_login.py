@@ -0,0 +1,125 @@
+"""Benchmark des connexions : hachage scrypt dans le thread de requête vs pool de processus.
+
+Envoie une rafale de POST /auth/login depuis plusieurs threads (base SQLite temporaire,
+application Flask en mémoire) et mesure, pendant la rafale, la latence de /users/me
+qui ne dépend plus que du token. Avec --url, la rafale vise un serveur déjà lancé.
+
+    python bench_login.py --logins 200 --threads 8
+    python bench_login.py --url http://localhost:5001 --email user@exemple.fr --password secret
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def run_burst(login, me, logins, threads):
+    """Rafale de connexions ; /users/me appelé en boucle en parallèle. Retourne les mesures."""
+    stop = threading.Event()
+    me_latencies = []
+
+    def poll_me():
+        while not stop.is_set():
+            started = time.perf_counter()
+            me()
+            me_latencies.append(time.perf_counter() - started)
+
+    poller = threading.Thread(target=poll_me)
+    started = time.perf_counter()
+    poller.start()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(lambda _: login(), range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    poller.join()
+    return {
+        "logins_per_s": logins / elapsed,
+        "login_p50": statistics.median(latencies),
+        "login_p95": percentile(latencies, 0.95),
+        "me_p50": statistics.median(me_latencies) if me_latencies else 0.0,
+        "me_p95": percentile(me_latencies, 0.95),
+    }
+
+
+def timed(fn):
+    def wrapper():
+        started = time.perf_counter()
+        response = fn()
+        if response.status_code != 200:
+            raise SystemExit(f"Réponse inattendue {response.status_code}")
+        return time.perf_counter() - started
+    return wrapper
+
+
+def local_app():
+    """Application en mémoire sur une base temporaire, avec un compte de test"""
+    os.environ.setdefault("ADMIN_PASSWORD", "bench-admin")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import api
+    api.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    api.init_db()
+    api.app.test_client().post('/auth/register', json={
+        "name": "Bench", "email": "bench@exemple.fr", "password": "motdepasse"})
+    return api
+
+
+def local_target(api, workers):
+    """Cibles login et /users/me avec PASSWORD_WORKERS=workers"""
+    api.PASSWORD_WORKERS = workers
+    api._password_executor = None
+    client = api.app.test_client()
+    credentials = {"username": "bench@exemple.fr", "password": "motdepasse"}
+    token = client.post('/auth/login', json=credentials).get_json()['token']
+    headers = {"Authorization": f"Bearer {token}"}
+    return (timed(lambda: client.post('/auth/login', json=credentials)),
+            lambda: client.get('/users/me', headers=headers))
+
+
+def remote_target(url, email, password):
+    import requests
+    session = requests.Session()
+    credentials = {"username": email, "password": password}
+    login = timed(lambda: requests.post(f"{url}/auth/login", json=credentials, timeout=30))
+    token = requests.post(f"{url}/auth/login", json=credentials, timeout=30).json()['token']
+    headers = {"Authorization": f"Bearer {token}"}
+    return login, lambda: session.get(f"{url}/users/me", headers=headers, timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200, help="Nombre de connexions de la rafale")
+    parser.add_argument("--threads", type=int, default=8, help="Connexions simultanées")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="PASSWORD_WORKERS pour le mode pool (local)")
+    parser.add_argument("--url", help="Serveur à mesurer au lieu de l'application en mémoire")
+    parser.add_argument("--email", help="Compte utilisé avec --url")
+    parser.add_argument("--password", help="Mot de passe du compte utilisé avec --url")
+    args = parser.parse_args()
+
+    if args.url:
+        targets = {args.url: lambda: remote_target(args.url.rstrip('/'), args.email, args.password)}
+    else:
+        api = local_app()
+        targets = {"thread": lambda: local_target(api, 0),
+                   f"pool x{args.workers}": lambda: local_target(api, args.workers)}
+
+    print(f"{args.logins} connexions, {args.threads} simultanées\n")
+    print(f"{'mode':<12} {'conn/s':>8} {'login p50':>10} {'login p95':>10} {'me p50':>9} {'me p95':>9}   (ms)")
+    for name, target in targets.items():
+        login, me = target()
+        result = run_burst(login, me, args.logins, args.threads)
+        print(f"{name:<12} {result['logins_per_s']:>8.1f} {result['login_p50'] * 1000:>10.0f} "
+              f"{result['login_p95'] * 1000:>10.0f} {result['me_p50'] * 1000:>9.1f} {result['me_p95'] * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
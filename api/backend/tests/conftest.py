@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+
+import pytest
+
+os.environ.setdefault("ADMIN_USERNAME", "admin")
+os.environ.setdefault("ADMIN_PASSWORD", "admin")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Application sur une base et des dossiers temporaires"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(api.app.config, 'DATABASE', str(tmp_path / "test.db"))
+    monkeypatch.setitem(api.app.config, 'UPLOAD_FOLDER', str(tmp_path / "uploads"))
+    monkeypatch.setitem(api.app.config, 'PDF_FOLDER', str(tmp_path / "pdfs"))
+    os.makedirs(api.app.config['UPLOAD_FOLDER'])
+    # Pas de thread d'envoi : il survivrait au test et lirait la base du test suivant
+    monkeypatch.setattr(api, 'wake_mail_sender', lambda: None)
+    api.init_db()
+    yield api.app
+    for executor in (api._devis_executor, api._similar_executor, api._image_executor):
+        drain(executor)
+
+
+def drain(executor):
+    """Attend que tous les workers du pool soient libres (tâches du test terminées)"""
+    workers = executor._max_workers
+    barrier = threading.Barrier(workers + 1)
+    for _ in range(workers):
+        executor.submit(barrier.wait)
+    barrier.wait()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(client):
+    response = client.post('/auth/login', json={"username": os.environ["ADMIN_USERNAME"],
+                                                "password": os.environ["ADMIN_PASSWORD"]})
+    return {"Authorization": f"Bearer {response.get_json()['token']}"}
+
+
+def insert_snapshot(endpoint, payload):
+    """Enregistre un snapshot api_data réussi, comme après /midocean/fetch"""
+    text = api.json_dumps(payload)
+    data, encoding = api.encode_snapshot_text(text)
+    conn = api.get_db()
+    conn.execute("""
+        INSERT INTO api_data (endpoint, fetched_at, data, status, encoding)
+        VALUES (?, datetime('now'), ?, 'success', ?)
+    """, (endpoint, data, encoding))
+    conn.commit()
+    conn.close()
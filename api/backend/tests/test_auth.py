@@ -0,0 +1,29 @@
+import api
+
+
+def test_users_me_for_env_admin_is_404(client, auth_headers):
+    # L'administrateur de .env n'a pas de ligne dans users
+    assert client.get('/users/me', headers=auth_headers).status_code == 404
+
+
+def test_users_me_from_token_claims(client, monkeypatch):
+    monkeypatch.setattr(api, 'PASSWORD_WORKERS', 1)
+    monkeypatch.setattr(api, '_password_executor', None)
+    credentials = {"name": "Ada", "email": "ada@acme.fr", "password": "motdepasse"}
+    assert client.post('/auth/register', json=credentials).status_code == 201
+    assert api._password_executor._mp_context.get_start_method() == 'spawn'
+
+    response = client.post('/auth/login', json={"username": "ada@acme.fr", "password": "motdepasse"})
+    headers = {"Authorization": f"Bearer {response.get_json()['token']}"}
+    api._password_executor.shutdown()
+
+    # Compte renommé après la connexion : /users/me répond avec le contenu du token
+    conn = api.get_db()
+    conn.execute("UPDATE users SET name = 'Autre', email = 'autre@acme.fr', role = 'admin' WHERE email = ?",
+                 ("ada@acme.fr",))
+    conn.commit()
+    conn.close()
+    response = client.get('/users/me', headers=headers)
+    assert response.status_code == 200
+    me = response.get_json()
+    assert (me['name'], me['email'], me['role']) == ("Ada", "ada@acme.fr", 'client')
@@ -0,0 +1,36 @@
+import api
+from conftest import insert_snapshot
+
+PRODUCTS = [{
+    "master_code": "MO8422",
+    "master_id": "40000004",
+    "product_name": "Mug",
+    "variants": [{"variant_id": "10000001", "sku": "MO8422-03", "color_description": "Bleu",
+                  "digital_assets": [{"type": "image", "subtype": "item_picture_front",
+                                      "url": "https://cdn1.midocean.com/MO8422-03.jpg"}]}],
+}]
+
+
+def shop_products():
+    conn = api.get_db()
+    rows = [row['master_code'] for row in conn.execute("SELECT master_code FROM products")]
+    conn.close()
+    return rows
+
+
+def test_catalog_import_with_empty_printdata(app):
+    insert_snapshot('products', PRODUCTS)
+    insert_snapshot('printdata', {"printing_techniques": [], "products": []})
+
+    result = app.test_cli_runner().invoke(args=['catalog', 'import'])
+    assert result.exception is None, result.output
+    assert "1 produit(s) créé(s)" in result.output
+    assert shop_products() == ["MO8422"]
+
+
+def test_catalog_import_with_empty_products(app):
+    insert_snapshot('products', [])
+
+    result = app.test_cli_runner().invoke(args=['catalog', 'import'])
+    assert result.exception is None, result.output
+    assert shop_products() == []
@@ -0,0 +1,225 @@
+import os
+import smtplib
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+
+import api
+
+QUOTE = {
+    "product": {"name": "Mug", "price": "2.5", "quantity": 100},
+    "companyInfo": {"companyName": "ACME", "firstName": "Ada", "lastName": "Martin", "email": "ada@acme.fr"},
+}
+
+
+@pytest.fixture
+def fake_pdf(monkeypatch):
+    rendered = []
+
+    def from_string(html, path, options=None):
+        rendered.append(path)
+        with open(path, 'w') as f:
+            f.write("%PDF")
+    monkeypatch.setattr(api.pdfkit, 'from_string', from_string)
+    return rendered
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def job_status(job_id):
+    conn = api.get_db()
+    row = conn.execute("SELECT status FROM devis_jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    return row['status']
+
+
+def insert_running_job(job_id, lease_until):
+    data = dict(QUOTE, companyInfo=dict(QUOTE['companyInfo']))
+    with api.app.test_request_context():
+        pdf_filename = api.prepare_devis(data)
+    conn = api.get_db()
+    conn.execute("""
+        INSERT INTO devis_jobs (id, devis_id, status, payload, pdf_filename, created_at, lease_until)
+        VALUES (?, ?, 'running', ?, ?, ?, ?)
+    """, (job_id, data['devis_id'], api.json_dumps(data), pdf_filename, datetime.now().isoformat(),
+          lease_until.isoformat()))
+    conn.commit()
+    conn.close()
+
+
+def test_resume_only_reclaims_expired_leases(app, client, fake_pdf):
+    # Deux devis pris par un autre processus : l'un travaille encore, l'autre s'est arrêté
+    insert_running_job('live', datetime.now() + timedelta(minutes=5))
+    insert_running_job('dead', datetime.now() - timedelta(minutes=1))
+    api._devis_resumed.discard(app.config['DATABASE'])
+
+    client.get('/api/devis/live')  # première requête du processus : reprise
+    assert wait_for(lambda: job_status('dead') == 'done')
+    assert job_status('live') == 'running'
+    assert len(fake_pdf) == 1
+
+
+def test_batch_renders_in_one_wkhtmltopdf_run(app, client, auth_headers, fake_pdf, monkeypatch):
+    runs = []
+
+    def from_file(sources, path, options=None):
+        # Un PDF par lot : 2 pages pour chaque devis, un signet au début de chacun
+        runs.append(len(sources))
+        writer = PdfWriter()
+        for index in range(len(sources)):
+            writer.add_blank_page(595, 842)
+            writer.add_outline_item(f"Devis {index}", 2 * index)
+            writer.add_blank_page(595, 842)
+        with open(path, 'wb') as f:
+            writer.write(f)
+    monkeypatch.setattr(api.pdfkit, 'from_file', from_file)
+
+    recipients = [dict(QUOTE['companyInfo'], companyName=f"Client {i}") for i in range(3)]
+    response = client.post('/api/devis/batch', json={"product": QUOTE["product"], "recipients": recipients},
+                           headers=auth_headers)
+    assert response.status_code == 202
+    batch_url = response.get_json()['status_url']
+    assert wait_for(lambda: client.get(batch_url, headers=auth_headers).get_json()['counts'].get('done') == 3)
+
+    assert runs == [3] and fake_pdf == []
+    conn = api.get_db()
+    filenames = [row['pdf_filename'] for row in conn.execute("SELECT pdf_filename FROM devis_jobs")]
+    conn.close()
+    assert len(set(filenames)) == 3
+    for filename in filenames:
+        assert len(PdfReader(os.path.join(app.config['PDF_FOLDER'], filename)).pages) == 2
+
+
+def test_mail_leases_are_respected(app, monkeypatch):
+    conn = api.get_db()
+    now = datetime.now()
+    for subject, status, lease in (("envoi en cours", 'sending', now + timedelta(minutes=5)),
+                                   ("expéditeur arrêté", 'sending', now - timedelta(minutes=1))):
+        conn.execute("""
+            INSERT INTO mail_outbox (recipients, subject, html, status, next_attempt_at, created_at, lease_until)
+            VALUES ('["a@b.fr"]', ?, '<p>x</p>', ?, ?, ?, ?)
+        """, (subject, status, now.isoformat(), now.isoformat(), lease.isoformat()))
+    conn.commit()
+
+    sent = []
+
+    class Connection:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def send(self, msg):
+            sent.append(msg.subject)
+
+    monkeypatch.setattr(api.mail, 'connect', lambda: Connection())
+    with app.app_context():
+        assert api.send_mail_batch(conn) == (1, 0)
+    conn.close()
+    assert sent == ["expéditeur arrêté"]
+
+
+class FakeSMTP:
+    """Remplace mail.connect() : compte les sessions, refuse les destinataires de `bounces`"""
+
+    def __init__(self, bounces=()):
+        self.sessions, self.sent, self.bounces = 0, [], set(bounces)
+
+    def __call__(self):
+        self.sessions += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def send(self, msg):
+        if set(msg.recipients) & self.bounces:
+            raise OSError("550 mailbox unavailable")
+        self.sent.append(msg.recipients[0])
+
+
+def outbox(conn):
+    return {row['recipients']: row for row in conn.execute("SELECT * FROM mail_outbox")}
+
+
+def test_mail_batch_uses_one_session_and_retries(app, monkeypatch):
+    monkeypatch.setattr(api, 'MAIL_MAX_ATTEMPTS', 2)
+    smtp = FakeSMTP(bounces={"bounce@acme.fr"})
+    monkeypatch.setattr(api.mail, 'connect', smtp)
+    conn = api.get_db()
+    with app.app_context():
+        for recipient in ("a@acme.fr", "bounce@acme.fr", "b@acme.fr"):
+            api.enqueue_mail(conn, api.Message(subject="Devis", recipients=[recipient], html="<p>x</p>"))
+        conn.commit()
+
+        assert api.send_mail_batch(conn) == (2, 1)
+        assert smtp.sessions == 1 and smtp.sent == ["a@acme.fr", "b@acme.fr"]
+        bounce = outbox(conn)['["bounce@acme.fr"]']
+        assert (bounce['status'], bounce['attempts']) == ('pending', 1)
+        assert bounce['next_attempt_at'] > datetime.now().isoformat()
+
+        # Pas encore dû : aucune session ouverte
+        assert api.send_mail_batch(conn) == (0, 0)
+        assert smtp.sessions == 1
+
+        conn.execute("UPDATE mail_outbox SET next_attempt_at = ? WHERE id = ?",
+                     (datetime.now().isoformat(), bounce['id']))
+        conn.commit()
+        assert api.send_mail_batch(conn) == (0, 1)
+        bounce = outbox(conn)['["bounce@acme.fr"]']
+        assert (bounce['status'], bounce['attempts']) == ('failed', 2)
+        assert bounce['last_error'] == "550 mailbox unavailable"
+    conn.close()
+
+
+def test_mail_batch_reschedules_when_smtp_is_down(app, monkeypatch):
+    def connect():
+        raise ConnectionRefusedError("SMTP indisponible")
+    monkeypatch.setattr(api.mail, 'connect', connect)
+    conn = api.get_db()
+    with app.app_context():
+        for recipient in ("a@acme.fr", "b@acme.fr"):
+            api.enqueue_mail(conn, api.Message(subject="Devis", recipients=[recipient], html="<p>x</p>"))
+        conn.commit()
+
+        assert api.send_mail_batch(conn) == (0, 2)
+        assert {(row['status'], row['attempts']) for row in outbox(conn).values()} == {('pending', 1)}
+    conn.close()
+
+
+def test_mail_batch_reschedules_when_session_drops(app, monkeypatch):
+    smtp = FakeSMTP()
+    send = smtp.send
+
+    def send_once(msg):
+        if smtp.sent:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        send(msg)
+    smtp.send = send_once
+    monkeypatch.setattr(api.mail, 'connect', smtp)
+    conn = api.get_db()
+    with app.app_context():
+        for recipient in ("a@acme.fr", "b@acme.fr", "c@acme.fr"):
+            api.enqueue_mail(conn, api.Message(subject="Devis", recipients=[recipient], html="<p>x</p>"))
+        conn.commit()
+
+        assert api.send_mail_batch(conn) == (1, 2)
+        rows = outbox(conn)
+        assert (rows['["a@acme.fr"]']['status'], rows['["a@acme.fr"]']['attempts']) == ('sent', 1)
+        for recipient in ('["b@acme.fr"]', '["c@acme.fr"]'):
+            assert (rows[recipient]['status'], rows[recipient]['attempts']) == ('pending', 0)
+            assert rows[recipient]['next_attempt_at'] > datetime.now().isoformat()
+    conn.close()
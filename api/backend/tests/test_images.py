@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import api
+
+
+@pytest.fixture
+def renditions(monkeypatch):
+    calls = []
+    make = api.make_image_renditions
+
+    def counting(folder, filename):
+        calls.append(filename)
+        make(folder, filename)
+    monkeypatch.setattr(api, 'make_image_renditions', counting)
+    return calls
+
+
+def wait_for_images():
+    api._image_executor.submit(lambda: None).result()
+
+
+@pytest.mark.skipif(api.Image is None, reason="Pillow absent")
+def test_unreadable_image_is_not_rescheduled(app, client, renditions):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'broken.jpg'), 'wb') as f:
+        f.write(b"pas une image")
+
+    assert client.get('/uploads/broken.jpg?w=320').status_code == 200
+    wait_for_images()
+    for _ in range(3):
+        assert client.get('/uploads/broken.jpg?w=320').status_code == 200
+    wait_for_images()
+    assert renditions == ['broken.jpg']
+
+
+def test_missing_image_is_404_without_renditions(client, renditions):
+    assert client.get('/uploads/absent.jpg?w=320').status_code == 404
+    wait_for_images()
+    assert renditions == []
@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import api
+from conftest import insert_snapshot
+
+IMAGE_URL = "https://cdn1.midocean.com/MO8422-03.jpg"
+PRODUCTS = [{
+    "master_code": "MO8422",
+    "master_id": "40000004",
+    "product_name": "Mug",
+    "variants": [{"variant_id": "10000001", "sku": "MO8422-03", "color_description": "Bleu",
+                  "digital_assets": [{"type": "image", "subtype": "item_picture_front", "url": IMAGE_URL}]}],
+}]
+
+
+def mirror_image(filename):
+    conn = api.get_db()
+    conn.execute("""
+        INSERT OR REPLACE INTO asset_mirror (url, status, filename, attempts, mirrored_at)
+        VALUES (?, 'done', ?, 1, ?)
+    """, (IMAGE_URL, filename, datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+
+def image_url(response):
+    product = response.get_json()['products_with_images'][0]
+    return product['variants'][0]['images'][0]['url']
+
+
+def test_catalog_keeps_cdn_urls_unless_asked(client, auth_headers):
+    insert_snapshot('products', PRODUCTS)
+    first = client.get('/products/images/full', headers=auth_headers)
+    assert image_url(first) == IMAGE_URL
+
+    # Une copie du miroir ne change ni la réponse par défaut ni son ETag
+    mirror_image('abc.jpg')
+    second = client.get('/products/images/full', headers=auth_headers)
+    assert image_url(second) == IMAGE_URL
+    assert second.headers['ETag'] == first.headers['ETag']
+
+    local = client.get('/products/images/full?local_images=1', headers=auth_headers)
+    assert image_url(local).endswith('/uploads/abc.jpg')
+    local = client.get('/products/images/full', headers=dict(auth_headers, **{'X-Local-Images': '1'}))
+    assert image_url(local).endswith('/uploads/abc.jpg')
+
+    product = client.get('/products/images/full/MO8422', headers=auth_headers).get_json()
+    assert product['variants'][0]['images'][0]['url'] == IMAGE_URL
+
+
+def test_devis_image_only_downloads_allowed_hosts(app, monkeypatch):
+    downloads = []
+    monkeypatch.setattr(api, 'download_image', lambda url, folder=None: downloads.append(url) or 'img.jpg')
+    with app.app_context():
+        assert api.devis_image_path("http://169.254.169.254/latest/meta-data") is None
+        assert api.devis_image_path("https://example.com/huge.jpg") is None
+        assert api.devis_image_path("http://cdn1.midocean.com/MO8422-03.jpg") is None
+        assert api.devis_image_path(IMAGE_URL).endswith('img.jpg')
+    assert downloads == [IMAGE_URL]
+
+
+def test_mirror_rerun_requested_during_release_is_not_lost(app, monkeypatch):
+    runs = []
+    monkeypatch.setattr(api, 'mirror_catalog_assets', lambda conn: runs.append(1) or (0, 0))
+
+    class RacingLock:
+        """Un fetch demande une copie juste avant que le thread du miroir libère le verrou"""
+
+        def __init__(self):
+            self.lock, self.raced = api.threading.Lock(), False
+
+        def acquire(self, blocking=True):
+            return self.lock.acquire(blocking)
+
+        def release(self):
+            if not self.raced:
+                self.raced = True
+                api.schedule_asset_mirror()  # verrou encore pris : acquire échoue, seul le drapeau est posé
+            self.lock.release()
+
+        def locked(self):
+            return self.lock.locked()
+
+    monkeypatch.setattr(api, '_mirror_lock', RacingLock())
+    assert api._mirror_lock.acquire(blocking=False)
+    api.run_asset_mirror()
+    assert len(runs) == 2
+    assert not api._mirror_lock.locked()
@@ -0,0 +1,62 @@
+from conftest import insert_snapshot
+
+# Extrait du flux printdata 1.0 : les techniques des positions sont des objets
+PRINTDATA = {
+    "printing_techniques": [
+        {"id": "S1", "name": [{"fr": "Sérigraphie"}], "default": False, "max_colours": "4"},
+        {"id": "TD", "name": [{"fr": "Transfert digital"}], "default": False, "max_colours": "0"},
+    ],
+    "products": [{
+        "master_code": "MO8422",
+        "master_id": "40000004",
+        "item_color_numbers": ["03", "05"],
+        "print_manipulation": "A",
+        "print_template": "https://printtemplates.v2.midocean.com/MO8422.pdf",
+        "printing_positions": [{
+            "position_id": "FRONT",
+            "print_size_unit": "mm",
+            "max_print_size_height": 50,
+            "max_print_size_width": 70,
+            "rotation": 0,
+            "print_position_type": "Rectangle",
+            "printing_techniques": [
+                {"id": "S1", "default": True, "max_colours": "4"},
+                {"id": "TD", "default": False, "max_colours": "0"},
+                {"id": "XX", "default": False},
+            ],
+            "points": [{"distance_from_left": 123, "distance_from_top": 45, "sequence_no": 1}],
+            "images": [{"variant_color": "03",
+                        "print_position_image_blank": "https://cdn1.midocean.com/MO8422-blank.jpg",
+                        "print_position_image_with_area": "https://cdn1.midocean.com/MO8422-area.jpg"}],
+        }],
+    }],
+}
+
+
+def test_print_data_resolves_dict_techniques(client):
+    insert_snapshot('printdata', PRINTDATA)
+
+    response = client.get('/api/printdata/by-master-code/MO8422')
+    assert response.status_code == 200
+    techniques = response.get_json()['data']['printing_positions'][0]['printing_techniques']
+    assert [tech['id'] for tech in techniques] == ['S1', 'TD']
+    assert techniques[0]['default'] is True
+    assert techniques[0]['name'] == [{"fr": "Sérigraphie"}]
+
+    response = client.post('/api/printdata/by-master-codes', json={"master_codes": ["MO8422", "MO0000"]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert list(body['data']) == ['MO8422']
+    assert body['not_found'] == ['MO0000']
+
+
+def test_print_data_accepts_plain_technique_ids(client):
+    payload = dict(PRINTDATA, products=[dict(PRINTDATA['products'][0], printing_positions=[
+        dict(PRINTDATA['products'][0]['printing_positions'][0], printing_techniques=["TD"])
+    ])])
+    insert_snapshot('printdata', payload)
+
+    response = client.get('/api/printdata/by-master-code/MO8422')
+    assert response.status_code == 200
+    techniques = response.get_json()['data']['printing_positions'][0]['printing_techniques']
+    assert [tech['id'] for tech in techniques] == ['TD']
@@ -0,0 +1,49 @@
+import api
+
+PRODUCTS = [
+    ("Mug", 2.5, "Maison", 10),
+    ("Stylo", 0.8, "Bureau", 0),
+    ("Carnet", 4.0, "Bureau", 5),
+    ("Gourde", 9.9, "Sport", 3),
+    ("Crayon", 0.3, "Bureau", 12),
+]
+
+
+def insert_products():
+    conn = api.get_db()
+    conn.executemany("INSERT INTO products (name, price, category_level1, stock) VALUES (?, ?, ?, ?)", PRODUCTS)
+    conn.commit()
+    conn.close()
+
+
+def test_keyset_pages_until_exhausted(client):
+    insert_products()
+    names, cursor, pages = [], None, 0
+    while True:
+        url = '/products?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        names += [product['name'] for product in response.get_json()]
+        pages += 1
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert names == [name for name, *_ in PRODUCTS]
+    assert pages == 3
+
+
+def test_filters_and_projection(client):
+    insert_products()
+    response = client.get('/products?category_level1=Bureau&in_stock=1&min_price=0.5&fields=name,price')
+    assert response.status_code == 200
+    assert response.get_json() == [{"id": 3, "name": "Carnet", "price": 4.0}]
+
+    # id est toujours renvoyé, même absent de fields
+    products = client.get('/products?fields=name&max_price=1').get_json()
+    assert products == [{"id": 2, "name": "Stylo"}, {"id": 5, "name": "Crayon"}]
+
+
+def test_invalid_parameters(client):
+    assert client.get('/products?fields=name,secret').status_code == 400
+    assert client.get('/products?min_price=abc').status_code == 400
+    assert client.get('/products?limit=deux').status_code == 400
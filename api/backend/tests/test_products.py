@@ -0,0 +1,84 @@
+import json
+
+import api
+
+
+def stored_json(product_id):
+    conn = api.get_db()
+    row = conn.execute("SELECT colors_json, images_json, images_by_color_json, print_data_json "
+                       "FROM products WHERE id = ?", (product_id,)).fetchone()
+    conn.close()
+    return {key: json.loads(row[key]) for key in row.keys()}
+
+
+def test_create_product_json_defaults(client, auth_headers):
+    response = client.post('/products', data={"name": "Mug", "price": "2.5"}, headers=auth_headers)
+    assert response.status_code == 201
+    assert stored_json(response.get_json()['product_id']) == {
+        "colors_json": [], "images_json": [], "images_by_color_json": {}, "print_data_json": {}}
+
+
+def test_create_product_rejects_wrong_json_types(client, auth_headers):
+    response = client.post('/products', data={"name": "Mug", "price": "2.5", "print_data_json": "[]"},
+                           headers=auth_headers)
+    assert response.status_code == 400
+    response = client.post('/products', data={"name": "Mug", "price": "2.5", "colors_json": "{not json"},
+                           headers=auth_headers)
+    assert response.status_code == 400
+
+
+def bulk(client, auth_headers, items, **kwargs):
+    return client.post('/products/bulk', json=items, headers=auth_headers, **kwargs)
+
+
+def test_bulk_upsert_statuses(client, auth_headers):
+    items = [{"master_code": "MO8422", "name": "Mug", "price": 2.5},
+             {"name": "Sans référence", "price": "1"},
+             {"master_code": "MO9999", "name": "Stylo", "price": 0.8, "colors_json": ["Bleu"]}]
+    response = bulk(client, auth_headers, items)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert (body['created'], body['updated'], body['unchanged']) == (3, 0, 0)
+    assert [item['index'] for item in body['items']] == [0, 1, 2]
+    ids = [item['id'] for item in body['items']]
+    assert ids == sorted(ids) and len(set(ids)) == 3
+    conn = api.get_db()
+    stored = {row['id']: row['name'] for row in conn.execute("SELECT id, name FROM products")}
+    conn.close()
+    assert [stored[product_id] for product_id in ids] == ["Mug", "Sans référence", "Stylo"]
+
+    # Même lot, un prix modifié et une erreur en tête : les index suivent le corps reçu
+    items = [{"name": "Sans prix"}, dict(items[0], price=3), items[2]]
+    response = bulk(client, auth_headers, items)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['created'], body['updated'], body['unchanged']) == (0, 1, 1)
+    assert body['items'] == [{"index": 1, "id": ids[0], "status": "updated"},
+                             {"index": 2, "id": ids[2], "status": "unchanged"}]
+    assert [error['index'] for error in body['errors']] == [0]
+
+
+def test_bulk_rejects_duplicate_master_code(client, auth_headers):
+    items = [{"master_code": "MO8422", "name": "Mug", "price": 2.5},
+             {"master_code": "MO8422", "name": "Mug bis", "price": 3}]
+    body = bulk(client, auth_headers, items).get_json()
+    assert body['created'] == 1 and body['items'][0]['index'] == 0
+    assert body['errors'] == [{"index": 1, "error": "master_code MO8422 en double dans le lot"}]
+
+
+def test_bulk_accepts_ndjson(client, auth_headers):
+    lines = [json.dumps({"master_code": "MO8422", "name": "Mug", "price": 2.5}), "",
+             "{pas du json", json.dumps({"master_code": "MO9999", "name": "Stylo", "price": 0.8})]
+    response = client.post('/products/bulk', data="\n".join(lines) + "\n",
+                           content_type='application/x-ndjson', headers=auth_headers)
+    assert response.status_code == 201
+    body = response.get_json()
+    assert [item['index'] for item in body['items']] == [0, 2]
+    assert body['errors'] == [{"index": 1, "error": "ligne NDJSON invalide"}]
+
+
+def test_bulk_limit(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(api, 'PRODUCTS_BULK_MAX', 2)
+    items = [{"name": f"Produit {i}", "price": 1} for i in range(3)]
+    assert bulk(client, auth_headers, items).status_code == 413
+    assert bulk(client, auth_headers, items[:2]).status_code == 201
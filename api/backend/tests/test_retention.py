@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+import api
+
+
+def insert(conn, days_ago, status='success', last_seen_days_ago=None):
+    fetched_at = (datetime.now() - timedelta(days=days_ago)).isoformat()
+    last_seen_at = None
+    if last_seen_days_ago is not None:
+        last_seen_at = (datetime.now() - timedelta(days=last_seen_days_ago)).isoformat()
+    c = conn.execute("""
+        INSERT INTO api_data (endpoint, fetched_at, data, status, last_seen_at)
+        VALUES ('products', ?, '[]', ?, ?)
+    """, (fetched_at, status, last_seen_at))
+    return c.lastrowid
+
+
+def test_retention_keeps_current_recent_and_seen_snapshots(app):
+    conn = api.get_db()
+    current = insert(conn, 40)  # snapshot du catalogue courant
+    seen = insert(conn, 30, last_seen_days_ago=1)  # contenu identique revu hier
+    old = [insert(conn, days) for days in (25, 20, 15)]
+    error = insert(conn, 50, status='error')  # seul de son (endpoint, statut)
+    recent = [insert(conn, 2), insert(conn, 1)]
+    conn.execute("INSERT INTO catalog_state (id, products_id, built_at) VALUES (1, ?, ?)",
+                 (current, datetime.now().isoformat()))
+    conn.executemany("INSERT INTO api_data_items (api_data_id, seq, data) VALUES (?, 0, '{}')",
+                     [(snapshot_id,) for snapshot_id in [current] + old])
+    conn.commit()
+
+    assert api.apply_retention(conn, keep_last=2, keep_days=7) == 3
+    conn.commit()
+    kept = {row['id'] for row in conn.execute("SELECT id FROM api_data")}
+    assert kept == {current, seen, error, *recent}
+    items = {row['api_data_id'] for row in conn.execute("SELECT api_data_id FROM api_data_items")}
+    assert items == {current}
+    conn.close()
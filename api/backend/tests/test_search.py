@@ -0,0 +1,25 @@
+import api
+
+
+def test_search_returns_local_master_code(client, auth_headers):
+    client.post('/products', data={"name": "Mug céramique", "price": "2", "master_code": "MO8422"},
+                headers=auth_headers)
+    client.post('/products', data={"name": "Mug isotherme", "price": "3"}, headers=auth_headers)
+
+    response = client.get('/products/search?q=mug&source=local')
+    assert response.status_code == 200
+    codes = {item['name']: item['master_code'] for item in response.get_json()['results']}
+    assert codes == {"Mug céramique": "MO8422", "Mug isotherme": None}
+
+
+def test_migration_reindexes_existing_products(client, auth_headers):
+    client.post('/products', data={"name": "Stylo bambou", "price": "1", "master_code": "MO9001"},
+                headers=auth_headers)
+    conn = api.get_db()
+    conn.execute("UPDATE product_search SET master_code = NULL WHERE rowid > 0")
+    api.migration_014_product_search_master_code(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    item = client.get('/products/search?q=stylo').get_json()['results'][0]
+    assert item['master_code'] == "MO9001"
@@ -0,0 +1,30 @@
+import api
+
+
+def create(client, headers, **fields):
+    response = client.post('/products', data=dict({"price": "1"}, **fields), headers=headers)
+    assert response.status_code in (200, 201)
+    api._similar_executor.submit(lambda: None).result()  # attend la mise à jour des voisins
+    return response.get_json()['product_id']
+
+
+def similar_ids(client, product_id):
+    return [item['id'] for item in client.get(f'/products/{product_id}/similar?limit=8').get_json()]
+
+
+def test_update_removes_stale_reverse_neighbours(client, auth_headers):
+    mug = dict(category_level1="Maison", category_level2="Cuisine", category_level3="Mugs")
+    pen = dict(category_level1="Bureau", category_level2="Ecriture", category_level3="Stylos")
+    red = create(client, auth_headers, name="Mug céramique rouge", description="mug céramique 300 ml", **mug)
+    blue = create(client, auth_headers, name="Mug céramique bleu", description="mug céramique 300 ml",
+                  master_code="MO1", **mug)
+    pen_id = create(client, auth_headers, name="Stylo bambou", description="stylo bille bambou", **pen)
+    assert blue in similar_ids(client, red)
+    assert blue not in similar_ids(client, pen_id)
+
+    # Le produit MO1 devient un stylo : il quitte la liste du mug et entre dans celle du stylo
+    create(client, auth_headers, name="Stylo bambou bleu", description="stylo bille bambou",
+           master_code="MO1", **pen)
+    assert blue not in similar_ids(client, red)
+    assert blue in similar_ids(client, pen_id)
+    assert similar_ids(client, blue) == [pen_id]
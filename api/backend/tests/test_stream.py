@@ -0,0 +1,64 @@
+import json
+import random
+
+import pytest
+
+import api
+
+DOCUMENTS = [
+    # Nombres coupés entre deux chunks, dont le dernier élément avant ']'
+    '{"products": [12345, -0.5e10, 3.14159, 1000000], "count": 4}',
+    # Guillemets échappés et ']' dans les chaînes, y compris dans l'enveloppe
+    '{"meta": {"note": "a \\"quoted\\" ] value"}, "products": ["]", "x\\\\", {"k": "[\\"]"}], "end": "]"}',
+    # UTF-8 multi-octets (accents, emoji) coupé entre deux chunks
+    '{"products": [{"name": "Café ☕ été", "desc": "Größe 😀"}], "lang": "fr"}',
+    # Tableau racine
+    ' [ {"master_code": "MO8422"} , {"master_code": "MO9999", "tags": []} ] ',
+    # Tableau vide, clé absente, espaces partout
+    '{ "products" : [ ] , "other" : [1, 2] }',
+    '{"other": {"products": [1]}, "n": null, "b": true}',
+]
+
+
+def chunked(data, sizes):
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = next(sizes)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def parse(chunks):
+    stream = api.JsonArrayStream(chunks, 'products')
+    return list(stream.items()), stream.envelope
+
+
+def expected(document):
+    value = json.loads(document)
+    if isinstance(value, list):
+        return value, []
+    if 'products' not in value:
+        return [], value
+    return value['products'], dict(value, products=[])
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('size', range(1, 8))
+def test_stream_matches_json_loads(document, size):
+    data = document.encode('utf-8')
+    assert parse(chunked(data, iter(lambda: size, None))) == expected(document)
+
+
+def test_stream_random_chunks():
+    rng = random.Random(4)
+    for _ in range(200):
+        document = rng.choice(DOCUMENTS)
+        data = document.encode('utf-8')
+        sizes = iter(lambda: rng.randint(1, 7), None)
+        assert parse(chunked(data, sizes)) == expected(document)
+
+
+def test_stream_rejects_truncated_document():
+    with pytest.raises(ValueError):
+        parse([b'{"products": [1, 2'])
@@ -1015,6 +1015,7 @@ const addToCatalog = async (product) => {
     const formData = new FormData();
 
     // 1. Données de base
+    formData.append("master_code", product.master_code || "");
     formData.append("name", product.product_name || "Produit sans nom");
     formData.append("price", String((product.price ?? 0) * 2));
     formData.append("description", product.long_description || product.short_description || "");
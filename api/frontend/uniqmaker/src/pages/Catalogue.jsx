@@ -21,6 +21,21 @@ import 'react-lazy-load-image-component/src/effects/blur.css';
 
 const API_BASE = process.env.REACT_APP_API_BASE || "http://localhost:5001";
 
+// Les devis sont générés en tâche de fond : on interroge leur statut jusqu'au PDF
+const waitForDevis = async (statusUrl, { interval = 1000, timeout = 120000 } = {}) => {
+  const deadline = Date.now() + timeout;
+  while (Date.now() < deadline) {
+    const response = await fetch(`${API_BASE}${statusUrl}`);
+    const job = await response.json();
+    if (job.status === 'done') return job;
+    if (!response.ok || job.status === 'failed') {
+      throw new Error(job.error || "Erreur lors de la génération du devis");
+    }
+    await new Promise(resolve => setTimeout(resolve, interval));
+  }
+  throw new Error("La génération du devis prend plus de temps que prévu");
+};
+
 const colorNameToHex = (colorName) => {
   if (!colorName) return "#CCCCCC";
 
@@ -439,12 +454,14 @@ const DevisPopup = ({ product, onClose, onSubmit }) => {
         body: JSON.stringify(devisData),
       });
 
-      const result = await response.json();
+      const accepted = await response.json();
 
       if (!response.ok) {
-        throw new Error(result.error || "Erreur lors de l'envoi du devis");
+        throw new Error(accepted.error || "Erreur lors de l'envoi du devis");
       }
 
+      const result = await waitForDevis(accepted.status_url);
+
       setSendSuccess(true);
       setPdfUrl(result.pdf_url);
       onSubmit(result);